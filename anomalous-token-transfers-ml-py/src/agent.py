@@ -1,25 +1,45 @@
 from os import environ
+import threading
 from timeit import default_timer as timer
 
 import forta_agent
 from forta_agent import get_json_rpc_url, EntityType
 from web3 import Web3
-import dill
+from cachetools import LRUCache
 import lime.lime_tabular
 import numpy as np
 
-from src.utils.constants import ANOMALY_THRESHOLD, ERC20_TRANSFER_EVENT, MODEL_FEATURES
-from src.utils.data_processing import get_features, SECRETS_JSON
+from src.utils.constants import (
+    ANOMALY_THRESHOLD,
+    BACKGROUND_MODEL_LOADING,
+    ERC20_TRANSFER_EVENT,
+    EXPLAINER_MODE,
+    EXPLAINER_PATH,
+    EXPLANATION_CACHE_RESOLUTION,
+    EXPLANATION_CACHE_SIZE,
+    MODEL_FEATURES,
+    MODEL_PATH,
+    PRELOAD_MODEL_TOKENS,
+)
+from src.utils.data_processing import get_features, preload_model_tokens, SECRETS_JSON
 from src.utils.findings import (
     AnomalousTransaction,
     NormalTransaction,
     InvalidModelFeatures,
 )
 from src.utils.logger import logger
+from src.utils.model_artifacts import (
+    BackgroundLoader,
+    load_dill,
+    load_model_artifact,
+    report_first_score,
+)
 
 
 ML_MODEL = None
 ML_EXPLAINER = None
+ML_MODEL_LOADER = None
+EXPLANATION_CACHE = LRUCache(maxsize=EXPLANATION_CACHE_SIZE)
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 
 
@@ -27,45 +47,118 @@ def initialize():
     """
     this function loads the ml model and explainer.
     """
-    global ML_MODEL, ML_EXPLAINER
-    logger.info("Start loading model")
-    with open("isolation_forest.pkl", "rb") as f:
-        ML_MODEL = dill.load(f)
-    logger.info("Complete loading model")
-    logger.info("Start loading model explainer")
-    with open("model_explainer.pkl", "rb") as f:
-        ML_EXPLAINER = dill.load(f)
-    logger.info("Complete loading model explainer")
+    global ML_MODEL, ML_EXPLAINER, ML_MODEL_LOADER
+    logger.info("Start loading model and model explainer")
+    if BACKGROUND_MODEL_LOADING:
+        ML_MODEL, ML_EXPLAINER = None, None
+        ML_MODEL_LOADER = BackgroundLoader("model and model explainer", load_model)
+    else:
+        ML_MODEL, ML_EXPLAINER = load_model()
+        logger.info("Complete loading model and model explainer")
     environ["ZETTABLOCK_API_KEY"] = SECRETS_JSON['apiKeys']['ZETTABLOCK']
+    if PRELOAD_MODEL_TOKENS:
+        # the token info of the model tokens is requested once, then read from the metadata store
+        threading.Thread(target=preload_model_tokens, name="preload-model-tokens", daemon=True).start()
+
+
+def load_model() -> tuple:
+    """
+    this function loads the ml model and explainer, memory mapped if they were packed
+    :return: model, explainer
+    """
+    return load_model_artifact(MODEL_PATH, load_dill), load_model_artifact(EXPLAINER_PATH, load_dill)
+
+
+def wait_for_model():
+    """
+    this function blocks until the model and explainer loaded in the background are ready.
+    """
+    global ML_MODEL, ML_EXPLAINER
+    if ML_MODEL is None:
+        ML_MODEL, ML_EXPLAINER = ML_MODEL_LOADER.get()
 
 
-def get_explanations(model_input) -> str:
+def get_lime_explanation(model_input):
     def prediction_func(x):
         scores = abs(ML_MODEL.score_samples(x))
         class_probabilities = np.array([[1 - score, score] for score in scores])
 
         return class_probabilities
 
-    explanation = ML_EXPLAINER.explain_instance(
+    return ML_EXPLAINER.explain_instance(
         model_input, prediction_func, num_features=10
     )
+
+
+def get_path_length_weights(model_input) -> np.ndarray:
+    """
+    this function attributes the isolation of the input to the features splitting its path in each tree of the isolation
+    forest: each split is credited with the log of the reduction of training samples it makes, so the splits isolating
+    the input early (short paths, i.e. anomalies) weigh the most
+    :return: weight per feature in MODEL_FEATURES order
+    """
+    weights = np.zeros(len(MODEL_FEATURES))
+    model_input = np.asarray(model_input, dtype=np.float32).reshape(1, -1)
+    for tree, tree_features in zip(ML_MODEL.estimators_, ML_MODEL.estimators_features_):
+        # nodes of the path from the root to the leaf
+        path = tree.decision_path(model_input[:, tree_features]).indices
+        node_samples = tree.tree_.n_node_samples[path]
+        split_features = tree.tree_.feature[path[:-1]]
+        np.add.at(weights, tree_features[split_features], np.log(node_samples[:-1] / node_samples[1:]))
+    return weights / len(ML_MODEL.estimators_)
+
+
+def get_explanations(model_input) -> list:
+    """
+    this function explains the prediction with the explainer selected by EXPLAINER_MODE:
+    lime: LIME on every call, cached_lime: LIME cached by the quantized input, path_length: isolation forest path lengths
+    :return: explanations: list of str
+    """
+    if EXPLAINER_MODE == "path_length":
+        weights = get_path_length_weights(model_input)
+        top_features = np.argsort(-weights)[:10]
+        return [
+            str((MODEL_FEATURES[i], round(float(weights[i]), 4)))
+            for i in top_features
+            if weights[i] > 0
+        ]
+
+    if EXPLAINER_MODE == "cached_lime":
+        # log scale buckets, so close large values share the explanation
+        key = tuple(
+            np.round(
+                np.sign(model_input) * np.log1p(np.abs(model_input)) * EXPLANATION_CACHE_RESOLUTION
+            ).astype(int)
+        )
+        explanations = EXPLANATION_CACHE.get(key)
+        if explanations is None:
+            explanations = [str(weighted_feature) for weighted_feature in get_lime_explanation(model_input).as_list()]
+            EXPLANATION_CACHE[key] = explanations
+        return explanations
+
+    explanation = get_lime_explanation(model_input)
     return [str(weighted_feature) for weighted_feature in explanation.as_list()]
 
 
 def get_prediction(features) -> tuple:
     start = timer()
+    wait_for_model()
     model_input = [[features.get(key, 0) for key in MODEL_FEATURES]]
     # score_samples output the opposite of the anomaly score defined in the original paper.
     # https://cs.nju.edu.cn/zhouzh/zhouzh.files/publication/icdm08b.pdf
     raw_score = ML_MODEL.score_samples(model_input)[0]
-    explanations = get_explanations(
-        np.array(model_input).reshape(
-            -1,
-        )
-    )
+    report_first_score()
     # normalize to return score between 0 and 1 (inclusive)
     normalized_score = abs(raw_score)
     prediction = "ANOMALY" if normalized_score >= ANOMALY_THRESHOLD else "NORMAL"
+    # only the anomalies are explained, the explainers are much slower than the model
+    explanations = []
+    if prediction == "ANOMALY":
+        explanations = get_explanations(
+            np.array(model_input).reshape(
+                -1,
+            )
+        )
     end = timer()
     return normalized_score, prediction, explanations, end - start
 
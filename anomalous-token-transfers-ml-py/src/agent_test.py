@@ -1,7 +1,10 @@
 from unittest.mock import Mock, patch
+
+import numpy as np
 from forta_agent import FindingSeverity, FindingType, create_transaction_event
 import agent
 from src.utils import data_processing
+from src.utils.metadata_store import MetadataStore
 
 mock_tx_event = create_transaction_event(
     {
@@ -24,6 +27,14 @@ USDC_TRANSFER = {
 
 
 class TestAnomalousTokenTransfers:
+    def setup_method(self):
+        # the tests don't preload the model tokens from Ethplorer
+        self.preload_patch = patch.object(agent, "PRELOAD_MODEL_TOKENS", False)
+        self.preload_patch.start()
+
+    def teardown_method(self):
+        self.preload_patch.stop()
+
     def test_returns_empty_findings_if_no_erc20_transfers(self):
         mock_tx_event.filter_log.return_value = []
 
@@ -110,12 +121,15 @@ class TestAnomalousTokenTransfers:
         from_address = mock_tx_event.from_
 
         mock_get_first_tx_timestamp.return_value = 1655403557
-        mock_get_token_info.side_effect = [("Tether USD", "USDT", 6)] * 1_000 + [
-            ("USD Coin", "USDC", 6)
-        ] * 1_000
+        mock_get_token_info.side_effect = {
+            USDT_TOKEN_ADDR: ("Tether USD", "USDT", 6),
+            USDC_TOKEN_ADDR: ("USD Coin", "USDC", 6),
+        }.get
         findings = agent.handle_transaction(mock_tx_event)
 
         assert len(findings) == 1
+        # one lookup per token
+        assert mock_get_token_info.call_count == 2
 
         finding = findings[0]
         assert finding.name == "Anomalous Transaction"
@@ -130,3 +144,91 @@ class TestAnomalousTokenTransfers:
         assert finding.metadata["token_types"] == ["Tether USD-USDT", "USD Coin-USDC"]
         assert finding.metadata["model_score"] == 0.568
         assert finding.metadata["prediction"] == "ANOMALY"
+
+    def test_aggregate_transfers(self):
+        token_infos = {
+            USDT_TOKEN_ADDR: ("Tether USD", "USDT", 6),
+            USDC_TOKEN_ADDR: ("USD Coin", "USDC", 6),
+            "0xnft": ("NO_NAME", "NO_SYMBOL", "NO_DECIMALS"),
+        }
+        transfer_events = [USDC_TRANSFER, USDT_TRANSFER, USDT_TRANSFER, USDC_TRANSFER] + [
+            {"args": {"value": 1}, "address": "0xnft"}
+        ] * 3
+
+        features = data_processing.aggregate_transfers(transfer_events, token_infos)
+
+        assert features["USDT_transfers"] == 2
+        assert features["USDT_value"] == 3400
+        assert features["USDC_transfers"] == 2
+        assert features["USDC_value"] == 10000
+        assert "NO_SYMBOL_transfers" not in features
+        assert features["tokens_type_counts"] == 2
+        # USDT reached 2 transfers first
+        assert features["max_single_token_transfers_name"] == "Tether USD"
+        assert features["max_single_token_transfers_count"] == 2
+        assert features["max_single_token_transfers_value"] == 3400
+
+    def test_aggregate_transfers_exact_large_values(self):
+        # a value beyond the float precision, whose float division is off by one ulp
+        value = 26030898605092851676294403068629666290589805221232206402613
+        token_infos = {USDT_TOKEN_ADDR: ("Tether USD", "USDT", 6)}
+        transfer_events = [{"args": {"value": value, "from": "0x123", "to": "0xabc"}, "address": USDT_TOKEN_ADDR}]
+
+        features = data_processing.aggregate_transfers(transfer_events, token_infos)
+
+        assert features["USDT_value"] == round(value / 10**6, 3)
+        assert features["max_single_token_transfers_value"] == round(value / 10**6, 3)
+
+    def test_path_length_weights_rank_outliers(self):
+        agent.initialize()
+        rng = np.random.default_rng(0)
+        for _ in range(10):
+            model_input = np.zeros(len(agent.MODEL_FEATURES))
+            outliers = rng.choice(len(agent.MODEL_FEATURES), 3, replace=False)
+            model_input[outliers] = rng.lognormal(10, 3, 3)
+
+            weights = agent.get_path_length_weights(model_input)
+
+            top_features = set(np.argsort(-weights)[:10])
+            assert set(outliers) <= top_features, "the outlier features should isolate the input"
+            assert np.array_equal(weights, agent.get_path_length_weights(model_input)), "weights should be deterministic"
+
+    def test_explanations_cached_by_quantized_input(self):
+        agent.initialize()
+        model_input = np.zeros(len(agent.MODEL_FEATURES))
+        model_input[0] = 1_000_000
+        close_model_input = model_input.copy()
+        close_model_input[0] = 1_000_001
+
+        with patch.object(agent, "EXPLAINER_MODE", "cached_lime"):
+            explanations = agent.get_explanations(model_input)
+            with patch.object(agent, "get_lime_explanation") as mock_get_lime_explanation:
+                assert agent.get_explanations(close_model_input) == explanations
+                mock_get_lime_explanation.assert_not_called()
+
+    def test_token_info_persisted_in_metadata_store(self, tmp_path):
+        store = MetadataStore(str(tmp_path / "metadata_store.db"), 3600, 0)
+        response = Mock()
+        response.json.return_value = {"name": "Tether USD", "symbol": "USDT", "decimals": "6"}
+        with patch.object(data_processing, "metadata_store", store), patch.object(
+            data_processing, "get_token_data", return_value=response
+        ) as mock_get_token_data:
+            assert data_processing.get_token_info(USDT_TOKEN_ADDR) == ("Tether USD", "USDT", "6")
+            assert data_processing.get_token_info(USDT_TOKEN_ADDR) == ("Tether USD", "USDT", "6")
+            assert mock_get_token_data.call_count == 1
+
+        # a restart reads it from the database
+        restarted_store = MetadataStore(str(tmp_path / "metadata_store.db"), 3600, 0)
+        assert restarted_store.get_token_info(USDT_TOKEN_ADDR) == (None, "Tether USD", "USDT", "6")
+
+    def test_failed_first_tx_lookup_retried_after_negative_ttl(self, tmp_path):
+        store = MetadataStore(str(tmp_path / "metadata_store.db"), 0, 0)
+        failed_response, response = Mock(), Mock()
+        failed_response.json.return_value = {"status": "0", "result": "Max rate limit reached"}
+        response.json.return_value = {"status": "1", "result": [{"timeStamp": "1655403557"}]}
+        with patch.object(data_processing, "metadata_store", store), patch.object(
+            data_processing, "get_first_tx", side_effect=[failed_response, response]
+        ):
+            assert data_processing.get_first_tx_timestamp("0xbeef") == "Max rate limit reached"
+            assert data_processing.get_first_tx_timestamp("0xbeef") == 1655403557
+        assert store.stats()["first_tx_entries"] == 1
@@ -0,0 +1,41 @@
+from timeit import default_timer as timer
+
+import numpy as np
+
+from src import agent
+
+
+def benchmark_explainers(samples: int = 10, seed: int = 0) -> dict:
+    """
+    this function explains synthetic anomalies (a few features with large lognormal values) with LIME and with the path
+    length weights, and compares their latency and the overlap of their top 10 features
+    :return: lime and path length latency per explanation in seconds and mean top 10 agreement: dict
+    """
+    agent.initialize()
+    rng = np.random.default_rng(seed)
+    model_inputs = []
+    for _ in range(samples):
+        model_input = np.zeros(len(agent.MODEL_FEATURES))
+        outliers = rng.choice(len(agent.MODEL_FEATURES), 3, replace=False)
+        model_input[outliers] = rng.lognormal(10, 3, 3)
+        model_inputs.append(model_input)
+
+    start = timer()
+    lime_top_features = [{i for i, _ in agent.get_lime_explanation(x).as_map()[1]} for x in model_inputs]
+    lime_latency = (timer() - start) / samples
+
+    start = timer()
+    path_length_top_features = [set(np.argsort(-agent.get_path_length_weights(x))[:10]) for x in model_inputs]
+    path_length_latency = (timer() - start) / samples
+
+    agreement = np.mean([len(a & b) / 10 for a, b in zip(lime_top_features, path_length_top_features)])
+    return {"lime_latency": lime_latency, "path_length_latency": path_length_latency, "agreement": agreement}
+
+
+if __name__ == "__main__":
+    # python3 -m src.explainer_benchmark, from the bot directory
+    result = benchmark_explainers()
+    print(
+        f"lime: {result['lime_latency'] * 1000:.1f}ms, path_length: {result['path_length_latency'] * 1000:.1f}ms, "
+        f"top-10 agreement: {result['agreement']:.0%}"
+    )
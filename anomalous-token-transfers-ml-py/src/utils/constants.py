@@ -7,6 +7,37 @@ ETHERSCAN_ENDPOINT = (
     "https://api.etherscan.io/api?module=account&action=txlist&page=1&offset=1&sort=asc"
 )
 
+METADATA_STORE_PATH = "metadata_store.db"  # SQLite database of the token info and first tx timestamps, kept across restarts
+METADATA_NEGATIVE_TTL = 3600  # seconds before a failed token info or first tx lookup is retried
+METADATA_STATS_LOG_INTERVAL = 1000  # log the metadata store stats every N lookups
+PRELOAD_MODEL_TOKENS = True  # load the token info of the model tokens into the metadata store at startup
+# mainnet addresses of the tokens in MODEL_FEATURES, preloaded in the metadata store; the others are stored when first seen
+MODEL_TOKEN_ADDRESSES = {
+    "APE": "0x4d224452801aced8b2f0aebe155379bb5d594381",
+    "CRV": "0xd533a949740bb3306d119cc777fa900ba034cd52",
+    "DAI": "0x6b175474e89094c44da98b954eedeac495271d0f",
+    "GALA": "0x15d4c048f83bd7e37d49ea4c83a07267ec4203da",
+    "HEX": "0x2b591e99afe9f32eaa6214f7b7629768c40eeb39",
+    "LINK": "0x514910771af9ca656af840dff83e8264ecf986ca",
+    "LOOKS": "0xf4d2888d29d722226fafa5d9b24f9164c092421e",
+    "MANA": "0x0f5d2fb29fb7d3cfee444a200298f468908cc942",
+    "MATIC": "0x7d1afa7b718fb893db30a3abc0cfc608aacfebb0",
+    "SAND": "0x3845badade8e6dff049820680d1f14bd3903a5d0",
+    "SHIB": "0x95ad61b0a150d79219dcf64e1e6cc01f0b64c4ce",
+    "SOS": "0x3b484b82567a09e2588a13d54d032153f0c0aee0",
+    "USDC": "0xa0b86991c6218b36c1d19d4a2e9eb0ce3606eb48",
+    "USDT": "0xdac17f958d2ee523a2206206994597c13d831ec7",
+    "WBTC": "0x2260fac5e5542a773aa44fbcfedf7c193bc2c599",
+    "WETH": "0xc02aaa39b223fe8d0a0e5c4f27ead9083c756cc2",
+}
+FEATURE_WORKERS = 8  # threads resolving the token info misses and the first tx of a tx concurrently
+ETHPLORER_REQUESTS_PER_SECOND = 10  # rate budget of the token info requests, shared by the threads
+MODEL_PATH = "isolation_forest.pkl"
+EXPLAINER_PATH = "model_explainer.pkl"
+EXPLAINER_MODE = "lime"  # "lime", "cached_lime" (LIME cached by the quantized model input) or "path_length" (isolation forest path lengths)
+EXPLANATION_CACHE_SIZE = 10_000  # how many explanations to keep in cached_lime mode
+EXPLANATION_CACHE_RESOLUTION = 4  # buckets per natural log unit of the features in cached_lime mode
+BACKGROUND_MODEL_LOADING = False  # load the model and explainer on a background thread; the transactions wait for them
 MODEL_CREATED_TIMESTAMP = "1657669403"  # Tuesday, July 12, 2022 11:43:23 PM
 MODEL_FEATURES = [
     "APE_transfers",
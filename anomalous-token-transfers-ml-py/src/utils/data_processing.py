@@ -1,20 +1,69 @@
-from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 from timeit import default_timer as timer
 from random import randint
+import threading
+import time
 
 import backoff
+import numpy as np
 import requests
 from expiring_dict import ExpiringDict
 
 from src.utils.constants import (
     ETHPLORER_ENDPOINT,
     ETHERSCAN_ENDPOINT,
+    ETHPLORER_REQUESTS_PER_SECOND,
+    FEATURE_WORKERS,
+    METADATA_NEGATIVE_TTL,
+    METADATA_STATS_LOG_INTERVAL,
+    METADATA_STORE_PATH,
+    MODEL_TOKEN_ADDRESSES,
 )
 
 from src.utils.logger import logger
+from src.utils.metadata_store import MetadataStore
 from src.storage import get_secrets
 
 SECRETS_JSON = get_secrets()
+metadata_store = None
+metadata_store_lock = threading.Lock()
+# resolves the token info misses and the first tx of the sender of a tx concurrently
+FEATURE_EXECUTOR = ThreadPoolExecutor(max_workers=FEATURE_WORKERS, thread_name_prefix="features")
+
+
+class RateLimiter:
+    """
+    Spaces the requests to an API shared by concurrent threads, so they stay within requests_per_second; acquire()
+    blocks until the next request slot.
+    """
+
+    def __init__(self, requests_per_second: float):
+        self.interval = 1 / requests_per_second
+        self._lock = threading.Lock()
+        self._next_slot = 0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+ETHPLORER_RATE_LIMITER = RateLimiter(ETHPLORER_REQUESTS_PER_SECOND)
+
+
+def get_metadata_store() -> MetadataStore:
+    """
+    this function returns the metadata store, opening its database on the first call
+    :return: metadata_store: MetadataStore
+    """
+    global metadata_store
+    with metadata_store_lock:
+        if metadata_store is None:
+            metadata_store = MetadataStore(METADATA_STORE_PATH, METADATA_NEGATIVE_TTL, METADATA_STATS_LOG_INTERVAL)
+    return metadata_store
 
 
 # Retry if etherscan api response status is not ok = 0.
@@ -32,13 +81,17 @@ def get_first_tx(url):
     backoff.expo, requests.exceptions.RequestException, max_tries=3, jitter=None
 )
 def get_token_data(url):
+    ETHPLORER_RATE_LIMITER.acquire()
     return requests.get(url)
 
 
-@lru_cache(maxsize=1_000_000)
 def get_first_tx_timestamp(address) -> int:
-    """Gets address's first tx timestamp from Etherscan in unix."""
-    first_tx_timestamp = -1
+    """Gets address's first tx timestamp from Etherscan in unix, or the error message. Stored in the metadata store."""
+    stored = get_metadata_store().get_first_tx_timestamp(address)
+    if stored is not None:
+        error, first_tx_timestamp = stored
+        return first_tx_timestamp if error is None else error
+
     data = {}
     api_key = SECRETS_JSON['apiKeys']['ETHERSCAN'][randint(0, 1)]
     addr_first_tx_endpoint = f"{ETHERSCAN_ENDPOINT}&address={address}&apikey={api_key}"
@@ -49,10 +102,13 @@ def get_first_tx_timestamp(address) -> int:
     except requests.exceptions.RequestException or Exception as err:
         logger.warn(f"Request failed for addr: {address}, err: {err}")
 
-    if int(data["status"]) == 1:
+    if int(data.get("status", 0)) == 1:
         first_tx_timestamp = int(data["result"][0]["timeStamp"])
+        get_metadata_store().put_first_tx_timestamp(address, first_tx_timestamp)
     else:
-        first_tx_timestamp = data["result"]
+        # retried once the negative entry expires
+        first_tx_timestamp = str(data.get("result", "Request failed"))
+        get_metadata_store().put_first_tx_timestamp_failure(address, first_tx_timestamp)
 
     return first_tx_timestamp
 
@@ -60,7 +116,6 @@ def get_first_tx_timestamp(address) -> int:
 def get_account_active_period(address, recent_tx_timestamp) -> float:
     """Return difference between first and recent transaction timestamp in minutes."""
     first_tx_timestamp = get_first_tx_timestamp(address)
-    logger.info(f"get_first_tx_timestamp: {get_first_tx_timestamp.cache_info()}")
 
     if isinstance(first_tx_timestamp, str):
         return first_tx_timestamp
@@ -68,9 +123,20 @@ def get_account_active_period(address, recent_tx_timestamp) -> float:
     return (recent_tx_timestamp - first_tx_timestamp) / 60
 
 
-@lru_cache(maxsize=1_000_000)
 def get_token_info(token_address) -> tuple:
-    """Get token name, symbol, and decimals from Ethplorer API."""
+    """Get token name, symbol, and decimals from Ethplorer API. Stored in the metadata store."""
+    stored = get_metadata_store().get_token_info(token_address)
+    if stored is not None:
+        error, name, symbol, decimals = stored
+        if error is None:
+            return name, symbol, decimals
+        return "NO_NAME", "NO_SYMBOL", "NO_DECIMALS"
+
+    return request_token_info(token_address)
+
+
+def request_token_info(token_address) -> tuple:
+    """Request token name, symbol, and decimals from Ethplorer API and store them in the metadata store."""
     token_info_endpoint = (
         f"{ETHPLORER_ENDPOINT}/getTokenInfo/{token_address}?apiKey={SECRETS_JSON['apiKeys']['ETHPLORER']}"
     )
@@ -86,40 +152,68 @@ def get_token_info(token_address) -> tuple:
     symbol = data.get("symbol", "NO_SYMBOL")
     decimals = data.get("decimals", "NO_DECIMALS")
 
+    if decimals != "NO_DECIMALS":
+        get_metadata_store().put_token_info(token_address, name, symbol, decimals)
+    else:
+        # not a token, or the request failed: retried once the negative entry expires
+        get_metadata_store().put_token_info_failure(token_address, data.get("error", "Request failed"))
+
     return name, symbol, decimals
 
 
-def get_features(from_address, tx_timestamp, transfer_events) -> tuple:
+def preload_model_tokens():
+    """Load the token info of the tokens in MODEL_FEATURES that are not in the metadata store yet."""
     start = timer()
+    for symbol, token_address in MODEL_TOKEN_ADDRESSES.items():
+        if get_metadata_store().get_token_info(token_address) is None:
+            _, stored_symbol, _ = request_token_info(token_address)
+            if stored_symbol != symbol:
+                logger.warn(f"Preloaded token {token_address}: expected symbol {symbol}, got {stored_symbol}")
+    logger.info(f"Preloaded model tokens in {timer() - start:.2f}s. Metadata store: {get_metadata_store().stats()}")
+
+
+def aggregate_transfers(transfer_events, token_infos) -> dict:
+    """
+    this function aggregates the erc20 transfers per token symbol with numpy: transfer count, sum of the normalized values
+    and the token with the most transfers (the first one to reach the highest count, as if they were counted in order)
+    :param token_infos: dict token address -> (name, symbol, decimals)
+    :return: features: dict
+    """
     features = {}
+    # the transfers of tokens without decimals are likely not erc20
+    erc20_transfers = [
+        (token_infos[transfer["address"]], transfer["args"]["value"])
+        for transfer in transfer_events
+        if token_infos[transfer["address"]][2] != "NO_DECIMALS"
+    ]
+    token_types = {f"{name}-{symbol}" for (name, symbol, _), _ in erc20_transfers}
 
-    features["transfer_counts"] = len(transfer_events)
-    features["account_active_period_in_minutes"] = get_account_active_period(
-        from_address, tx_timestamp
-    )
-
-    token_types = set()
     max_token_transfers_name = ""
     max_single_token_transfers_count = 0
     max_single_token_transfers_value = 0
-
-    for transfer in transfer_events:
-        token_address = transfer["address"]
-        value = transfer["args"]["value"]
-        token_name, token_symbol, decimals = get_token_info(token_address)
-        logger.info(f"get_token_info: {get_token_info.cache_info()}")
-        token_transfers = f"{token_symbol}_transfers"
-        token_value = f"{token_symbol}_value"
-        if decimals != "NO_DECIMALS":  # token is likely not an erc20
-            normalized_value = round(value / (10 ** int(decimals)), 3)
-            features[token_transfers] = features.get(token_transfers, 0) + 1
-            features[token_value] = features.get(token_value, 0) + normalized_value
-            token_types.add(f"{token_name}-{token_symbol}")
-
-            if features[token_transfers] > max_single_token_transfers_count:
-                max_token_transfers_name = token_name
-                max_single_token_transfers_count = features[token_transfers]
-                max_single_token_transfers_value = features[token_value]
+    if len(erc20_transfers) > 0:
+        symbols, symbol_index = np.unique(
+            [str(symbol) for (_, symbol, _), _ in erc20_transfers], return_inverse=True
+        )
+        # normalized per transfer with the exact integer division, as 256 bits values don't fit in a float
+        normalized_values = np.array(
+            [round(value / (10 ** int(decimals)), 3) for (_, _, decimals), value in erc20_transfers]
+        )
+
+        transfer_counts = np.bincount(symbol_index)
+        transfer_values = np.bincount(symbol_index, weights=normalized_values)
+        last_transfer = np.zeros(len(symbols), dtype=int)
+        np.maximum.at(last_transfer, symbol_index, np.arange(len(erc20_transfers)))
+        for symbol, count, value in zip(symbols, transfer_counts, transfer_values):
+            features[f"{symbol}_transfers"] = int(count)
+            features[f"{symbol}_value"] = float(value)
+
+        # among the symbols with the most transfers, the one whose last transfer comes first reached the count first
+        max_count = transfer_counts.max()
+        max_symbol = np.flatnonzero(transfer_counts == max_count)[np.argmin(last_transfer[transfer_counts == max_count])]
+        max_token_transfers_name = erc20_transfers[last_transfer[max_symbol]][0][0]
+        max_single_token_transfers_count = int(max_count)
+        max_single_token_transfers_value = float(transfer_values[max_symbol])
 
     features["token_types"] = sorted(list(token_types))
     features["max_single_token_transfers_name"] = max_token_transfers_name
@@ -128,6 +222,24 @@ def get_features(from_address, tx_timestamp, transfer_events) -> tuple:
     features["max_single_token_transfers_count"] = max_single_token_transfers_count
     features["max_single_token_transfers_value"] = max_single_token_transfers_value
 
+    return features
+
+
+def get_features(from_address, tx_timestamp, transfer_events) -> tuple:
+    start = timer()
+    features = {}
+
+    features["transfer_counts"] = len(transfer_events)
+    # each token is looked up once; the misses are requested concurrently (within ETHPLORER_REQUESTS_PER_SECOND) and with the first tx of the sender
+    account_active_period = FEATURE_EXECUTOR.submit(
+        get_account_active_period, from_address, tx_timestamp
+    )
+    token_addresses = list(dict.fromkeys(transfer["address"] for transfer in transfer_events))
+    token_infos = dict(zip(token_addresses, FEATURE_EXECUTOR.map(get_token_info, token_addresses)))
+    features["account_active_period_in_minutes"] = account_active_period.result()
+
+    features.update(aggregate_transfers(transfer_events, token_infos))
+
     valid = valid_features(features)
 
     end = timer()
@@ -0,0 +1,102 @@
+import sqlite3
+import threading
+import time
+
+from src.utils.logger import logger
+
+
+class MetadataStore:
+    """
+    Persistent store of the token info and the first tx timestamps, in a local SQLite database in WAL mode, so the bot
+    doesn't request them again after a restart. Both are immutable once found and never expire; failed lookups are
+    stored as negative entries that expire after negative_ttl seconds, so they are retried.
+    """
+
+    def __init__(self, path: str, negative_ttl: int, stats_log_interval: int):
+        self.path = path
+        self.negative_ttl = negative_ttl
+        self.stats_log_interval = stats_log_interval
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "negative_hits": 0, "misses": 0, "stored": 0, "failures_stored": 0}
+        self._lookups = 0
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS token_info "
+            "(address TEXT PRIMARY KEY, name TEXT, symbol TEXT, decimals TEXT, error TEXT, updated_at REAL)"
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS first_tx "
+            "(address TEXT PRIMARY KEY, timestamp INTEGER, error TEXT, updated_at REAL)"
+        )
+
+    def _get(self, table: str, columns: str, address: str):
+        """
+        this function returns the stored row of the address, None if it is not stored or it is an expired failure
+        :return: (error, *columns) or None
+        """
+        with self._lock:
+            row = self._connection.execute(
+                f"SELECT error, updated_at, {columns} FROM {table} WHERE address = ?", (address.lower(),)
+            ).fetchone()
+            if row is not None and row[0] is not None and time.time() - row[1] > self.negative_ttl:
+                row = None
+            self._count("misses" if row is None else "hits" if row[0] is None else "negative_hits")
+        if row is None:
+            return None
+        return (row[0],) + tuple(row[2:])
+
+    def _put(self, table: str, columns: str, address: str, values: tuple, error: str = None):
+        placeholders = ", ".join("?" * (len(values) + 3))
+        with self._lock:
+            self._connection.execute(
+                f"INSERT OR REPLACE INTO {table} (address, {columns}, error, updated_at) VALUES ({placeholders})",
+                (address.lower(),) + tuple(values) + (error, time.time()),
+            )
+            self._stats["stored" if error is None else "failures_stored"] += 1
+
+    def get_token_info(self, token_address: str):
+        """
+        :return: (error, name, symbol, decimals) or None
+        """
+        return self._get("token_info", "name, symbol, decimals", token_address)
+
+    def put_token_info(self, token_address: str, name: str, symbol: str, decimals):
+        self._put("token_info", "name, symbol, decimals", token_address, (name, symbol, decimals))
+
+    def put_token_info_failure(self, token_address: str, error: str):
+        self._put("token_info", "name, symbol, decimals", token_address, (None, None, None), str(error))
+
+    def get_first_tx_timestamp(self, address: str):
+        """
+        :return: (error, timestamp) or None
+        """
+        return self._get("first_tx", "timestamp", address)
+
+    def put_first_tx_timestamp(self, address: str, timestamp: int):
+        self._put("first_tx", "timestamp", address, (timestamp,))
+
+    def put_first_tx_timestamp_failure(self, address: str, error: str):
+        self._put("first_tx", "timestamp", address, (None,), str(error))
+
+    def _count(self, stat: str):
+        self._stats[stat] += 1
+        self._lookups += 1
+        if self.stats_log_interval > 0 and self._lookups % self.stats_log_interval == 0:
+            logger.info(f"Metadata store: {self._format_stats()}")
+
+    def _format_stats(self) -> str:
+        lookups = max(self._lookups, 1)
+        return f"{self._stats}, hit ratio: {(self._stats['hits'] + self._stats['negative_hits']) / lookups:.1%}"
+
+    def stats(self) -> dict:
+        """
+        this function returns the lookup counters and the number of stored entries
+        :return: stats: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            for table in ("token_info", "first_tx"):
+                stats[f"{table}_entries"] = self._connection.execute(f"SELECT COUNT(*) FROM {table}").fetchone()[0]
+        return stats
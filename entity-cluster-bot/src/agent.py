@@ -1,8 +1,12 @@
 import logging
 import sys
+import threading
 from datetime import datetime, timedelta
 import json
 import base64
+import hashlib
+from collections import OrderedDict, deque
+from functools import partial
 import forta_agent
 import networkx as nx
 import rlp
@@ -10,20 +14,22 @@ from forta_agent import Finding, FindingSeverity, FindingType, get_json_rpc_url
 from hexbytes import HexBytes
 from web3 import Web3
 from bot_alert_rate import calculate_alert_rate, ScanCountType
-import cProfile
-import pstats
 from os import environ
 
 from dotenv import load_dotenv
 load_dotenv()
 
 try:
-    from src.constants import MAX_AGE_IN_DAYS, MAX_NONCE, GRAPH_KEY, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE, TX_SAVE_STEP, HTTP_RPC_TIMEOUT, PROFILING, BOT_ID, PROD_TAG
+    from src.constants import MAX_AGE_IN_DAYS, MAX_NONCE, GRAPH_KEY, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE, TX_SAVE_STEP, HTTP_RPC_TIMEOUT, PROFILING, BOT_ID, PROD_TAG, CLUSTER_QUERY_API_PORT, DIAGRAM_CACHE_SIZE, ENTITY_ADDRESSES_DELTA_MODE, REPORTED_CLUSTERS_CACHE_SIZE, PROFILING_SAMPLE_RATE, PROFILING_WINDOW, PROFILING_REPORT_INTERVAL_SECONDS
     from src.persistance import DynamoPersistance
+    from src.profiler import SamplingProfiler, PhaseTimer, timed
+    from src.cluster_index import ClusterIndex, serve_cluster_index
     from src.storage import get_secrets
 except ModuleNotFoundError:
-    from constants import MAX_AGE_IN_DAYS, MAX_NONCE, GRAPH_KEY, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE, TX_SAVE_STEP, HTTP_RPC_TIMEOUT, PROFILING, BOT_ID, PROD_TAG
+    from constants import MAX_AGE_IN_DAYS, MAX_NONCE, GRAPH_KEY, ONE_WAY_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD, NEW_FUNDED_MAX_NONCE, TX_SAVE_STEP, HTTP_RPC_TIMEOUT, PROFILING, BOT_ID, PROD_TAG, CLUSTER_QUERY_API_PORT, DIAGRAM_CACHE_SIZE, ENTITY_ADDRESSES_DELTA_MODE, REPORTED_CLUSTERS_CACHE_SIZE, PROFILING_SAMPLE_RATE, PROFILING_WINDOW, PROFILING_REPORT_INTERVAL_SECONDS
     from persistance import DynamoPersistance
+    from profiler import SamplingProfiler, PhaseTimer, timed
+    from cluster_index import ClusterIndex, serve_cluster_index
     from storage import get_secrets
 
 
@@ -54,12 +60,27 @@ handler.addFilter(ContextFilter())
 class EntityClusterAgent:
 
     GRAPH = nx.DiGraph()
+    # nodes and edges changed since the last save, swapped out and handed to the persist thread on each save
+    delta_graph = nx.DiGraph()
     persistance: DynamoPersistance = None
+    cluster_index: ClusterIndex = None
+    profiler: SamplingProfiler = None
+    phase_timer: PhaseTimer = None
     tx_counter = 0
     tx_save_step = 1
     contract_cache =[]
+    # membership hash -> rendered diagram, so an unchanged cluster is not serialized again
+    diagram_cache: OrderedDict = None
+    # cluster id -> members in the last finding, used to only report the new members in ENTITY_ADDRESSES_DELTA_MODE
+    reported_clusters: OrderedDict = None
     previous_shared_graphs = []
     chain_id = None
+    # (save number, delta) handed to the persist thread and not known to be in the shared graph yet
+    unpersisted_deltas: deque = None
+    save_count = 0
+    # (save number, index, shared graph) built by the persist thread, swapped in by the handler thread
+    pending_cluster_index: tuple = None
+    pending_cluster_index_lock: threading.Lock = None
 
 
     def __init__(self, a_persistance: DynamoPersistance, tx_save_step = 1, chain_id = 1):
@@ -76,6 +97,15 @@ class EntityClusterAgent:
         logging.info(f"Run initialize chain: {self.chain_id}")
         self.tx_save_step = tx_save_step
         self.GRAPH = nx.DiGraph()
+        self.delta_graph = nx.DiGraph()
+        self.diagram_cache = OrderedDict()
+        self.reported_clusters = OrderedDict()
+        self.phase_timer = PhaseTimer(PROFILING_WINDOW, PROFILING_REPORT_INTERVAL_SECONDS)
+        self.profiler = SamplingProfiler(PROFILING_SAMPLE_RATE, PROFILING_WINDOW, PROFILING_REPORT_INTERVAL_SECONDS, 'entity_cluster_prof_stats', 'entity_cluster_prof_collapsed.txt')
+        self.cluster_index = ClusterIndex()
+        self.cluster_index.rebuild([self.persistance.graph_cache])
+        self.unpersisted_deltas = deque()
+        self.pending_cluster_index_lock = threading.Lock()
         environ["ZETTABLOCK_API_KEY"] = ZETTABLOCK_KEY
         
 
@@ -83,6 +113,7 @@ class EntityClusterAgent:
     def load(self, key: str) -> object:
         return self.persistance.load(key)
 
+    @timed("graph_update")
     def add_address(self, address):
         if address is None:
             return
@@ -91,13 +122,16 @@ class EntityClusterAgent:
             return
 
         checksum_address = Web3.toChecksumAddress(address)
+        self.delta_graph.add_node(checksum_address, last_seen=datetime.now())
         if checksum_address in self.GRAPH.nodes:
             self.GRAPH.nodes[checksum_address]["last_seen"] = datetime.now()
             logging.info(f"Updated address {checksum_address} last_seen in graph. Graph size is still {len(self.GRAPH.nodes)}")
         else:
             self.GRAPH.add_node(checksum_address, last_seen=datetime.now())
+            self.cluster_index.add_address(checksum_address)
             logging.info(f"Added address {checksum_address} to graph. Graph size is now {len(self.GRAPH.nodes)}")
 
+    @timed("rpc")
     def is_address_belong_max_transactions(self, w3, address):
         if address is None:
             return False
@@ -124,14 +158,24 @@ class EntityClusterAgent:
             logging.info(f"Removed address {node} from graph. Graph size is now {len(a_graph.nodes)}")
 
 
+    @timed("graph_update")
     def add_directed_edge(self, w3, from_, to):
 
         if from_ is None or to is None:
             return
 
-        if Web3.toChecksumAddress(from_) in self.GRAPH.nodes and Web3.toChecksumAddress(to) in self.GRAPH.nodes:
-            self.GRAPH.add_edges_from([(Web3.toChecksumAddress(from_), Web3.toChecksumAddress(to))])
+        checksum_from = Web3.toChecksumAddress(from_)
+        checksum_to = Web3.toChecksumAddress(to)
+        if checksum_from in self.GRAPH.nodes and checksum_to in self.GRAPH.nodes:
+            self.GRAPH.add_edges_from([(checksum_from, checksum_to)])
+            for checksum_address in (checksum_from, checksum_to):
+                if checksum_address not in self.delta_graph.nodes:
+                    self.delta_graph.add_node(checksum_address, last_seen=self.GRAPH.nodes[checksum_address]["last_seen"])
+            self.delta_graph.add_edges_from([(checksum_from, checksum_to)])
             logging.info(f"Added edge from address {from_} to {to}.")
+            # only bidirectional edges make a cluster, see filter_edge
+            if self.GRAPH.has_edge(checksum_to, checksum_from) or self.persistance.graph_cache.has_edge(checksum_to, checksum_from):
+                self.cluster_index.add_bidirectional_edge(checksum_from, checksum_to)
 
 
     def calc_contract_address(self, address, nonce) -> str:
@@ -144,6 +188,7 @@ class EntityClusterAgent:
         return Web3.toChecksumAddress(Web3.keccak(rlp.encode([address_bytes, nonce]))[-20:]).lower()
 
 
+    @timed("rpc")
     def is_contract(self, w3, address) -> bool:
         """
         this function determines whether address is a contract
@@ -168,9 +213,11 @@ class EntityClusterAgent:
 
     def cluster_entities(self, w3, transaction_event) -> list:
         findings = []
+        self.swap_cluster_index_if_pending()
         if (transaction_event.transaction.to is None) or (transaction_event.transaction.value > 0) or (transaction_event.filter_log(ERC20_TRANSFER_EVENT)):
 
-            EntityClusterAgent.prune_graph(self.GRAPH)
+            with self.phase_timer.time("prune"):
+                EntityClusterAgent.prune_graph(self.GRAPH)
 
             #  add edges for each native transfer
             if transaction_event.transaction.value > 0:
@@ -202,7 +249,9 @@ class EntityClusterAgent:
             # For perfomance it check first the threshould, then if contract that could be cached, the NEW_FUNDED_MAX_NONCE and then it won't check MAX_NONCE as we assume that always NEW_FUNDED_MAX_NONCE <= MAX_NONCE
             if transaction_event.transaction.value < NEW_FUNDED_MAX_WEI_TRANSFER_THRESHOLD:
                 if not self.is_contract(w3, transaction_event.transaction.to) and not self.is_contract(w3, transaction_event.transaction.from_):
-                    if w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.from_), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE and w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.to), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE:
+                    with self.phase_timer.time("rpc"):
+                        is_new_funded = w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.from_), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE and w3.eth.get_transaction_count(Web3.toChecksumAddress(transaction_event.transaction.to), transaction_event.block.number) <= NEW_FUNDED_MAX_NONCE
+                    if is_new_funded:
                         if self.is_address_belong_max_transactions(w3, transaction_event.transaction.from_) and self.is_address_belong_max_transactions(w3, transaction_event.transaction.to):
                             logging.info(f"Observing small native transfer of value {transaction_event.transaction.value} from new EOA {transaction_event.transaction.from_} to new EOA {transaction_event.transaction.to}")
                             self.add_address(transaction_event.transaction.from_)
@@ -260,6 +309,7 @@ class EntityClusterAgent:
             return False
         return f
 
+    @timed("ego_cluster")
     def create_finding(self, from_, message) -> Finding:
         shared_graph = self.persistance.graph_cache
         # Add all nodes and all edges to the shared cached graph to have a updated graph with the delta + shared
@@ -287,17 +337,13 @@ class EntityClusterAgent:
         nodes = list(ego_g.nodes)
         n_nodes = len(nodes)
 
+        #  find the connected component that contains the from_ address
+        if checksum_addr not in nodes or n_nodes <= 1:
+            return None
+
         diagram = "Too big or small for a diagram"
         if 8 <= n_nodes and n_nodes <= 16:
-            try:
-                ego_for_json = ego_g.copy()
-                for n in ego_for_json:
-                    ego_for_json.nodes[n]["name"] = n
-                    ego_for_json.nodes[n]['last_seen'] = str(ego_for_json.nodes[n]['last_seen'])
-                link_data = nx.json_graph.node_link_data(ego_for_json)
-                diagram = base64.b64encode(json.dumps(link_data).encode()).decode()
-            except Exception as e:
-                diagram = f"There was an error creating the diagram: {e}"
+            diagram = self.render_diagram(ego_g, EntityClusterAgent.get_membership_hash(nodes))
 
         alert_id = 'ENTITY-CLUSTER'
         anomality_score = 0
@@ -311,48 +357,119 @@ class EntityClusterAgent:
         except Exception as e:
             logging.error(f"Error doing calculate_alert_rate  {e}, default to {anomality_score}")
 
-        #  find the connected component that contains the from_ address
-        if checksum_addr in nodes and n_nodes > 1:
-            return Finding(
-                {
-                    "name": "Entity identified",
-                    "description": f"Entity of size {n_nodes} has been identified. Transaction from {from_} created this entity. {message}",
-                    "alert_id": alert_id,
-                    "type": FindingType.Info,
-                    "severity": FindingSeverity.Info,
-                    "metadata": {
-                        "entity_addresses": nodes,
-                        "diagram": diagram,
-                        "anomaly_score": anomality_score
-                    }
-                }
-            )
+        # same definition as the cluster index, the lowest address of the cluster
+        cluster_id = min(node.lower() for node in nodes)
+        metadata = {}
+        previous_members = self.reported_clusters.get(cluster_id) if ENTITY_ADDRESSES_DELTA_MODE else None
+        if previous_members is not None and previous_members.issubset(nodes):
+            metadata["entity_addresses_added"] = [node for node in nodes if node not in previous_members]
+            metadata["entity_size"] = n_nodes
+        else:
+            metadata["entity_addresses"] = nodes
+        metadata["diagram"] = diagram
+        metadata["anomaly_score"] = anomality_score
+        metadata["cluster_id"] = cluster_id
+
+        if ENTITY_ADDRESSES_DELTA_MODE:
+            self.reported_clusters[cluster_id] = frozenset(nodes)
+            self.reported_clusters.move_to_end(cluster_id)
+            if len(self.reported_clusters) > REPORTED_CLUSTERS_CACHE_SIZE:
+                self.reported_clusters.popitem(last=False)
+
+        return Finding(
+            {
+                "name": "Entity identified",
+                "description": f"Entity of size {n_nodes} has been identified. Transaction from {from_} created this entity. {message}",
+                "alert_id": alert_id,
+                "type": FindingType.Info,
+                "severity": FindingSeverity.Info,
+                "metadata": metadata
+            }
+        )
+
+    def get_membership_hash(nodes) -> str:
+        return hashlib.sha256(",".join(sorted(nodes)).encode()).hexdigest()
+
+    def render_diagram(self, ego_g, membership_hash) -> str:
+        """
+        this function serializes the cluster to base64 node-link json for the viewer, cached by membership hash and edge count
+        :return: diagram: str
+        """
+        # the edges among the same members are only ever added, so their count tells if the diagram changed.
+        # last_seen is not in the diagram, as it changes on every transaction of a member
+        diagram_key = (membership_hash, ego_g.number_of_edges())
+        if diagram_key in self.diagram_cache:
+            self.diagram_cache.move_to_end(diagram_key)
+            return self.diagram_cache[diagram_key]
+
+        try:
+            # same layout as nx.json_graph.node_link_data, without copying the ego graph
+            link_data = {
+                "directed": True,
+                "multigraph": False,
+                "graph": {},
+                "nodes": [{"name": n, "id": n} for n in ego_g.nodes],
+                "links": [{"source": n1, "target": n2} for n1, n2 in ego_g.edges]
+            }
+            diagram = base64.b64encode(json.dumps(link_data).encode()).decode()
+        except Exception as e:
+            return f"There was an error creating the diagram: {e}"
+
+        self.diagram_cache[diagram_key] = diagram
+        if len(self.diagram_cache) > DIAGRAM_CACHE_SIZE:
+            self.diagram_cache.popitem(last=False)
+        return diagram
 
 
 
     def provide_handle_transaction(self, w3, transaction_event):
-        # to save stats of a transaction processing, can be seen with viewers that help a lot to see where the time is being spent.
+        # samples 1 in PROFILING_SAMPLE_RATE transactions and dumps the merged stats of the last PROFILING_WINDOW samples every PROFILING_REPORT_INTERVAL_SECONDS,
+        # can be seen with viewers that help a lot to see where the time is being spent.
         if PROFILING:
-            with cProfile.Profile() as profile:
-                f = self.cluster_entities(w3, transaction_event)
-            
-            with open('profiling_stats.txt', 'w') as stream:
-                stats = pstats.Stats(profile, stream=stream)
-                stats.strip_dirs()
-                stats.sort_stats('time')
-                stats.dump_stats('entity_cluster_prof_stats')
-                stats.print_stats()
-            return f
+            findings = self.profiler.profile(self.cluster_entities, w3, transaction_event)
         else:
-            return self.cluster_entities(w3, transaction_event)
+            findings = self.cluster_entities(w3, transaction_event)
+        self.phase_timer.maybe_report()
+        return findings
 
 
     def real_handle_transaction(self, transaction_event):
         return self.provide_handle_transaction(web3, transaction_event)
 
+    @timed("persist")
     def persist_state(self):
-        self.persistance.persist(self.GRAPH, GRAPH_KEY, EntityClusterAgent.prune_graph)
+        # double buffer: the handler only swaps the delta graph, the persist thread owns the swapped out one from now on.
+        # If the persist queue is full the delta is kept and will go with the next save
+        self.save_count += 1
+        if self.persistance.persist_async(self.delta_graph, GRAPH_KEY, EntityClusterAgent.prune_graph, partial(self.on_shared_graph_persisted, save=self.save_count)):
+            self.unpersisted_deltas.append((self.save_count, self.delta_graph))
+            self.delta_graph = nx.DiGraph()
+
+    def on_shared_graph_persisted(self, shared_graph, save):
+        # the shared graph was reloaded and pruned, so clusters may have been merged by other instances or split by aged out addresses.
+        # Runs on the persist thread before the shared graph is published, so the O(E) build stays off the handler thread.
+        # Saves are persisted in order and a failed one goes with the next, so the shared graph has all the deltas up to this save
+        fresh = ClusterIndex.build([shared_graph])
+        with self.pending_cluster_index_lock:
+            self.pending_cluster_index = (save, fresh, shared_graph)
+
+    @timed("cluster_index")
+    def swap_cluster_index_if_pending(self):
+        # on the handler thread, the only one modifying the local graphs: replays the deltas the shared graph does not have yet
+        # into the index built by the persist thread and swaps it in, in O(delta)
+        with self.pending_cluster_index_lock:
+            pending, self.pending_cluster_index = self.pending_cluster_index, None
+        if pending is None:
+            return
+        save, fresh, shared_graph = pending
+        while self.unpersisted_deltas and self.unpersisted_deltas[0][0] <= save:
+            self.unpersisted_deltas.popleft()
+        for delta in [a_delta for _, a_delta in self.unpersisted_deltas] + [self.delta_graph]:
+            fresh.add_graph(delta, [shared_graph, self.GRAPH])
+        self.cluster_index.swap(fresh)
 
 entity_cluster_agent =  EntityClusterAgent(DynamoPersistance(PROD_TAG, web3.eth.chain_id), TX_SAVE_STEP, web3.eth.chain_id)
+if CLUSTER_QUERY_API_PORT:
+    serve_cluster_index(entity_cluster_agent.cluster_index, CLUSTER_QUERY_API_PORT)
 def handle_transaction(transaction_event: forta_agent.transaction_event.TransactionEvent) -> list:
     return entity_cluster_agent.real_handle_transaction(transaction_event)
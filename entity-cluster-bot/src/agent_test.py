@@ -58,13 +58,37 @@ class TestEntityClusterBot:
 
         agent.add_address(EOA_ADDRESS_SMALL_TX)
         agent.persist_state()
+        agent.persistance.flush()
 
         agent.add_address(EOA_ADDRESS_NEW)
         agent.persist_state()
+        assert len(agent.delta_graph.nodes) == 0, "Delta graph should have been handed over to the persist thread"
+        agent.persistance.flush()
 
         assert len(agent.GRAPH.nodes) == 2, "Addresses should have been added to graph. Its nonce is within range"
+        assert agent.persistance.persist_stats["persist_count"] == 2, "Both saves should have been persisted"
+        assert len(agent.persistance.graph_cache.nodes) == 2, "Shared graph should contain both deltas"
 
 
+    def test_persist_concurrent_writers(self):
+        TestEntityClusterBot.remove_persistent_state()
+        persistance_a = DynamoPersistance()
+        persistance_b = DynamoPersistance()
+        delta_a = nx.DiGraph()
+        delta_a.add_node(EOA_ADDRESS_NEW, last_seen=datetime.now())
+        delta_b = nx.DiGraph()
+        delta_b.add_node(EOA_ADDRESS_OLD, last_seen=datetime.now())
+
+        # both saves are queued at the same time, the loser has to merge into the winner's graph
+        persistance_a.persist_async(delta_a, GRAPH_KEY, EntityClusterAgent.prune_graph)
+        persistance_b.persist_async(delta_b, GRAPH_KEY, EntityClusterAgent.prune_graph)
+        persistance_a.flush()
+        persistance_b.flush()
+
+        shared_graph, version = DynamoPersistance().load_with_version(GRAPH_KEY)
+        assert version == 2, "Each save should bump the shared graph version"
+        assert EOA_ADDRESS_NEW in shared_graph.nodes and EOA_ADDRESS_OLD in shared_graph.nodes, "No save should be lost"
+
     def test_add_directed_edges_without_add(self):
         agent = EntityClusterAgent(DynamoPersistance())
 
@@ -96,6 +120,83 @@ class TestEntityClusterBot:
         filtered_graph = nx.subgraph_view(agent.GRAPH, filter_edge=EntityClusterAgent.filter_edge(agent.GRAPH))
         assert len(filtered_graph.edges) == 2, "Edges should not have been filtered out"
 
+    def test_cluster_index_swapped_after_persist(self):
+        TestEntityClusterBot.remove_persistent_state()
+        agent = EntityClusterAgent(DynamoPersistance())
+
+        agent.add_address(EOA_ADDRESS_NEW)
+        agent.add_address(EOA_ADDRESS_OLD)
+        agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        agent.persist_state()
+        agent.persistance.flush()
+        assert agent.pending_cluster_index is not None, "The persist thread should have built the new index"
+
+        # added after the save, so only in the local graphs
+        agent.add_directed_edge(w3, EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+        agent.swap_cluster_index_if_pending()
+
+        assert agent.pending_cluster_index is None
+        assert len(agent.unpersisted_deltas) == 0, "The persisted delta should not be replayed again"
+        assert agent.cluster_index.get_cluster_size(EOA_ADDRESS_NEW) == 2, "The local delta should have been replayed into the new index"
+
+    def test_finding_diagram_cached(self):
+        TestEntityClusterBot.remove_persistent_state()
+        agent = EntityClusterAgent(DynamoPersistance())
+        addresses = [Web3.toChecksumAddress(f"0x{i:040x}") for i in range(1, 9)]
+        for address in addresses:
+            agent.GRAPH.add_node(address, last_seen=datetime.now())
+        for address in addresses[1:]:
+            agent.GRAPH.add_edges_from([(addresses[0], address), (address, addresses[0])])
+
+        finding1 = agent.create_finding(addresses[0], "test")
+        finding2 = agent.create_finding(addresses[1], "test")
+
+        assert finding1.metadata["diagram"] == finding2.metadata["diagram"], "Same cluster should have the same diagram"
+        assert len(agent.diagram_cache) == 1, "Unchanged cluster should only be rendered once"
+        assert finding1.metadata["cluster_id"] == addresses[0].lower(), "Cluster id should be the lowest address"
+
+    def test_finding_diagram_cached_across_transactions(self):
+        TestEntityClusterBot.remove_persistent_state()
+        agent = EntityClusterAgent(DynamoPersistance())
+        addresses = [Web3.toChecksumAddress(f"0x{i:040x}") for i in range(1, 9)]
+        for address in addresses:
+            agent.add_address(address)
+        for address in addresses[1:]:
+            agent.GRAPH.add_edges_from([(addresses[0], address), (address, addresses[0])])
+
+        finding1 = agent.create_finding(addresses[0], "test")
+        # a new transaction of a member updates its last_seen
+        agent.add_address(addresses[0])
+        finding2 = agent.create_finding(addresses[0], "test")
+        assert finding2.metadata["diagram"] == finding1.metadata["diagram"]
+        assert len(agent.diagram_cache) == 1, "A new transaction of a member should not render the diagram again"
+
+        agent.GRAPH.add_edges_from([(addresses[1], addresses[2]), (addresses[2], addresses[1])])
+        finding3 = agent.create_finding(addresses[0], "test")
+        assert finding3.metadata["diagram"] != finding1.metadata["diagram"], "New edges should render a new diagram"
+        assert len(agent.diagram_cache) == 2
+
+    def test_finding_delta_mode(self, monkeypatch):
+        TestEntityClusterBot.remove_persistent_state()
+        monkeypatch.setattr("agent.ENTITY_ADDRESSES_DELTA_MODE", True)
+        agent = EntityClusterAgent(DynamoPersistance())
+        agent.add_address(EOA_ADDRESS_NEW)
+        agent.add_address(EOA_ADDRESS_OLD)
+        agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        agent.add_directed_edge(w3, EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+
+        finding = agent.create_finding(EOA_ADDRESS_NEW, "test")
+        assert len(finding.metadata["entity_addresses"]) == 2, "First finding of a cluster should have all the addresses"
+
+        agent.add_address(EOA_ADDRESS_SMALL_TX)
+        agent.add_directed_edge(w3, EOA_ADDRESS_NEW, EOA_ADDRESS_SMALL_TX)
+        agent.add_directed_edge(w3, EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_NEW)
+
+        finding = agent.create_finding(EOA_ADDRESS_NEW, "test")
+        assert "entity_addresses" not in finding.metadata, "Known cluster should only report the new addresses"
+        assert finding.metadata["entity_addresses_added"] == [EOA_ADDRESS_SMALL_TX]
+        assert finding.metadata["entity_size"] == 3
+
     def test_finding_bidirectional(self):
         TestEntityClusterBot.remove_persistent_state()
         agent = EntityClusterAgent(DynamoPersistance())
@@ -533,6 +634,7 @@ class TestEntityClusterBot:
         
         agent1b = EntityClusterAgent(DynamoPersistance())   
         agent1b.cluster_entities(real_w3, native_transfer1)
+        agent1b.persistance.flush()
         agent1a = EntityClusterAgent(DynamoPersistance())
         findings = agent1a.cluster_entities(real_w3, native_transfer1)
         assert len(findings) == 0, "No findings should be returned as it is not bidirectional"
@@ -557,6 +659,7 @@ class TestEntityClusterBot:
         
         agent2b = EntityClusterAgent(DynamoPersistance())
         agent2b.cluster_entities(real_w3, native_transfer2)
+        agent2b.persistance.flush()
         agent2a = EntityClusterAgent(DynamoPersistance())
         findings = agent2a.cluster_entities(real_w3, native_transfer2)
         assert len(findings) == 1, "Finding should be returned as it is bidirectional"
@@ -591,6 +694,7 @@ class TestEntityClusterBot:
 
         findings = agent1.cluster_entities(real_w3, native_transfer1)
         assert len(findings) == 0, "No findings should be returned as it is not bidirectional"
+        agent1.persistance.flush()
         native_transfer2 = create_transaction_event({
 
                 'transaction': {
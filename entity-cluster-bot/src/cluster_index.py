@@ -0,0 +1,196 @@
+import json
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+from web3 import Web3
+
+
+class ClusterIndex:
+    """
+    Maintains the connected components of the entity graph (only bidirectional edges count, same as the ego graph used in findings)
+    with a union-find structure, so consumers can ask for the cluster of an address without rebuilding it from alerts.
+    The cluster id is the lowest lowercased address in the cluster, so it is deterministic for a given membership.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._parent = {}
+        self._members = {}
+        self._cluster_id = {}
+
+    def _find(self, address):
+        root = address
+        while self._parent[root] != root:
+            root = self._parent[root]
+        # path compression
+        while self._parent[address] != root:
+            self._parent[address], address = root, self._parent[address]
+        return root
+
+    def _add_node(self, address):
+        if address not in self._parent:
+            self._parent[address] = address
+            self._members[address] = {address}
+            self._cluster_id[address] = address.lower()
+
+    def _union(self, address_a, address_b):
+        root_a = self._find(address_a)
+        root_b = self._find(address_b)
+        if root_a == root_b:
+            return
+        # merge the smaller component into the bigger one
+        if len(self._members[root_a]) < len(self._members[root_b]):
+            root_a, root_b = root_b, root_a
+        self._parent[root_b] = root_a
+        self._members[root_a].update(self._members.pop(root_b))
+        self._cluster_id[root_a] = min(self._cluster_id[root_a], self._cluster_id.pop(root_b))
+
+    def add_address(self, address):
+        with self._lock:
+            self._add_node(Web3.toChecksumAddress(address))
+
+    def add_bidirectional_edge(self, from_, to):
+        with self._lock:
+            checksum_from = Web3.toChecksumAddress(from_)
+            checksum_to = Web3.toChecksumAddress(to)
+            self._add_node(checksum_from)
+            self._add_node(checksum_to)
+            self._union(checksum_from, checksum_to)
+
+    @classmethod
+    def build(cls, graphs: list) -> "ClusterIndex":
+        """
+        builds a new index from the union of the graphs, an edge counts if its reverse exists in any of them.
+        Nobody else sees the new index yet, so this can run on any thread while the current index keeps serving queries.
+        The graphs must not be modified during the build.
+        :param graphs: list of networkx DiGraph
+        :return: the new index
+        """
+        fresh = cls()
+        for graph in graphs:
+            fresh.add_graph(graph, graphs)
+        return fresh
+
+    def add_graph(self, graph, graphs: list):
+        """
+        adds the addresses and the bidirectional edges of a graph to the index
+        :param graph: networkx DiGraph to add
+        :param graphs: list of networkx DiGraph, an edge of graph counts if its reverse exists in any of them
+        """
+        with self._lock:
+            for node in graph.nodes:
+                self._add_node(node)
+            for (from_, to) in graph.edges:
+                if any(a_graph.has_edge(to, from_) for a_graph in graphs):
+                    self._union(from_, to)
+
+    def swap(self, fresh: "ClusterIndex"):
+        """
+        replaces the content of this index with the one of another index, in O(1) so queries are not blocked.
+        The other index must not be used afterwards.
+        :param fresh: the index to take over
+        """
+        with self._lock:
+            self._parent, self._members, self._cluster_id = fresh._parent, fresh._members, fresh._cluster_id
+        logging.info(f"Swapped in cluster index with {len(fresh._parent)} addresses in {len(fresh._members)} clusters")
+
+    def rebuild(self, graphs: list):
+        """
+        rebuilds the index from scratch, see build. The new index is built without holding the lock and swapped in at the end.
+        :param graphs: list of networkx DiGraph
+        """
+        self.swap(ClusterIndex.build(graphs))
+
+    def get_cluster_id(self, address) -> str:
+        with self._lock:
+            checksum_address = Web3.toChecksumAddress(address)
+            if checksum_address not in self._parent:
+                return None
+            return self._cluster_id[self._find(checksum_address)]
+
+    def get_cluster_members(self, address) -> list:
+        with self._lock:
+            checksum_address = Web3.toChecksumAddress(address)
+            if checksum_address not in self._parent:
+                return []
+            return list(self._members[self._find(checksum_address)])
+
+    def get_cluster_size(self, address) -> int:
+        with self._lock:
+            checksum_address = Web3.toChecksumAddress(address)
+            if checksum_address not in self._parent:
+                return 0
+            return len(self._members[self._find(checksum_address)])
+
+    def lookup(self, addresses: list) -> dict:
+        """
+        bulk lookup of the cluster of each address
+        :return: dict address -> {cluster_id, size}; addresses not in the graph map to None
+        """
+        result = {}
+        with self._lock:
+            for address in addresses:
+                checksum_address = Web3.toChecksumAddress(address)
+                if checksum_address not in self._parent:
+                    result[address] = None
+                    continue
+                root = self._find(checksum_address)
+                result[address] = {"cluster_id": self._cluster_id[root], "size": len(self._members[root])}
+        return result
+
+
+def serve_cluster_index(index: ClusterIndex, port: int, host: str = "127.0.0.1") -> ThreadingHTTPServer:
+    """
+    starts a small local http service on a daemon thread to query the cluster index
+      GET  /cluster?address=0x..  -> {"address", "cluster_id", "size", "members"}
+      POST /clusters  ["0x..", ...] -> {address: {"cluster_id", "size"} | null}
+    """
+
+    class ClusterQueryHandler(BaseHTTPRequestHandler):
+
+        def _send_json(self, status, body):
+            payload = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            addresses = parse_qs(url.query).get("address")
+            if url.path != "/cluster" or not addresses:
+                self._send_json(404, {"error": "use /cluster?address=<address>"})
+                return
+            try:
+                address = addresses[0]
+                self._send_json(200, {
+                    "address": address,
+                    "cluster_id": index.get_cluster_id(address),
+                    "size": index.get_cluster_size(address),
+                    "members": index.get_cluster_members(address)
+                })
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+
+        def do_POST(self):
+            if urlparse(self.path).path != "/clusters":
+                self._send_json(404, {"error": "use POST /clusters with a json list of addresses"})
+                return
+            try:
+                length = int(self.headers.get("Content-Length", 0))
+                addresses = json.loads(self.rfile.read(length))
+                self._send_json(200, index.lookup(addresses))
+            except (ValueError, TypeError) as e:
+                self._send_json(400, {"error": str(e)})
+
+        def log_message(self, format, *args):
+            logging.debug(f"cluster query api: {format % args}")
+
+    server = ThreadingHTTPServer((host, port), ClusterQueryHandler)
+    thread = threading.Thread(target=server.serve_forever, name="cluster-query-api", daemon=True)
+    thread.start()
+    logging.info(f"Cluster query api listening on {host}:{port}")
+    return server
@@ -0,0 +1,99 @@
+import json
+import urllib.request
+from datetime import datetime
+
+import networkx as nx
+
+from cluster_index import ClusterIndex, serve_cluster_index
+from web3_mock import EOA_ADDRESS_NEW, EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX
+
+
+class TestClusterIndex:
+
+    def test_one_directional_edge_is_not_a_cluster(self):
+        graph = nx.DiGraph()
+        graph.add_node(EOA_ADDRESS_NEW, last_seen=datetime.now())
+        graph.add_node(EOA_ADDRESS_OLD, last_seen=datetime.now())
+        graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+
+        index = ClusterIndex()
+        index.rebuild([graph])
+
+        assert index.get_cluster_size(EOA_ADDRESS_NEW) == 1, "one directional edges should be filtered out"
+        assert index.get_cluster_id(EOA_ADDRESS_NEW) != index.get_cluster_id(EOA_ADDRESS_OLD)
+
+    def test_rebuild_across_graphs(self):
+        shared_graph = nx.DiGraph()
+        shared_graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        delta_graph = nx.DiGraph()
+        delta_graph.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+
+        index = ClusterIndex()
+        index.rebuild([shared_graph, delta_graph])
+
+        assert index.get_cluster_size(EOA_ADDRESS_OLD) == 2, "reverse edge in other graph should make a cluster"
+        assert set(index.get_cluster_members(EOA_ADDRESS_NEW)) == {EOA_ADDRESS_NEW, EOA_ADDRESS_OLD}
+
+    def test_rebuild_replaces_index(self):
+        index = ClusterIndex()
+        index.add_bidirectional_edge(EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX)
+        graph = nx.DiGraph()
+        graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        graph.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+
+        index.rebuild([graph])
+
+        assert index.get_cluster_size(EOA_ADDRESS_NEW) == 2
+        assert index.get_cluster_id(EOA_ADDRESS_SMALL_TX) is None, "addresses not in the graphs should be dropped"
+
+    def test_build_and_swap(self):
+        index = ClusterIndex()
+        index.add_bidirectional_edge(EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX)
+        shared_graph = nx.DiGraph()
+        shared_graph.add_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        local_delta = nx.DiGraph()
+        local_delta.add_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_NEW)
+
+        fresh = ClusterIndex.build([shared_graph])
+        assert index.get_cluster_size(EOA_ADDRESS_SMALL_TX) == 2, "building a new index should not touch the current one"
+        fresh.add_graph(local_delta, [shared_graph, local_delta])
+        index.swap(fresh)
+
+        assert index.get_cluster_size(EOA_ADDRESS_NEW) == 2, "the replayed delta should complete the bidirectional edge"
+        assert index.get_cluster_id(EOA_ADDRESS_SMALL_TX) is None, "the swapped in index replaces the old one"
+
+    def test_merge_clusters(self):
+        index = ClusterIndex()
+        index.add_bidirectional_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        index.add_bidirectional_edge(EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX)
+        assert index.get_cluster_size(EOA_ADDRESS_NEW) == 2
+
+        index.add_bidirectional_edge(EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX.lower())
+
+        assert index.get_cluster_size(EOA_ADDRESS_LARGE_TX) == 4
+        expected_id = min(a.lower() for a in [EOA_ADDRESS_NEW, EOA_ADDRESS_OLD, EOA_ADDRESS_SMALL_TX, EOA_ADDRESS_LARGE_TX])
+        assert index.get_cluster_id(EOA_ADDRESS_NEW) == expected_id, "cluster id should be the lowest address"
+
+    def test_bulk_lookup(self):
+        index = ClusterIndex()
+        index.add_bidirectional_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+
+        result = index.lookup([EOA_ADDRESS_NEW, EOA_ADDRESS_SMALL_TX])
+
+        assert result[EOA_ADDRESS_NEW]["size"] == 2
+        assert result[EOA_ADDRESS_SMALL_TX] is None, "unknown address should not have a cluster"
+
+    def test_query_api(self):
+        index = ClusterIndex()
+        index.add_bidirectional_edge(EOA_ADDRESS_NEW, EOA_ADDRESS_OLD)
+        server = serve_cluster_index(index, 0)
+        try:
+            port = server.server_address[1]
+            with urllib.request.urlopen(f"http://127.0.0.1:{port}/cluster?address={EOA_ADDRESS_NEW}") as response:
+                assert json.loads(response.read())["size"] == 2
+
+            request = urllib.request.Request(f"http://127.0.0.1:{port}/clusters", data=json.dumps([EOA_ADDRESS_OLD]).encode(), method="POST")
+            with urllib.request.urlopen(request) as response:
+                assert json.loads(response.read())[EOA_ADDRESS_OLD]["cluster_id"] == index.get_cluster_id(EOA_ADDRESS_NEW)
+        finally:
+            server.shutdown()
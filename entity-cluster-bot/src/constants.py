@@ -20,13 +20,28 @@ DYNAMODB_PRIMARY_KEY = 'itemId'
 DYNAMODB_SORT_KEY = 'sortKey'
 DYNAMODB_TTL_KEY = 'expiresAt'
 
-# if True  it will profile every transaction and dump it to entity_cluster_prof_stats file so can be viewed with snakeviz
+# if True  it will profile 1 in PROFILING_SAMPLE_RATE transactions and dump the merged stats of the last PROFILING_WINDOW samples
+# to entity_cluster_prof_stats file (can be viewed with snakeviz) and entity_cluster_prof_collapsed.txt (flame graph) every PROFILING_REPORT_INTERVAL_SECONDS
 PROFILING = False
+PROFILING_SAMPLE_RATE = 100
+# also the number of durations per phase (prune, rpc, graph_update, ego_cluster, persist) whose percentiles are logged
+PROFILING_WINDOW = 1000
+PROFILING_REPORT_INTERVAL_SECONDS = 600
 
 # How many Transaction to wait before saving. configured as 6 blocks of ethereum
 TX_SAVE_STEP = 150*6
 # Timeout for w3 calls in seconds 
 HTTP_RPC_TIMEOUT = 2
-# timeout of the lock in the mutex db 10s
-MUTEX_TIMEOUT_MILLIS=10*10000
+# How many rendered diagrams to keep, keyed by the cluster membership hash
+DIAGRAM_CACHE_SIZE = 1000
+# if True  findings of an already reported cluster only contain the new members (entity_addresses_added) instead of the full entity_addresses list
+ENTITY_ADDRESSES_DELTA_MODE = False
+# How many reported clusters to remember for ENTITY_ADDRESSES_DELTA_MODE
+REPORTED_CLUSTERS_CACHE_SIZE = 10000
+# Local port of the cluster query api (cluster id, members and size per address), None to disable it
+CLUSTER_QUERY_API_PORT = None
+# How many times a save is retried when another instance updated the shared graph at the same time
+PERSIST_MAX_RETRIES = 5
+# Saves waiting for the background persist thread, further saves are skipped as the delta graph is cumulative
+PERSIST_QUEUE_SIZE = 1
 
@@ -4,20 +4,21 @@ import sys
 from datetime import datetime
 import bz2
 import networkx as nx
+import queue
+import threading
 import time
 import boto3
-from boto3.dynamodb.conditions import Key
+import botocore
+from boto3.dynamodb.conditions import Attr, Key
 import random
 import string
 
 
 try:
-    from src.constants import  GRAPH_KEY, TEST_TAG, S3_BUCKET, MUTEX_TIMEOUT_MILLIS, S3_REGION, DYNAMO_REGION, DYNAMODB_PRIMARY_KEY, DYNAMODB_SORT_KEY, BOT_ID, DYNAMO_TABLE
-    from src.dyndbmutex import DynamoDbMutex
+    from src.constants import  GRAPH_KEY, TEST_TAG, S3_BUCKET, PERSIST_MAX_RETRIES, PERSIST_QUEUE_SIZE, S3_REGION, DYNAMO_REGION, DYNAMODB_PRIMARY_KEY, DYNAMODB_SORT_KEY, BOT_ID, DYNAMO_TABLE
     from src.storage import get_secrets
 except ModuleNotFoundError:
-    from constants import  GRAPH_KEY, TEST_TAG, S3_BUCKET, MUTEX_TIMEOUT_MILLIS, S3_REGION, DYNAMO_REGION, DYNAMODB_PRIMARY_KEY, DYNAMODB_SORT_KEY, BOT_ID, DYNAMO_TABLE
-    from dyndbmutex import DynamoDbMutex
+    from constants import  GRAPH_KEY, TEST_TAG, S3_BUCKET, PERSIST_MAX_RETRIES, PERSIST_QUEUE_SIZE, S3_REGION, DYNAMO_REGION, DYNAMODB_PRIMARY_KEY, DYNAMODB_SORT_KEY, BOT_ID, DYNAMO_TABLE
     from storage import get_secrets
 
 
@@ -51,8 +52,11 @@ class DynamoPersistance:
     chain_id = None
     graph_cache = None
     table = None
-    mutex:DynamoDbMutex = None
     tag:string = None
+    persist_queue: queue.Queue = None
+    persist_thread: threading.Thread = None
+    unsaved_delta: nx.DiGraph = None
+    persist_stats: dict = None
 
 
     def __init__(self, tag = TEST_TAG, chain_id = 1):
@@ -60,50 +64,118 @@ class DynamoPersistance:
         self.chain_id = chain_id
         self.table = dynamodb.Table(DYNAMO_TABLE)
         self.tag = tag
-        self.mutex = DynamoDbMutex(f"mutex|{self.chain_id}|{self.tag}", DYNAMO_TABLE, self.name, region_name=DYNAMO_REGION, ttl_minutes=15, timeoutms=MUTEX_TIMEOUT_MILLIS)
+        self.persist_queue = queue.Queue(maxsize=PERSIST_QUEUE_SIZE)
+        self.persist_stats = {"persist_count": 0, "failed_count": 0, "conflict_count": 0, "last_duration_s": 0, "last_size_kb": 0, "last_nodes": 0}
         print(f"chain id {self.chain_id}  - name {self.name} - dynamo table:  {DYNAMO_TABLE} - tag: {self.tag}")
         self.graph_cache = self.load(GRAPH_KEY)
         if not self.graph_cache:
             self.graph_cache = nx.DiGraph()
 
 
-    def persist(self, delta_graph: object, key: str, prune_graph):
-        for n in range(5):
-            locked = self.mutex.lock()
-            if locked:
-                try:
-                    compose = []
-                    shared_graph = self.load(GRAPH_KEY)
-                    if shared_graph:
-                        compose.append(shared_graph)
-                    compose.append(delta_graph)
-                    obj = nx.compose_all(compose)
-                    prune_graph(obj)
-                    bytes = pickle.dumps(obj)
-                    size = self.bytes_to_kb(bytes)
-                    c = bz2.compress(bytes)
-                    c_size =  self.bytes_to_kb(c)
-                    print(f"Persisting with MUTEX {key}/{self.chain_id}/{self.tag} using API. Size:: {size} KB and compress {c_size} KB. {str(obj)}")
-                    s3_key = f"{BOT_ID}/sub_graph/{self.chain_id}/{self.table.table_name}_{self.tag}_SHARED_GRAPH"
-                    s3.put_object(Body=c, Bucket=S3_BUCKET, Key=s3_key)
-                    self.table.put_item(
-                        Item={
-                                DYNAMODB_PRIMARY_KEY: f"{PRIMARY_PREFIX}|{key}|{self.tag}",
-                                DYNAMODB_SORT_KEY: f"shared_graph|{self.chain_id}",
-                                'updated': datetime.now().isoformat(),
-                                'sizeKB': str(c_size), 
-                                's3_key': s3_key
-                            }
-                        )
-                    self.graph_cache = obj
-                except Exception as e:
-                    print(f"ERROR {e}")
-                finally:
-                    self.mutex.release()
-                    break
-            else:
-                print(f"{self.name} table mutex is locked, tryinging in 2 second, try #{n}")
-                time.sleep(2)
+    def persist(self, delta_graph: object, key: str, prune_graph) -> nx.DiGraph:
+        # optimistic concurrency: the shared graph pointer item has a version, a writer composes its delta into the head it read
+        # and only moves the pointer if nobody else did it meanwhile. The loser merges its delta into the new head and retries.
+        # Returns the persisted shared graph, or None if it could not be persisted.
+        start = time.time()
+        conflicts = 0
+        for n in range(PERSIST_MAX_RETRIES):
+            try:
+                shared_graph, version, head_s3_key = self.load_head(key)
+                compose = []
+                if shared_graph:
+                    compose.append(shared_graph)
+                compose.append(delta_graph)
+                obj = nx.compose_all(compose)
+                prune_graph(obj)
+                bytes = pickle.dumps(obj)
+                size = self.bytes_to_kb(bytes)
+                c = bz2.compress(bytes)
+                c_size =  self.bytes_to_kb(c)
+                print(f"Persisting {key}/{self.chain_id}/{self.tag} version {version + 1} using API. Size:: {size} KB and compress {c_size} KB. {str(obj)}")
+                # one object per version and writer: a losing writer never overwrites the object a pointer references,
+                # and the object of the previous version is deleted once the pointer moved away from it
+                s3_key = f"{BOT_ID}/sub_graph/{self.chain_id}/{self.table.table_name}_{self.tag}_SHARED_GRAPH_{version + 1}_{self.name}"
+                s3.put_object(Body=c, Bucket=S3_BUCKET, Key=s3_key)
+                if version == 0:
+                    condition = Attr(DYNAMODB_PRIMARY_KEY).not_exists() | Attr('version').not_exists()
+                else:
+                    condition = Attr('version').eq(version)
+                self.table.put_item(
+                    Item={
+                            DYNAMODB_PRIMARY_KEY: f"{PRIMARY_PREFIX}|{key}|{self.tag}",
+                            DYNAMODB_SORT_KEY: f"shared_graph|{self.chain_id}",
+                            'updated': datetime.now().isoformat(),
+                            'sizeKB': str(c_size), 
+                            's3_key': s3_key,
+                            'version': version + 1
+                        },
+                    ConditionExpression=condition
+                    )
+                if head_s3_key is not None and head_s3_key != s3_key:
+                    self.delete_object(head_s3_key)
+                self.persist_stats["persist_count"] += 1
+                self.persist_stats["last_duration_s"] = time.time() - start
+                self.persist_stats["last_size_kb"] = c_size
+                self.persist_stats["last_nodes"] = len(obj.nodes)
+                logging.info(f"{self.name} persisted shared graph version {version + 1} in {self.persist_stats['last_duration_s']:.2f}s, {c_size:.0f} KB compressed, {conflicts} conflicts. Stats: {self.persist_stats}")
+                return obj
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
+                    # the pointer never referenced the object, nobody else will delete it
+                    self.delete_object(s3_key)
+                    conflicts += 1
+                    self.persist_stats["conflict_count"] += 1
+                    print(f"{self.name} shared graph version {version} was updated by another instance, merging into the new head, try #{n}")
+                    continue
+                print(f"ERROR {e}")
+                break
+            except Exception as e:
+                print(f"ERROR {e}")
+                break
+        print(f"{self.name} could not persist the shared graph after {n + 1} tries")
+        self.persist_stats["failed_count"] += 1
+        return None
+
+    def persist_async(self, delta_graph: object, key: str, prune_graph, callback = None) -> bool:
+        # hands the delta graph over to a background thread so handle_transaction never waits for S3/Dynamo.
+        # The caller must not modify delta_graph afterwards. Returns False if the queue is full, then the caller keeps the delta and retries on its next save.
+        if self.persist_thread is None:
+            self.persist_thread = threading.Thread(target=self._persist_worker, name=f"persist-{self.name}", daemon=True)
+            self.persist_thread.start()
+        try:
+            self.persist_queue.put_nowait((delta_graph, key, prune_graph, callback))
+            return True
+        except queue.Full:
+            logging.warning(f"{self.name} persist queue is full, the delta will be saved with the next save")
+            return False
+
+    def _persist_worker(self):
+        while True:
+            delta_graph, key, prune_graph, callback = self.persist_queue.get()
+            try:
+                # a delta that failed to persist is merged into the next one, so no update is lost
+                if self.unsaved_delta is not None:
+                    delta_graph = nx.compose(self.unsaved_delta, delta_graph)
+                    self.unsaved_delta = None
+                shared_graph = self.persist(delta_graph, key, prune_graph)
+                if shared_graph is not None:
+                    # the callback gets the new shared graph before it is published as graph_cache,
+                    # while this thread is the only one reading it, so it can be indexed without copying it
+                    try:
+                        if callback is not None:
+                            callback(shared_graph)
+                    finally:
+                        self.graph_cache = shared_graph
+                else:
+                    self.unsaved_delta = delta_graph
+            except Exception as e:
+                logging.error(f"Error in persist worker {e}")
+            finally:
+                self.persist_queue.task_done()
+
+    def flush(self):
+        # blocks until all the queued saves are persisted
+        self.persist_queue.join()
 
     def bytes_to_kb(self, bytes):
         size_in_bytes = sys.getsizeof(bytes)
@@ -111,20 +183,43 @@ class DynamoPersistance:
         return size_in_kb     
 
     def load(self, key: str) -> object:
-        logging.info(f"Loading {key}/{self.chain_id}/{self.tag} using API")
-        response = self.table.get_item(
-            Key={
-                DYNAMODB_PRIMARY_KEY: f"{PRIMARY_PREFIX}|{key}|{self.tag}",
-                DYNAMODB_SORT_KEY: f"shared_graph|{self.chain_id}"
-            }
-        )
-        if "Item" in response:
-            obj = s3.get_object(Bucket=S3_BUCKET, Key=response['Item']['s3_key'])
+        return self.load_with_version(key)[0]
+
+    def load_with_version(self, key: str) -> tuple:
+        return self.load_head(key)[:2]
+
+    def load_head(self, key: str) -> tuple:
+        # returns the shared graph, its version and its s3 key. The object of a version is deleted when the next version is
+        # persisted, so if it is gone between reading the pointer and the object, the pointer is read again
+        for n in range(PERSIST_MAX_RETRIES):
+            logging.info(f"Loading {key}/{self.chain_id}/{self.tag} using API")
+            response = self.table.get_item(
+                Key={
+                    DYNAMODB_PRIMARY_KEY: f"{PRIMARY_PREFIX}|{key}|{self.tag}",
+                    DYNAMODB_SORT_KEY: f"shared_graph|{self.chain_id}"
+                },
+                ConsistentRead=True
+            )
+            if "Item" not in response:
+                return None, 0, None
+            s3_key = response['Item']['s3_key']
+            try:
+                obj = s3.get_object(Bucket=S3_BUCKET, Key=s3_key)
+            except botocore.exceptions.ClientError as e:
+                if e.response['Error']['Code'] == 'NoSuchKey' and n < PERSIST_MAX_RETRIES - 1:
+                    logging.info(f"{s3_key} was superseded while loading it, reloading the pointer")
+                    continue
+                raise
             compressed = obj['Body'].read()
             dc = bz2.decompress(compressed)
-            return pickle.loads(dc)
-        else:
-            return None
+            return pickle.loads(dc), int(response['Item'].get('version', 0)), s3_key
+
+    def delete_object(self, s3_key: str):
+        try:
+            s3.delete_object(Bucket=S3_BUCKET, Key=s3_key)
+        except Exception as e:
+            # only leaves an unreferenced object behind, the s3 lifecycle rule expires it
+            logging.warning(f"Could not delete {s3_key}: {e}")
 
     
     def clean_db(self) -> list:
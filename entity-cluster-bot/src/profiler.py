@@ -0,0 +1,113 @@
+import cProfile
+import logging
+import pstats
+import statistics
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from functools import wraps
+
+
+class SamplingProfiler:
+    """
+    Profiles 1 in sample_rate calls with cProfile and keeps the stats of the last window sampled calls.
+    Every report_interval_seconds the window is merged and dumped as pstats (can be viewed with snakeviz) and as
+    collapsed stacks (caller;callee time in microseconds, one caller level as pstats doesn't keep full stacks) for flame graph tools.
+    """
+
+    def __init__(self, sample_rate: int, window: int, report_interval_seconds: int, stats_file: str, collapsed_file: str):
+        self.sample_rate = max(1, sample_rate)
+        self.window = deque(maxlen=window)
+        self.report_interval_seconds = report_interval_seconds
+        self.stats_file = stats_file
+        self.collapsed_file = collapsed_file
+        self.calls = 0
+        self.last_report = time.time()
+
+    def profile(self, func, *args):
+        self.calls += 1
+        if self.calls % self.sample_rate != 0:
+            return func(*args)
+
+        with cProfile.Profile() as profile:
+            result = func(*args)
+        self.window.append(pstats.Stats(profile))
+        if time.time() - self.last_report >= self.report_interval_seconds:
+            self.dump()
+        return result
+
+    def dump(self):
+        self.last_report = time.time()
+        if len(self.window) == 0:
+            return
+        samples = list(self.window)
+        merged = pstats.Stats()
+        merged.add(*samples)
+        merged.dump_stats(self.stats_file)
+
+        with open(self.collapsed_file, 'w') as stream:
+            for (file_name, line, func_name), (_, _, tt, _, callers) in merged.stats.items():
+                frame = f"{func_name} ({file_name}:{line})"
+                if not callers:
+                    stream.write(f"{frame} {int(tt * 1e6)}\n")
+                    continue
+                # the self time is split among the callers by their share of the calls
+                total_calls = sum(caller_stats[0] for caller_stats in callers.values()) or 1
+                for (caller_file, caller_line, caller_name), caller_stats in callers.items():
+                    stream.write(f"{caller_name} ({caller_file}:{caller_line});{frame} {int(tt * 1e6 * caller_stats[0] / total_calls)}\n")
+        logging.info(f"Dumped profiling stats of {len(samples)} sampled transactions out of {self.calls} to {self.stats_file} and {self.collapsed_file}")
+
+
+class PhaseTimer:
+    """
+    Records the duration of each phase of the transaction processing in a rolling window and logs their percentiles
+    every report_interval_seconds.
+    """
+
+    def __init__(self, window: int, report_interval_seconds: int):
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.report_interval_seconds = report_interval_seconds
+        self.last_report = time.time()
+
+    @contextmanager
+    def time(self, phase: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.durations[phase].append(time.perf_counter() - start)
+
+    def percentiles(self) -> dict:
+        result = {}
+        for phase, durations in self.durations.items():
+            if len(durations) < 2:
+                continue
+            quantiles = statistics.quantiles(durations, n=100, method='inclusive')
+            result[phase] = {
+                "count": len(durations),
+                "p50_ms": quantiles[49] * 1000,
+                "p95_ms": quantiles[94] * 1000,
+                "p99_ms": quantiles[98] * 1000,
+                "max_ms": max(durations) * 1000
+            }
+        return result
+
+    def maybe_report(self):
+        if time.time() - self.last_report < self.report_interval_seconds:
+            return
+        self.last_report = time.time()
+        for phase, stats in self.percentiles().items():
+            logging.info(f"Phase {phase}: n={stats['count']} p50={stats['p50_ms']:.1f}ms p95={stats['p95_ms']:.1f}ms p99={stats['p99_ms']:.1f}ms max={stats['max_ms']:.1f}ms")
+
+
+def timed(phase: str):
+    """
+    decorator to time a method of an object with a phase_timer attribute
+    """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(self, *args, **kwargs):
+            with self.phase_timer.time(phase):
+                return func(self, *args, **kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,42 @@
+import pstats
+
+from profiler import SamplingProfiler, PhaseTimer, timed
+
+
+def work(n):
+    return sum(i * i for i in range(n))
+
+
+class TestProfiler:
+
+    def test_sampling_profiler_samples_and_dumps(self, tmp_path):
+        stats_file = str(tmp_path / "stats")
+        collapsed_file = str(tmp_path / "collapsed.txt")
+        profiler = SamplingProfiler(3, 2, 0, stats_file, collapsed_file)
+
+        results = [profiler.profile(work, 100) for _ in range(9)]
+
+        assert results == [work(100)] * 9, "Profiling should not change the result"
+        assert len(profiler.window) == 2, "Only the last window samples should be kept"
+        stats = pstats.Stats(stats_file)
+        assert any(func_name == "work" for (_, _, func_name) in stats.stats.keys())
+        with open(collapsed_file) as stream:
+            assert any(";work (" in line or line.startswith("work (") for line in stream)
+
+    def test_phase_timer_percentiles(self):
+        timer = PhaseTimer(10, 0)
+
+        class Agent:
+            phase_timer = timer
+
+            @timed("graph_update")
+            def update(self):
+                return work(100)
+
+        agent = Agent()
+        for _ in range(20):
+            agent.update()
+
+        percentiles = timer.percentiles()
+        assert percentiles["graph_update"]["count"] == 10, "Only the last window durations should be kept"
+        assert percentiles["graph_update"]["p50_ms"] <= percentiles["graph_update"]["p99_ms"] <= percentiles["graph_update"]["max_ms"]
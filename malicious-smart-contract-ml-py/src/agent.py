@@ -1,23 +1,36 @@
+from concurrent.futures import wait
+
 import forta_agent
 from forta_agent import get_json_rpc_url, EntityType
-from joblib import load
-from evmdasm import EvmBytecode
 from web3 import Web3
 from os import environ
 
 from src.constants import (
+    BACKGROUND_MODEL_LOADING,
     BYTE_CODE_LENGTH_THRESHOLD,
+    INFERENCE_TIMEOUT,
+    INFERENCE_WORKERS,
+    MODEL_PATH,
     MODEL_THRESHOLD,
+    RESOLVE_NON_ALERTING_OPCODE_ADDRESSES,
     SAFE_CONTRACT_THRESHOLD,
+    VERDICT_CACHE_KEY,
+    VERDICT_CACHE_PERSIST_INTERVAL,
+    VERDICT_CACHE_PERSIST_TIMEOUT,
+    VERDICT_CACHE_SIZE,
 )
 from src.findings import ContractFindings
 from src.logger import logger
+from src.model_artifacts import BackgroundLoader, load_model_artifact, report_first_score
 from src.utils import (
     calc_contract_address,
-    get_features,
+    get_opcode_addresses,
     get_storage_addresses,
     is_contract,
 )
+from src.inference_pool import create_inference_pool, score_contract_in_worker, score_opcodes
+from src.opcode_tokenizer import OpcodeVectorizer, bytecode_to_bytes
+from src.verdict_cache import VerdictCache
 
 from src.storage import get_secrets
 
@@ -25,6 +38,10 @@ SECRETS_JSON = get_secrets()
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 ML_MODEL = None
+OPCODE_VECTORIZER = None
+ML_MODEL_LOADER = None
+VERDICT_CACHE = None
+INFERENCE_POOL = None
 
 
 def initialize():
@@ -32,29 +49,128 @@ def initialize():
     this function loads the ml model.
     """
     global ML_MODEL
+    global OPCODE_VECTORIZER
+    global ML_MODEL_LOADER
     logger.info("Start loading model")
-    ML_MODEL = load("malicious_non_token_model_02_07_23_exp2.joblib")
-    logger.info("Complete loading model")
+    if BACKGROUND_MODEL_LOADING:
+        ML_MODEL, OPCODE_VECTORIZER = None, None
+        ML_MODEL_LOADER = BackgroundLoader("model", load_model)
+    else:
+        ML_MODEL, OPCODE_VECTORIZER = load_model()
+        logger.info("Complete loading model")
+
+    global INFERENCE_POOL
+    if INFERENCE_WORKERS > 0 and INFERENCE_POOL is None:
+        INFERENCE_POOL = create_inference_pool(INFERENCE_WORKERS)
+        logger.info(f"Started inference pool with {INFERENCE_WORKERS} workers")
 
     global CHAIN_ID
     CHAIN_ID = web3.eth.chain_id
 
+    global VERDICT_CACHE
+    VERDICT_CACHE = VerdictCache(
+        VERDICT_CACHE_SIZE,
+        VERDICT_CACHE_PERSIST_INTERVAL,
+        VERDICT_CACHE_PERSIST_TIMEOUT,
+        f"{VERDICT_CACHE_KEY}_{CHAIN_ID}",
+    )
+    VERDICT_CACHE.load()
+
     environ["ZETTABLOCK_API_KEY"] = SECRETS_JSON['apiKeys']['ZETTABLOCK']
 
 
-def exec_model(w3, opcodes: str, contract_creator: str) -> tuple:
+def load_model() -> tuple:
+    """
+    this function loads the ml model, memory mapped if it was packed
+    :return: model, opcode vectorizer
+    """
+    model = load_model_artifact(MODEL_PATH)
+    return model, OpcodeVectorizer(model)
+
+
+def wait_for_model():
+    """
+    this function blocks until the model loaded in the background is ready.
+    """
+    global ML_MODEL
+    global OPCODE_VECTORIZER
+    if OPCODE_VECTORIZER is None:
+        ML_MODEL, OPCODE_VECTORIZER = ML_MODEL_LOADER.get()
+
+
+def score_contract(code: bytes, contract_creator: str) -> tuple:
+    """
+    this function scores the contract inline, the inference pool workers score it with score_contract_in_worker
+    :return: score: float, address_operands: list
+    """
+    wait_for_model()
+    return score_opcodes(OPCODE_VECTORIZER, code, contract_creator)
+
+
+def exec_model(w3, code: bytes, contract_creator: str, scoring=None) -> tuple:
     """
     this function executes the model to obtain the score for the contract
+    :param scoring: done future of score_contract_in_worker, if any
     :return: score: float
     """
     score = None
-    features, opcode_addresses = get_features(w3, opcodes, contract_creator)
-    score = ML_MODEL.predict_proba([features])[0][1]
-    score = round(score, 4)
+    if scoring is not None:
+        try:
+            score, address_operands = scoring.result()
+        except Exception as e:
+            logger.warn(f"Error scoring contract in the inference pool, scoring inline: {e}")
+    if score is None:
+        score, address_operands = score_contract(code, contract_creator)
+    report_first_score()
+    opcode_addresses = set()
+    # the contract checks of the operands are deferred until the score is known, as they only go to the metadata in the non-alerting band
+    if RESOLVE_NON_ALERTING_OPCODE_ADDRESSES or not SAFE_CONTRACT_THRESHOLD < score < MODEL_THRESHOLD:
+        opcode_addresses = get_opcode_addresses(w3, address_operands)
 
     return score, opcode_addresses
 
 
+def submit_scorings(creations: list) -> dict:
+    """
+    this function submits the created contracts that miss the verdict cache to the inference pool, so the contracts of
+    factory transactions are scored in parallel; single creations are scored inline
+    :param creations: list of (from, created contract address, creation bytecode, error)
+    :return: scorings: dict verdict key -> future of score_contract_in_worker
+    """
+    scorings = {}
+    if INFERENCE_POOL is None or len(creations) < 2:
+        return scorings
+
+    for from_, created_contract_address, code, _ in creations:
+        if created_contract_address is None or len(code) <= BYTE_CODE_LENGTH_THRESHOLD:
+            continue
+        try:
+            code = bytecode_to_bytes(code)
+        except Exception:
+            continue  # logged when the creation is analyzed
+        verdict_key = VERDICT_CACHE.get_key(code, from_)
+        if verdict_key not in scorings and verdict_key not in VERDICT_CACHE.verdicts:
+            scorings[verdict_key] = INFERENCE_POOL.submit(score_contract_in_worker, code, from_)
+    return scorings
+
+
+def wait_for_scorings(scorings: dict) -> dict:
+    """
+    this function waits up to INFERENCE_TIMEOUT for the contracts submitted to the inference pool, so a stuck or dead
+    worker can't hold the transaction; the contracts not scored by then are dropped and scored inline
+    :param scorings: dict verdict key -> future of score_contract_in_worker
+    :return: scorings: dict verdict key -> done future of score_contract_in_worker
+    """
+    if not scorings:
+        return scorings
+    _, not_done = wait(scorings.values(), timeout=INFERENCE_TIMEOUT)
+    if not_done:
+        logger.warn(f"{len(not_done)} of {len(scorings)} contracts not scored by the inference pool in {INFERENCE_TIMEOUT}s, scoring them inline")
+        for future in not_done:
+            future.cancel()
+    return {verdict_key: future for verdict_key, future in scorings.items() if future not in not_done}
+
+
 def detect_malicious_contract_tx(
     w3, transaction_event: forta_agent.transaction_event.TransactionEvent
 ) -> list:
@@ -62,6 +178,7 @@ def detect_malicious_contract_tx(
     safe_findings = []
 
     if len(transaction_event.traces) > 0:
+        creations = []
         for trace in transaction_event.traces:
             if trace.type == "create":
                 created_contract_address = (
@@ -84,17 +201,26 @@ def detect_malicious_contract_tx(
 
                 # creation bytecode contains both initialization and run-time bytecode.
                 creation_bytecode = trace.action.init
-                for finding in detect_malicious_contract(
-                    w3,
-                    trace.action.from_,
-                    created_contract_address,
-                    creation_bytecode,
-                    error=error,
-                ):
-                    if finding.alert_id == "SUSPICIOUS-TOKEN-CONTRACT-CREATION":
-                        malicious_findings.append(finding)
-                    else:
-                        safe_findings.append(finding)
+                creations.append(
+                    (trace.action.from_, created_contract_address, creation_bytecode, error)
+                )
+
+        # the findings are built in trace order once the contracts are scored
+        scorings = wait_for_scorings(submit_scorings(creations))
+        for from_, created_contract_address, creation_bytecode, error in creations:
+            for finding in detect_malicious_contract(
+                w3,
+                from_,
+                created_contract_address,
+                creation_bytecode,
+                error=error,
+                scorings=scorings,
+                block_number=transaction_event.block_number,
+            ):
+                if finding.alert_id == "SUSPICIOUS-TOKEN-CONTRACT-CREATION":
+                    malicious_findings.append(finding)
+                else:
+                    safe_findings.append(finding)
 
     else:  # Trace isn't supported, To improve coverage, process contract creations from EOAs.
         if transaction_event.to is None:
@@ -108,6 +234,7 @@ def detect_malicious_contract_tx(
                 transaction_event.from_,
                 created_contract_address,
                 creation_bytecode,
+                block_number=transaction_event.block_number,
             ):
                 if finding.alert_id == "SUSPICIOUS-TOKEN-CONTRACT-CREATION":
                     malicious_findings.append(finding)
@@ -119,22 +246,37 @@ def detect_malicious_contract_tx(
 
 
 def detect_malicious_contract(
-    w3, from_, created_contract_address, code, error=None
+    w3, from_, created_contract_address, code, error=None, scorings=None, block_number=None
 ) -> list:
     findings = []
 
     if created_contract_address is not None:
         if len(code) > BYTE_CODE_LENGTH_THRESHOLD:
             try:
-                opcodes = EvmBytecode(code).disassemble()
+                code = bytecode_to_bytes(code)
             except Exception as e:
-                logger.warn(f"Error disassembling evm bytecode: {e}")
+                logger.warn(f"Error decoding evm bytecode: {e}")
+                return findings
+            # duplicated deployments reuse the verdict of the same bytecode
+            verdict_key = VERDICT_CACHE.get_key(code, from_)
+            verdict = VERDICT_CACHE.get(verdict_key)
+            if verdict is not None:
+                model_score, opcode_addresses, creator_in_opcodes = verdict
+                opcode_addresses = set(opcode_addresses)
+                if creator_in_opcodes and is_contract(w3, from_):
+                    opcode_addresses.add(Web3.toChecksumAddress(from_))
+                logger.info(f"{created_contract_address}: verdict cache hit. {VERDICT_CACHE.stats()}")
+            else:
+                (
+                    model_score,
+                    opcode_addresses,
+                ) = exec_model(
+                    w3, code, from_, scorings.get(verdict_key) if scorings else None
+                )
+                VERDICT_CACHE.put(verdict_key, model_score, opcode_addresses, from_)
+                logger.info(f"{created_contract_address}: verdict cache miss. {VERDICT_CACHE.stats()}")
             # obtain all the addresses contained in the created contract and propagate to the findings
-            storage_addresses = get_storage_addresses(w3, created_contract_address)
-            (
-                model_score,
-                opcode_addresses,
-            ) = exec_model(w3, opcodes, from_)
+            storage_addresses = get_storage_addresses(w3, created_contract_address, block_number)
             logger.info(f"{created_contract_address}: score={model_score}")
 
             finding = ContractFindings(
@@ -1,8 +1,16 @@
+import os
+import tempfile
+
+import joblib
 from forta_agent import FindingSeverity, create_transaction_event
 
 import agent
+import reference_features
 import utils
 from evmdasm import EvmBytecode
+from model_artifacts import load_model_artifact, pack_model_artifact
+from opcode_tokenizer import iter_opcode_tokens
+from verdict_cache import VerdictCache
 from web3_mock import (
     BENIGN_CONTRACT,
     CONTRACT_NO_ADDRESS,
@@ -32,13 +40,13 @@ class TestMaliciousSmartContractML:
     def test_opcode_addresses_no_addr(self):
         bytecode = w3.eth.get_code(CONTRACT_NO_ADDRESS)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        _, addresses = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        _, addresses = reference_features.get_features(w3, opcodes, EOA_ADDRESS)
         assert len(addresses) == 0, "should be empty"
 
     def test_opcode_addresses_with_addr(self):
         bytecode = w3.eth.get_code(CONTRACT_WITH_ADDRESS)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        _, addresses = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        _, addresses = reference_features.get_features(w3, opcodes, EOA_ADDRESS)
 
         assert len(addresses) == 1, "should not be empty"
 
@@ -59,7 +67,7 @@ class TestMaliciousSmartContractML:
     def test_get_features(self):
         bytecode = w3.eth.get_code(MALICIOUS_CONTRACT)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        features, _ = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        features, _ = reference_features.get_features(w3, opcodes, EOA_ADDRESS)
         assert len(features) == 4572, "incorrect features length obtained"
 
     def test_finding_MALICIOUS_CONTRACT_creation(self):
@@ -111,3 +119,131 @@ class TestMaliciousSmartContractML:
             w3, EOA_ADDRESS, SHORT_CONTRACT, bytecode
         )
         assert len(findings) == 0, "this should not have triggered a finding"
+
+    def test_verdict_cache_key_normalizes_creator(self):
+        agent.initialize()
+        creator_a = "0x" + "11" * 20
+        creator_b = "0x" + "22" * 20
+        code_a = "0x6080604052" + "73" + creator_a[2:] + "5b00" * 40
+        code_b = "0x6080604052" + "73" + creator_b[2:] + "5b00" * 40
+        assert agent.VERDICT_CACHE.get_key(code_a, creator_a) == agent.VERDICT_CACHE.get_key(
+            code_b, creator_b
+        ), "creator address should be normalized out of the key"
+        assert agent.VERDICT_CACHE.get_key(code_a, creator_a) != agent.VERDICT_CACHE.get_key(
+            code_b, creator_a
+        ), "other addresses should be part of the key"
+
+    def test_detect_malicious_contract_verdict_cache_hit(self):
+        agent.initialize()
+        bytecode = w3.eth.get_code(BENIGN_CONTRACT)
+        findings = agent.detect_malicious_contract(
+            w3, EOA_ADDRESS, BENIGN_CONTRACT, bytecode
+        )
+        hits = agent.VERDICT_CACHE.hits
+        cached_findings = agent.detect_malicious_contract(
+            w3, EOA_ADDRESS, BENIGN_CONTRACT, bytecode
+        )
+        assert agent.VERDICT_CACHE.hits == hits + 1, "second deployment should hit the cache"
+        assert cached_findings[0].alert_id == findings[0].alert_id
+        assert cached_findings[0].metadata["model_score"] == findings[0].metadata["model_score"]
+
+    def test_verdict_cache_persists_in_background(self):
+        with tempfile.TemporaryDirectory() as directory:
+            cache = VerdictCache(10, 2, 1, os.path.join(directory, "verdicts"))
+            cache.put("0x1", 0.1, set(), EOA_ADDRESS)
+            assert cache.persist_thread is None, "should only persist every persist_interval new verdicts"
+            cache.put("0x2", 0.9, set(), EOA_ADDRESS)
+            cache.persist_thread.join()
+
+            loaded_cache = VerdictCache(10, 2, 1, cache.key)
+            loaded_cache.load()
+            assert list(loaded_cache.verdicts) == ["0x1", "0x2"]
+
+    def test_opcode_tokens_match_get_features(self):
+        for contract in [MALICIOUS_CONTRACT, BENIGN_CONTRACT, CONTRACT_WITH_ADDRESS]:
+            bytecode = w3.eth.get_code(contract)
+            opcodes = EvmBytecode(bytecode.hex()).disassemble()
+            features, addresses = reference_features.get_features(w3, opcodes, EOA_ADDRESS)
+            address_operands = []
+            tokens = list(iter_opcode_tokens(bytes(bytecode), EOA_ADDRESS, address_operands))
+            assert " ".join(tokens) == features, "streaming tokens should match the disassembled features"
+            assert utils.get_opcode_addresses(w3, address_operands) == addresses
+
+    def test_opcode_vectorizer_score_matches_model(self):
+        agent.initialize()
+        for contract in [MALICIOUS_CONTRACT, BENIGN_CONTRACT]:
+            bytecode = w3.eth.get_code(contract)
+            opcodes = EvmBytecode(bytecode.hex()).disassemble()
+            features, _ = reference_features.get_features(w3, opcodes, EOA_ADDRESS)
+            expected_score = agent.ML_MODEL.predict_proba([features])[0][1]
+            tokens = iter_opcode_tokens(bytes(bytecode), EOA_ADDRESS, [])
+            assert abs(agent.OPCODE_VECTORIZER.predict_proba(tokens) - expected_score) < 1e-9
+
+    def test_is_contract_batch(self):
+        utils.CONTRACT_CACHE.clear()
+        contracts = utils.is_contract_batch(w3, [CONTRACT_WITH_ADDRESS, EOA_ADDRESS, CONTRACT_WITH_ADDRESS.lower()])
+        assert contracts == {CONTRACT_WITH_ADDRESS: True, EOA_ADDRESS: False}, "addresses should be deduplicated"
+        assert utils.CONTRACT_CACHE[EOA_ADDRESS] is False, "EOA result should be cached"
+
+    def test_detect_malicious_contract_tx_inference_pool(self):
+        agent.initialize()
+        tx_event = create_transaction_event(
+            {
+                "transaction": {
+                    "hash": "0",
+                    "from": MALICIOUS_CONTRACT_DEPLOYER,
+                    "nonce": MALICIOUS_CONTRACT_DEPLOYER_NONCE,
+                },
+                "block": {"number": 0},
+                "traces": [
+                    {
+                        "type": "create",
+                        "action": {
+                            "from": MALICIOUS_CONTRACT_DEPLOYER,
+                            "init": w3.eth.get_code(contract),
+                            "value": 1,
+                        },
+                        "result": {"address": contract},
+                    }
+                    for contract in [MALICIOUS_CONTRACT, BENIGN_CONTRACT]
+                ],
+                "receipt": {"logs": []},
+            }
+        )
+        findings = agent.detect_malicious_contract_tx(w3, tx_event)
+
+        agent.initialize()  # empty verdict cache
+        agent.INFERENCE_POOL = agent.create_inference_pool(2)
+        try:
+            pool_findings = agent.detect_malicious_contract_tx(w3, tx_event)
+        finally:
+            agent.INFERENCE_POOL.shutdown()
+            agent.INFERENCE_POOL = None
+
+        assert [f.alert_id for f in pool_findings] == [f.alert_id for f in findings], "findings should be in trace order"
+        assert [f.metadata["model_score"] for f in pool_findings] == [f.metadata["model_score"] for f in findings]
+
+    def test_model_artifact_mmap(self, tmp_path):
+        agent.initialize()
+        path = str(tmp_path / "model.joblib")
+        joblib.dump(agent.ML_MODEL, path)
+        pack_model_artifact(path)
+
+        model = load_model_artifact(path)
+        bytecode = w3.eth.get_code(MALICIOUS_CONTRACT)
+        features, _ = reference_features.get_features(w3, EvmBytecode(bytecode.hex()).disassemble(), EOA_ADDRESS)
+        assert model.predict_proba([features])[0][1] == agent.ML_MODEL.predict_proba([features])[0][1]
+
+    def test_model_artifacts_copies_in_sync(self):
+        # model_artifacts.py is copied into the other ML bots, see the comment at its top
+        src_dir = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(src_dir, "model_artifacts.py"), "rb") as f:
+            source = f.read()
+        for copy in [
+            "malicious-token-contract-ml-py/src/model_artifacts.py",
+            "anomalous-token-transfers-ml-py/src/utils/model_artifacts.py",
+        ]:
+            path = os.path.join(src_dir, "..", "..", copy)
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    assert f.read() == source, f"{copy} differs from src/model_artifacts.py"
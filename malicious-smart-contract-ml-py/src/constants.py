@@ -5,5 +5,19 @@ SAFE_CONTRACT_THRESHOLD = 0.1  # threshold for labelling safe contract
 BYTE_CODE_LENGTH_THRESHOLD = (
     60  # ignore contracts with byte code length below this threshold
 )
+CONTRACT_CACHE_SIZE = 100000  # how many contract/EOA check results to keep
+RPC_BATCH_SIZE = 100  # how many calls to send in one JSON-RPC batch
+RPC_BATCH_TIMEOUT = 30  # timeout in seconds of the JSON-RPC batch request
+STORAGE_ADDRESSES_CACHE_SIZE = 1000  # how many (contract, block) storage addresses results to keep
+MIN_ADDRESS_NONZERO_BYTES = 10  # storage values with fewer non-zero bytes are not checked for contracts
+RESOLVE_NON_ALERTING_OPCODE_ADDRESSES = False  # the opcode addresses only go to the metadata when the score is between the safe and model thresholds
+MODEL_PATH = "malicious_non_token_model_02_07_23_exp2.joblib"
+BACKGROUND_MODEL_LOADING = False  # load the model on a background thread; the transactions that need it wait for it
+INFERENCE_WORKERS = 0  # processes scoring the contracts of transactions with several creations in parallel; 0 scores inline
+INFERENCE_TIMEOUT = 30  # seconds a transaction waits for the inference pool, the contracts not scored by then are scored inline
 MASK = "0xffffffffffffffffffffffffffffffffffffffff"
 BOT_ID = "0x9aaa5cd64000e8ba4fa2718a467b90055b70815d60351914cc1cbe89fe1c404c"
+VERDICT_CACHE_SIZE = 10000  # how many bytecode verdicts to keep
+VERDICT_CACHE_PERSIST_INTERVAL = 100  # persist the verdict cache every this many new verdicts
+VERDICT_CACHE_PERSIST_TIMEOUT = 30  # seconds to wait for the research database when loading or persisting the verdict cache
+VERDICT_CACHE_KEY = "malicious-contract-verdict-cache-V1"  # bump when the model changes
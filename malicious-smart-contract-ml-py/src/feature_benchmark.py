@@ -0,0 +1,35 @@
+import sys
+import timeit
+
+from evmdasm import EvmBytecode
+
+from src import agent
+from src.opcode_tokenizer import iter_opcode_tokens
+from src.reference_features import get_features
+
+
+def benchmark_feature_extraction(contract_address: str, creator: str, number: int = 20) -> tuple:
+    """
+    this function scores a deployed contract with the disassembler-based reference features and with the streaming tokenizer
+    :return: reference and streaming throughput in contracts per second: tuple
+    """
+    agent.initialize()
+    agent.wait_for_model()
+    bytecode = bytes(agent.web3.eth.get_code(contract_address))
+
+    def score_reference():
+        features, _ = get_features(agent.web3, EvmBytecode(bytecode.hex()).disassemble(), creator)
+        return agent.ML_MODEL.predict_proba([features])
+
+    def score_streaming():
+        return agent.OPCODE_VECTORIZER.predict_proba(iter_opcode_tokens(bytecode, creator, []))
+
+    reference_seconds = timeit.timeit(score_reference, number=number)
+    streaming_seconds = timeit.timeit(score_streaming, number=number)
+    return number / reference_seconds, number / streaming_seconds
+
+
+if __name__ == "__main__":
+    # python3 -m src.feature_benchmark <contract_address> <creator>, from the bot directory
+    reference, streaming = benchmark_feature_extraction(sys.argv[1], sys.argv[2].lower())
+    print(f"reference: {reference:.1f} contracts/s, streaming: {streaming:.1f} contracts/s, speedup: {streaming / reference:.1f}x")
@@ -0,0 +1,48 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+from src.constants import MODEL_PATH
+from src.model_artifacts import load_model_artifact
+from src.opcode_tokenizer import OpcodeVectorizer, iter_opcode_tokens
+
+# Kept apart from the agent: the workers are spawned, so they import this module and not the agent with its secrets and node
+WORKER_VECTORIZER = None
+
+
+def create_inference_pool(workers: int) -> ProcessPoolExecutor:
+    """
+    this function creates the inference pool. Its processes are spawned rather than forked, as forking while the model
+    loader or verdict cache threads hold a lock can leave a worker deadlocked
+    :return: inference pool: ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(
+        max_workers=workers, mp_context=multiprocessing.get_context("spawn"), initializer=initialize_inference_worker
+    )
+
+
+def initialize_inference_worker():
+    """
+    this function loads the ml model once in each inference pool worker.
+    """
+    global WORKER_VECTORIZER
+    WORKER_VECTORIZER = OpcodeVectorizer(load_model_artifact(MODEL_PATH))
+
+
+def score_opcodes(opcode_vectorizer: OpcodeVectorizer, code: bytes, contract_creator: str) -> tuple:
+    """
+    this function scores the contract with the given vectorizer
+    :return: score: float, address_operands: list
+    """
+    address_operands = []
+    tokens = iter_opcode_tokens(code, contract_creator, address_operands)
+    score = opcode_vectorizer.predict_proba(tokens)
+    score = round(score, 4)
+    return score, address_operands
+
+
+def score_contract_in_worker(code: bytes, contract_creator: str) -> tuple:
+    """
+    this function scores the contract in an inference pool worker
+    :return: score: float, address_operands: list
+    """
+    return score_opcodes(WORKER_VECTORIZER, code, contract_creator)
@@ -0,0 +1,120 @@
+# Shared by the malicious-smart-contract-ml, malicious-token-contract-ml and anomalous-token-transfers-ml bots. Each bot is
+# its own Docker build context, so each has a copy: edit malicious-smart-contract-ml-py/src/model_artifacts.py and copy it
+# over, test_model_artifacts_copies_in_sync fails when the copies differ.
+import logging
+import os
+import sys
+import threading
+import time
+
+import joblib
+
+PACKED_SUFFIX = ".mmap"
+START_TIME = time.time()  # imported with the agent, so this is close to the start of the bot
+FIRST_SCORE_REPORTED = False
+
+
+def get_packed_path(path: str) -> str:
+    return f"{path}{PACKED_SUFFIX}"
+
+
+def load_dill(path: str):
+    import dill
+
+    with open(path, "rb") as f:
+        return dill.load(f)
+
+
+def pack_model_artifact(path: str, loader=joblib.load) -> str:
+    """
+    this function re-dumps a model artifact uncompressed with joblib, which stores its numpy arrays as raw buffers that can
+    be memory mapped when loading. Only the arrays kept as numpy attributes stay mapped (idf diagonal, model coefficients,
+    explainer training statistics): sklearn copies the tree nodes and values into its own buffers, and dicts such as the
+    vectorizer vocabulary are unpickled as usual
+    :return: packed path: str
+    """
+    model = loader(path)
+    packed_path = get_packed_path(path)
+    try:
+        joblib.dump(model, packed_path, compress=0)
+    except Exception:
+        # don't leave a partial artifact behind, load_model_artifact would try it first
+        if os.path.exists(packed_path):
+            os.remove(packed_path)
+        raise
+    return packed_path
+
+
+def load_model_artifact(path: str, loader=joblib.load):
+    """
+    this function loads the packed artifact with mmap_mode='r' if it exists, otherwise the original artifact
+    the pages of the mapped arrays are shared by the processes loading the same artifact
+    :return: model artifact
+    """
+    packed_path = get_packed_path(path)
+    if os.path.exists(packed_path):
+        try:
+            return joblib.load(packed_path, mmap_mode="r")
+        except Exception as e:
+            logging.warning(f"Error loading {packed_path}, loading {path}: {e}")
+    return loader(path)
+
+
+class BackgroundLoader:
+    """
+    Loads model artifacts on a background thread, so the bot starts handling transactions right away; get() blocks until
+    they are loaded, which holds the transactions that need the model until then.
+    """
+
+    def __init__(self, name: str, load_func):
+        self.name = name
+        self._loaded = threading.Event()
+        self._artifact = None
+        self._error = None
+        self._thread = threading.Thread(target=self._load, args=(load_func,), name=f"load-{name}", daemon=True)
+        self._thread.start()
+
+    def _load(self, load_func):
+        start = time.time()
+        try:
+            self._artifact = load_func()
+            logging.info(f"Loaded {self.name} in the background in {time.time() - start:.2f}s")
+        except Exception as e:
+            self._error = e
+        finally:
+            self._loaded.set()
+
+    def is_loaded(self) -> bool:
+        return self._loaded.is_set()
+
+    def get(self):
+        self._loaded.wait()
+        if self._error is not None:
+            raise self._error
+        return self._artifact
+
+
+def report_first_score():
+    """
+    this function logs the time from the start of the bot to the first score, once
+    """
+    global FIRST_SCORE_REPORTED
+    if not FIRST_SCORE_REPORTED:
+        FIRST_SCORE_REPORTED = True
+        logging.info(f"Startup to first score: {time.time() - START_TIME:.2f}s")
+
+
+if __name__ == "__main__":
+    # packaging step of the Dockerfile: python3 -m <module> [--dill] <artifact> ...
+    paths = sys.argv[1:]
+    loader = joblib.load
+    if len(paths) > 0 and paths[0] == "--dill":
+        paths = paths[1:]
+        loader = load_dill
+    for path in paths:
+        start = time.time()
+        try:
+            print(f"Packed {path} to {pack_model_artifact(path, loader)} in {time.time() - start:.2f}s")
+        except Exception as e:
+            # the bot loads the original artifact when there is no packed one
+            print(f"Couldn't pack {path}, the original artifact will be loaded: {e}")
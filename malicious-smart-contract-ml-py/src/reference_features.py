@@ -0,0 +1,38 @@
+# Reference feature extraction from the disassembled instructions, as the model was trained. The bot uses
+# src/opcode_tokenizer.py instead; this module is only imported by the tests and src/feature_benchmark.py.
+from web3 import Web3
+
+from src.constants import MASK
+from src.contract_inspection import is_contract
+
+
+def get_features(w3, opcodes, contract_creator) -> list:
+    """
+    this function returns the contract opcodes from the disassembled instructions, same tokens as opcode_tokenizer.iter_opcode_tokens
+    :return: features: list
+    """
+    features = []
+    opcode_addresses = set()
+
+    for i, opcode in enumerate(opcodes):
+        opcode_name = opcode.name
+        # treat unique unknown and invalid opcodes as UNKNOWN OR INVALID
+        if opcode_name.startswith("UNKNOWN") or opcode_name.startswith("INVALID"):
+            opcode_name = opcode.name.split("_")[0]
+        features.append(opcode_name)
+        if len(opcode.operand) == 40 and is_contract(w3, opcode.operand):
+            opcode_addresses.add(Web3.toChecksumAddress(f"0x{opcode.operand}"))
+
+        if opcode_name in {"PUSH4", "PUSH32"}:
+            features.append(opcode.operand)
+        elif opcode_name == "PUSH20":
+            if opcode.operand == contract_creator:
+                features.append("creator")
+            elif opcode.operand == MASK:
+                features.append(MASK)
+            else:
+                features.append("addr")
+
+    features = " ".join(features)
+
+    return features, opcode_addresses
@@ -0,0 +1,125 @@
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import forta_agent
+import requests
+from web3 import Web3
+
+from src.logger import logger
+from src.opcode_tokenizer import bytecode_to_bytes
+
+DATABASE = "https://research.forta.network/database/bot/"
+PUSH20 = b"\x73"
+
+
+def normalize_bytecode(code, contract_creator: str) -> bytes:
+    """
+    this function replaces the creator address pushed by PUSH20 with zeros, so copies of the same contract deployed by different creators share the key
+    :return: normalized bytecode: bytes
+    """
+    code = bytecode_to_bytes(code)
+    if contract_creator is None:
+        return code
+    creator_bytes = bytes.fromhex(contract_creator[2:].lower())
+    return code.replace(PUSH20 + creator_bytes, PUSH20 + bytes(20))
+
+
+class VerdictCache:
+    """
+    LRU cache of model verdicts keyed by the keccak of the normalized creation bytecode, so duplicate deployments
+    (factories, copy-paste scam kits) skip the feature extraction and the model. It is persisted on a background thread every
+    persist_interval new verdicts and loaded at initialize.
+    """
+
+    def __init__(self, max_size: int, persist_interval: int, persist_timeout: float, key: str):
+        self.max_size = max_size
+        self.persist_interval = persist_interval
+        self.persist_timeout = persist_timeout
+        self.key = key
+        self.persist_thread = None
+        self.verdicts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.new_verdicts = 0
+
+    def get_key(self, code, contract_creator: str) -> str:
+        return Web3.keccak(normalize_bytecode(code, contract_creator)).hex()
+
+    def get(self, key: str):
+        """
+        :return: (model score, opcode addresses, whether the creator was an opcode address) or None
+        """
+        verdict = self.verdicts.get(key)
+        if verdict is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.verdicts.move_to_end(key)
+        return verdict
+
+    def put(self, key: str, model_score: float, opcode_addresses: set, contract_creator: str):
+        # the creator is stored as a flag as it differs for each deployment
+        creator = Web3.toChecksumAddress(contract_creator) if contract_creator is not None else None
+        self.verdicts[key] = (model_score, frozenset(opcode_addresses - {creator}), creator in opcode_addresses)
+        self.verdicts.move_to_end(key)
+        if len(self.verdicts) > self.max_size:
+            self.verdicts.popitem(last=False)
+        self.new_verdicts += 1
+        if self.new_verdicts >= self.persist_interval:
+            self.persist_async()
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> str:
+        return f"verdict cache size={len(self.verdicts)} hits={self.hits} misses={self.misses} hit_ratio={self.hit_ratio():.2%}"
+
+    def persist_async(self):
+        """
+        this function snapshots the verdicts and persists them on a background thread, so the transaction handler doesn't wait for the upload.
+        While a previous persist is still running nothing is started, the next new verdict tries again
+        """
+        if self.persist_thread is not None and self.persist_thread.is_alive():
+            return
+        self.new_verdicts = 0
+        data = pickle.dumps(self.verdicts)
+        self.persist_thread = threading.Thread(target=self.persist, args=(data,), name="verdict-cache-persist", daemon=True)
+        self.persist_thread.start()
+
+    def persist(self, data: bytes):
+        try:
+            if "NODE_ENV" in os.environ and "production" in os.environ.get("NODE_ENV"):
+                logger.info(f"Persisting {self.key} using API. {self.stats()}")
+                token = forta_agent.fetch_jwt({})
+                headers = {"Authorization": f"Bearer {token}"}
+                res = requests.post(f"{DATABASE}{self.key}", data=data, headers=headers, timeout=self.persist_timeout)
+                logger.info(f"Persisting {self.key} to database. Response: {res}")
+            else:
+                logger.info(f"Persisting {self.key} locally. {self.stats()}")
+                with open(self.key, "wb") as f:
+                    f.write(data)
+        except Exception as e:
+            logger.warning(f"Error persisting {self.key}: {e}")
+
+    def load(self):
+        try:
+            verdicts = None
+            if "NODE_ENV" in os.environ and "production" in os.environ.get("NODE_ENV"):
+                logger.info(f"Loading {self.key} using API")
+                token = forta_agent.fetch_jwt({})
+                headers = {"Authorization": f"Bearer {token}"}
+                res = requests.get(f"{DATABASE}{self.key}", headers=headers, timeout=self.persist_timeout)
+                if res.status_code == 200 and len(res.content) > 0:
+                    verdicts = pickle.loads(res.content)
+            elif os.path.exists(self.key):
+                logger.info(f"Loading {self.key} locally")
+                with open(self.key, "rb") as f:
+                    verdicts = pickle.load(f)
+            if verdicts is not None:
+                self.verdicts = OrderedDict(list(verdicts.items())[-self.max_size:])
+                logger.info(f"Loaded {len(self.verdicts)} verdicts from {self.key}")
+        except Exception as e:
+            logger.warning(f"Error loading {self.key}: {e}")
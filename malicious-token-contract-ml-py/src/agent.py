@@ -1,24 +1,32 @@
 import forta_agent
 import rlp
 from forta_agent import get_json_rpc_url, EntityType
-from joblib import load
-from evmdasm import EvmBytecode
 from web3 import Web3
 from os import environ
 
 
 from src.constants import (
+    BACKGROUND_MODEL_LOADING,
     BYTE_CODE_LENGTH_THRESHOLD,
+    MODEL_PATH,
     MODEL_THRESHOLD,
+    RESOLVE_NON_ALERTING_OPCODE_ADDRESSES,
     SAFE_CONTRACT_THRESHOLD,
+    VERDICT_CACHE_KEY,
+    VERDICT_CACHE_PERSIST_INTERVAL,
+    VERDICT_CACHE_PERSIST_TIMEOUT,
+    VERDICT_CACHE_SIZE,
 )
 from src.findings import TokenContractFindings
 from src.logger import logger
+from src.model_artifacts import BackgroundLoader, load_model_artifact, report_first_score
 from src.utils import (
-    get_features,
+    get_opcode_addresses,
     get_storage_addresses,
     is_contract,
 )
+from src.opcode_tokenizer import OpcodeVectorizer, bytecode_to_bytes, iter_opcode_tokens
+from src.verdict_cache import VerdictCache
 
 from src.storage import get_secrets
 
@@ -26,6 +34,9 @@ SECRETS_JSON = get_secrets()
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 ML_MODEL = None
+OPCODE_VECTORIZER = None
+ML_MODEL_LOADER = None
+VERDICT_CACHE = None
 
 
 def initialize():
@@ -33,24 +44,65 @@ def initialize():
     this function loads the ml model.
     """
     global ML_MODEL
+    global OPCODE_VECTORIZER
+    global ML_MODEL_LOADER
     logger.info("Start loading model")
-    ML_MODEL = load("malicious_token_model_02_07_23_exp6.joblib")
-    logger.info("Complete loading model")
+    if BACKGROUND_MODEL_LOADING:
+        ML_MODEL, OPCODE_VECTORIZER = None, None
+        ML_MODEL_LOADER = BackgroundLoader("model", load_model)
+    else:
+        ML_MODEL, OPCODE_VECTORIZER = load_model()
+        logger.info("Complete loading model")
 
     global CHAIN_ID
     CHAIN_ID = web3.eth.chain_id
 
+    global VERDICT_CACHE
+    VERDICT_CACHE = VerdictCache(
+        VERDICT_CACHE_SIZE,
+        VERDICT_CACHE_PERSIST_INTERVAL,
+        VERDICT_CACHE_PERSIST_TIMEOUT,
+        f"{VERDICT_CACHE_KEY}_{CHAIN_ID}",
+    )
+    VERDICT_CACHE.load()
+
     environ["ZETTABLOCK_API_KEY"] = SECRETS_JSON["apiKeys"]["ZETTABLOCK"]
 
 
-def exec_model(w3, opcodes: str, contract_creator: str) -> tuple:
+def load_model() -> tuple:
+    """
+    this function loads the ml model, memory mapped if it was packed
+    :return: model, opcode vectorizer
+    """
+    model = load_model_artifact(MODEL_PATH)
+    return model, OpcodeVectorizer(model)
+
+
+def wait_for_model():
+    """
+    this function blocks until the model loaded in the background is ready.
+    """
+    global ML_MODEL
+    global OPCODE_VECTORIZER
+    if OPCODE_VECTORIZER is None:
+        ML_MODEL, OPCODE_VECTORIZER = ML_MODEL_LOADER.get()
+
+
+def exec_model(w3, code: bytes, contract_creator: str) -> tuple:
     """
     this function executes the model to obtain the score for the contract
     :return: score: float
     """
     score = None
-    features, opcode_addresses = get_features(w3, opcodes, contract_creator)
-    score = ML_MODEL.predict_proba([features])[0][1]
+    wait_for_model()
+    address_operands = []
+    tokens = iter_opcode_tokens(code, contract_creator, address_operands)
+    score = OPCODE_VECTORIZER.predict_proba(tokens)
+    report_first_score()
+    opcode_addresses = set()
+    # the contract checks of the operands are deferred until the score is known, as they only go to the metadata in the non-alerting band
+    if RESOLVE_NON_ALERTING_OPCODE_ADDRESSES or not SAFE_CONTRACT_THRESHOLD < score < MODEL_THRESHOLD:
+        opcode_addresses = get_opcode_addresses(w3, address_operands)
 
     return score, opcode_addresses
 
@@ -88,6 +140,7 @@ def detect_malicious_token_contract_tx(
                     trace.action.from_,
                     created_contract_address,
                     creation_bytecode,
+                    block_number=transaction_event.block_number,
                 ):
                     if finding.alert_id == "SUSPICIOUS-TOKEN-CONTRACT-CREATION":
                         malicious_findings.append(finding)
@@ -107,6 +160,7 @@ def detect_malicious_token_contract_tx(
                 transaction_event.from_,
                 created_contract_address,
                 runtime_bytecode,
+                block_number=transaction_event.block_number,
             ):
                 if finding.alert_id == "SUSPICIOUS-TOKEN-CONTRACT-CREATION":
                     malicious_findings.append(finding)
@@ -117,18 +171,31 @@ def detect_malicious_token_contract_tx(
     return (malicious_findings + safe_findings)[:10]
 
 
-def detect_malicious_token_contract(w3, from_, created_contract_address, code) -> list:
+def detect_malicious_token_contract(w3, from_, created_contract_address, code, block_number=None) -> list:
     findings = []
 
     if created_contract_address is not None:
         if len(code) > BYTE_CODE_LENGTH_THRESHOLD:
             try:
-                opcodes = EvmBytecode(code).disassemble()
+                code = bytecode_to_bytes(code)
             except Exception as e:
-                logger.warn(f"Error disassembling evm bytecode: {e}")
+                logger.warn(f"Error decoding evm bytecode: {e}")
+                return findings
+            # duplicated deployments reuse the verdict of the same bytecode
+            verdict_key = VERDICT_CACHE.get_key(code, from_)
+            verdict = VERDICT_CACHE.get(verdict_key)
+            if verdict is not None:
+                model_score, opcode_addresses, creator_in_opcodes = verdict
+                opcode_addresses = set(opcode_addresses)
+                if creator_in_opcodes and is_contract(w3, from_):
+                    opcode_addresses.add(Web3.toChecksumAddress(from_))
+                logger.info(f"{created_contract_address}: verdict cache hit. {VERDICT_CACHE.stats()}")
+            else:
+                model_score, opcode_addresses = exec_model(w3, code, from_)
+                VERDICT_CACHE.put(verdict_key, model_score, opcode_addresses, from_)
+                logger.info(f"{created_contract_address}: verdict cache miss. {VERDICT_CACHE.stats()}")
             # obtain all the addresses contained in the created contract and propagate to the findings
-            storage_addresses = get_storage_addresses(w3, created_contract_address)
-            model_score, opcode_addresses = exec_model(w3, opcodes, from_)
+            storage_addresses = get_storage_addresses(w3, created_contract_address, block_number)
             from_label_type = "contract" if is_contract(w3, from_) else "eoa"
             finding = TokenContractFindings(
                 from_,
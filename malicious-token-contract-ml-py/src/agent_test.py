@@ -1,7 +1,9 @@
 from forta_agent import FindingSeverity, create_transaction_event
 
 import agent
+import utils
 from evmdasm import EvmBytecode
+from opcode_tokenizer import iter_opcode_tokens
 from web3_mock import (
     BENIGN_CONTRACT,
     CONTRACT_NO_ADDRESS,
@@ -32,19 +34,19 @@ class TestMaliciousSmartContractML:
         # EOAs don't have bytecode or opcodes
         bytecode = w3.eth.get_code(EOA_ADDRESS)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        _, addresses = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        _, addresses = utils.get_features(w3, opcodes, EOA_ADDRESS)
         assert len(addresses) == 0, "should be empty"
 
     def test_opcode_addresses_no_addr(self):
         bytecode = w3.eth.get_code(CONTRACT_NO_ADDRESS)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        _, addresses = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        _, addresses = utils.get_features(w3, opcodes, EOA_ADDRESS)
         assert len(addresses) == 0, "should be empty"
 
     def test_opcode_addresses_with_addr(self):
         bytecode = w3.eth.get_code(CONTRACT_WITH_ADDRESS)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        _, addresses = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        _, addresses = utils.get_features(w3, opcodes, EOA_ADDRESS)
 
         assert len(addresses) == 1, "should not be empty"
 
@@ -65,7 +67,7 @@ class TestMaliciousSmartContractML:
     def test_get_features(self):
         bytecode = w3.eth.get_code(MALICIOUS_TOKEN_CONTRACT)
         opcodes = EvmBytecode(bytecode.hex()).disassemble()
-        features, _ = agent.get_features(w3, opcodes, EOA_ADDRESS)
+        features, _ = utils.get_features(w3, opcodes, EOA_ADDRESS)
         assert len(features) == 24312, "incorrect features length obtained"
 
     def test_finding_MALICIOUS_TOKEN_CONTRACT_creation(self):
@@ -118,3 +120,56 @@ class TestMaliciousSmartContractML:
             w3, EOA_ADDRESS, SHORT_CONTRACT, bytecode
         )
         assert len(findings) == 0, "this should not have triggered a finding"
+
+    def test_verdict_cache_key_normalizes_creator(self):
+        agent.initialize()
+        creator_a = "0x" + "11" * 20
+        creator_b = "0x" + "22" * 20
+        code_a = "0x6080604052" + "73" + creator_a[2:] + "5b00" * 40
+        code_b = "0x6080604052" + "73" + creator_b[2:] + "5b00" * 40
+        assert agent.VERDICT_CACHE.get_key(code_a, creator_a) == agent.VERDICT_CACHE.get_key(
+            code_b, creator_b
+        ), "creator address should be normalized out of the key"
+        assert agent.VERDICT_CACHE.get_key(code_a, creator_a) != agent.VERDICT_CACHE.get_key(
+            code_b, creator_a
+        ), "other addresses should be part of the key"
+
+    def test_detect_malicious_contract_verdict_cache_hit(self):
+        agent.initialize()
+        bytecode = w3.eth.get_code(BENIGN_CONTRACT)
+        findings = agent.detect_malicious_token_contract(
+            w3, EOA_ADDRESS, BENIGN_CONTRACT, bytecode
+        )
+        hits = agent.VERDICT_CACHE.hits
+        cached_findings = agent.detect_malicious_token_contract(
+            w3, EOA_ADDRESS, BENIGN_CONTRACT, bytecode
+        )
+        assert agent.VERDICT_CACHE.hits == hits + 1, "second deployment should hit the cache"
+        assert cached_findings[0].alert_id == findings[0].alert_id
+        assert cached_findings[0].metadata["model_score"] == findings[0].metadata["model_score"]
+
+    def test_opcode_tokens_match_get_features(self):
+        for contract in [MALICIOUS_TOKEN_CONTRACT, BENIGN_CONTRACT, CONTRACT_WITH_ADDRESS]:
+            bytecode = w3.eth.get_code(contract)
+            opcodes = EvmBytecode(bytecode.hex()).disassemble()
+            features, addresses = utils.get_features(w3, opcodes, EOA_ADDRESS)
+            address_operands = []
+            tokens = list(iter_opcode_tokens(bytes(bytecode), EOA_ADDRESS, address_operands))
+            assert " ".join(tokens) == features, "streaming tokens should match the disassembled features"
+            assert agent.get_opcode_addresses(w3, address_operands) == addresses
+
+    def test_opcode_vectorizer_score_matches_model(self):
+        agent.initialize()
+        for contract in [MALICIOUS_TOKEN_CONTRACT, BENIGN_CONTRACT]:
+            bytecode = w3.eth.get_code(contract)
+            opcodes = EvmBytecode(bytecode.hex()).disassemble()
+            features, _ = utils.get_features(w3, opcodes, EOA_ADDRESS)
+            expected_score = agent.ML_MODEL.predict_proba([features])[0][1]
+            tokens = iter_opcode_tokens(bytes(bytecode), EOA_ADDRESS, [])
+            assert abs(agent.OPCODE_VECTORIZER.predict_proba(tokens) - expected_score) < 1e-9
+
+    def test_is_contract_batch(self):
+        utils.CONTRACT_CACHE.clear()
+        contracts = utils.is_contract_batch(w3, [CONTRACT_WITH_ADDRESS, EOA_ADDRESS, CONTRACT_WITH_ADDRESS.lower()])
+        assert contracts == {CONTRACT_WITH_ADDRESS: True, EOA_ADDRESS: False}, "addresses should be deduplicated"
+        assert utils.CONTRACT_CACHE[EOA_ADDRESS] is False, "EOA result should be cached"
@@ -5,4 +5,16 @@ SAFE_CONTRACT_THRESHOLD = 0.1  # threshold for labelling safe contract
 BYTE_CODE_LENGTH_THRESHOLD = (
     60  # ignore contracts with byte code length below this threshold
 )
+CONTRACT_CACHE_SIZE = 100000  # how many contract/EOA check results to keep
+RPC_BATCH_SIZE = 100  # how many calls to send in one JSON-RPC batch
+RPC_BATCH_TIMEOUT = 30  # timeout in seconds of the JSON-RPC batch request
+STORAGE_ADDRESSES_CACHE_SIZE = 1000  # how many (contract, block) storage addresses results to keep
+MIN_ADDRESS_NONZERO_BYTES = 10  # storage values with fewer non-zero bytes are not checked for contracts
+RESOLVE_NON_ALERTING_OPCODE_ADDRESSES = False  # the opcode addresses only go to the metadata when the score is between the safe and model thresholds
+MODEL_PATH = "malicious_token_model_02_07_23_exp6.joblib"
+BACKGROUND_MODEL_LOADING = False  # load the model on a background thread; the transactions that need it wait for it
 MASK = "0xffffffffffffffffffffffffffffffffffffffff"
+VERDICT_CACHE_SIZE = 10000  # how many bytecode verdicts to keep
+VERDICT_CACHE_PERSIST_INTERVAL = 100  # persist the verdict cache every this many new verdicts
+VERDICT_CACHE_PERSIST_TIMEOUT = 30  # seconds to wait for the research database when loading or persisting the verdict cache
+VERDICT_CACHE_KEY = "malicious-token-contract-verdict-cache-V1"  # bump when the model changes
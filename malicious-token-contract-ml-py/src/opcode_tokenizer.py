@@ -0,0 +1,129 @@
+from collections import defaultdict, deque
+
+from evmdasm import registry
+from scipy.sparse import csr_matrix
+
+from src.constants import MASK
+
+# opcode -> (feature name, operand length) using the same names as evmdasm, so the features match EvmBytecode(code).disassemble()
+OPCODES = [("UNKNOWN", 0)] * 256
+for _instruction in registry.registry.instructions:
+    OPCODES[_instruction.opcode] = (_instruction.name, _instruction.length_of_operand)
+
+DEFAULT_TOKEN_PATTERN = r"(?u)\b\w\w+\b"
+
+
+def bytecode_to_bytes(code) -> bytes:
+    """
+    this function converts hex string or bytes bytecode to bytes
+    :return: bytecode: bytes
+    """
+    if isinstance(code, str):
+        code = code.strip()
+        return bytes.fromhex(code[2:] if code.startswith("0x") else code)
+    return bytes(code)
+
+
+def iter_opcode_tokens(code: bytes, contract_creator: str, address_operands: list, operand_opcodes=()):
+    """
+    this function decodes the bytecode in one pass and yields the same tokens as get_features, without instruction objects
+    :param address_operands: list where the hex of every 20 bytes operand is appended (candidates for the opcode addresses)
+    :return: tokens: generator of str
+    """
+    pc = 0
+    code_length = len(code)
+    while pc < code_length:
+        opcode_name, operand_length = OPCODES[code[pc]]
+        operand = code[pc + 1 : pc + 1 + operand_length]
+        pc += 1 + operand_length
+        # treat truncated operands at the end of the code as INVALID, as the disassembler does
+        if len(operand) != operand_length:
+            opcode_name = "INVALID"
+        yield opcode_name
+
+        if len(operand) == 20:
+            address_operands.append(operand.hex())
+
+        if opcode_name in operand_opcodes:
+            yield operand.hex()
+        elif opcode_name == "PUSH20":
+            operand_hex = operand.hex()
+            if operand_hex == contract_creator:
+                yield "creator"
+            elif operand_hex == MASK:
+                yield MASK
+            else:
+                yield "addr"
+
+
+class OpcodeVectorizer:
+    """
+    Turns opcode tokens straight into the n-gram counts of the model's vectorizer (first step of the pipeline) and scores
+    them with the rest of the pipeline, without building the space-separated features string. Falls back to the string
+    when the vectorizer is configured in a way it can't reproduce.
+    """
+
+    def __init__(self, model):
+        self.model = model
+        self.vectorizer = None
+        steps = getattr(model, "steps", None)
+        if steps is None or len(steps) < 2:
+            return
+        vectorizer = steps[0][1]
+        if (
+            hasattr(vectorizer, "vocabulary_")
+            and getattr(vectorizer, "analyzer", None) == "word"
+            and vectorizer.tokenizer is None
+            and vectorizer.preprocessor is None
+            and vectorizer.token_pattern == DEFAULT_TOKEN_PATTERN
+            and vectorizer.strip_accents is None
+        ):
+            self.vectorizer = vectorizer
+            self.estimator = model[1:]
+            self.vocabulary = vectorizer.vocabulary_
+            self.min_n, self.max_n = vectorizer.ngram_range
+            self.stop_words = vectorizer.get_stop_words()
+
+    def transform(self, tokens) -> csr_matrix:
+        """
+        this function counts the vocabulary n-grams of the tokens; tokens are words of 2+ characters, so they are the same as the token pattern would split
+        :return: features: csr_matrix
+        """
+        counts = defaultdict(int)
+        window = deque(maxlen=self.max_n)
+        for token in tokens:
+            if self.vectorizer.lowercase:
+                token = token.lower()
+            if self.stop_words is not None and token in self.stop_words:
+                continue
+            window.append(token)
+            window_tokens = list(window)
+            window_length = len(window_tokens)
+            for n in range(self.min_n, min(self.max_n, window_length) + 1):
+                ngram = token if n == 1 else " ".join(window_tokens[window_length - n :])
+                feature_index = self.vocabulary.get(ngram)
+                if feature_index is not None:
+                    counts[feature_index] += 1
+
+        indices = sorted(counts)
+        values = [1 if self.vectorizer.binary else counts[i] for i in indices]
+        features = csr_matrix(
+            (values, indices, [0, len(indices)]),
+            shape=(1, len(self.vocabulary)),
+            dtype=self.vectorizer.dtype,
+        )
+        # TfidfVectorizer applies the idf weights and normalization on top of the counts
+        tfidf = getattr(self.vectorizer, "_tfidf", None)
+        if tfidf is not None:
+            features = tfidf.transform(features, copy=False)
+        return features
+
+    def predict_proba(self, tokens) -> float:
+        """
+        this function scores the tokens
+        :return: score: float
+        """
+        if self.vectorizer is None:
+            return self.model.predict_proba([" ".join(tokens)])[0][1]
+        return self.estimator.predict_proba(self.transform(tokens))[0][1]
+
@@ -3,51 +3,30 @@ import requests
 from web3 import Web3
 
 
-from src.constants import CONTRACT_SLOT_ANALYSIS_DEPTH, MASK
+from src.constants import MASK
+from src.contract_inspection import (  # noqa: F401 re-exported for the agent
+    CONTRACT_CACHE,
+    get_storage_addresses,
+    is_contract,
+    is_contract_batch,
+)
 from src.logger import logger
 
 BOT_ID = "0x887678a85e645ad060b2f096812f7c71e3d20ed6ecf5f3acde6e71baa4cf86ad"
 
 
-def is_contract(w3, address) -> bool:
+def get_opcode_addresses(w3, address_operands) -> set:
     """
-    this function determines whether address is a contract
-    :return: is_contract: bool
+    this function returns the contract addresses among the 20 bytes operands of the opcodes
+    :return: opcode_addresses: set
     """
-    if address is None:
-        return True
-    code = w3.eth.get_code(Web3.toChecksumAddress(address))
-    return code != HexBytes("0x")
-
-
-def get_storage_addresses(w3, address) -> set:
-    """
-    this function returns the addresses that are references in the storage of a contract (first CONTRACT_SLOT_ANALYSIS_DEPTH slots)
-    :return: address_list: list (only returning contract addresses)
-    """
-    if address is None:
-        return set()
-
-    address_set = set()
-    for i in range(CONTRACT_SLOT_ANALYSIS_DEPTH):
-        mem = w3.eth.get_storage_at(Web3.toChecksumAddress(address), i)
-        if mem != HexBytes(
-            "0x0000000000000000000000000000000000000000000000000000000000000000"
-        ):
-            # looking at both areas of the storage slot as - depending on packing - the address could be at the beginning or the end.
-            addr_on_left = mem[0:20].hex()
-            addr_on_right = mem[12:].hex()
-            if is_contract(w3, addr_on_left):
-                address_set.add(Web3.toChecksumAddress(addr_on_left))
-            if is_contract(w3, addr_on_right):
-                address_set.add(Web3.toChecksumAddress(addr_on_right))
-
-    return address_set
+    contracts = is_contract_batch(w3, [f"0x{operand}" for operand in address_operands])
+    return {address for address, contract in contracts.items() if contract}
 
 
 def get_features(w3, opcodes, contract_creator) -> list:
     """
-    this function returns the contract opcodes
+    this function returns the contract opcodes from the disassembled instructions, same tokens as opcode_tokenizer.iter_opcode_tokens
     :return: features: list
     """
     features = []
@@ -1,4 +1,5 @@
 import concurrent.futures
+import threading
 from os import environ
 from joblib import load
 from timeit import default_timer as timer
@@ -7,18 +8,38 @@ import forta_agent
 from forta_agent import get_json_rpc_url, EntityType
 from hexbytes import HexBytes
 
-import pandas as pd
+import numpy as np
 from web3 import Web3
 
 
-from src.utils.constants import MODEL_THRESHOLD, MODEL_FEATURES
+from src.utils.constants import (
+    ANALYSIS_WORKERS,
+    MODEL_THRESHOLD,
+    MODEL_FEATURES,
+    VERDICT_CACHE_MAX_NEW_TXS,
+    VERDICT_CACHE_SIZE,
+    VERDICT_CACHE_STATS_LOG_INTERVAL,
+    VERDICT_CACHE_TTL,
+)
 from src.utils.data_processing import get_features, get_eoa_tx_stats
 from src.utils.findings import EoaScammer
 from src.utils.logger import logger
 from src.utils.storage import get_secrets
+from src.utils.verdict_cache import AddressVerdictCache
 
 SECRETS_JSON = get_secrets()
 ML_MODEL = None
+MODEL_INPUT = threading.local()  # preallocated model input of each analysis thread
+# analyzes the to and from of the txs, for the life of the bot
+ANALYSIS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=ANALYSIS_WORKERS, thread_name_prefix="analysis"
+)
+VERDICT_CACHE = AddressVerdictCache(
+    VERDICT_CACHE_SIZE,
+    VERDICT_CACHE_TTL,
+    VERDICT_CACHE_MAX_NEW_TXS,
+    VERDICT_CACHE_STATS_LOG_INTERVAL,
+)
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
 
 
@@ -46,9 +67,22 @@ def is_eoa(w3, address) -> bool:
     return code == HexBytes("0x")
 
 
+def get_model_input(features) -> np.ndarray:
+    """
+    this function fills the model input buffer of the thread with the features in MODEL_FEATURES order
+    :return: model_input: np.ndarray of shape (1, len(MODEL_FEATURES))
+    """
+    model_input = getattr(MODEL_INPUT, "buffer", None)
+    if model_input is None:
+        model_input = MODEL_INPUT.buffer = np.zeros((1, len(MODEL_FEATURES)))
+    for i, key in enumerate(MODEL_FEATURES):
+        model_input[0, i] = features.get(key, 0)
+    return model_input
+
+
 def get_prediction(address, features) -> tuple:
     start = timer()
-    model_input = pd.DataFrame([{key: features.get(key, 0) for key in MODEL_FEATURES}])
+    model_input = get_model_input(features)
     prediction_score = ML_MODEL.predict_proba(model_input)[0][1]
     prediction = "PHISHING_SCAMMER" if prediction_score >= MODEL_THRESHOLD else "NORMAL"
     end = timer()
@@ -59,55 +93,90 @@ def get_prediction(address, features) -> tuple:
     return prediction_score, prediction, prediction_time
 
 
-def check_scammer(address: str, eoa_stats: dict, chain_id: str):
+def score_address(address: str, eoa_stats: dict) -> dict:
+    """
+    this function generates the features of the address and scores them
+    :return: verdict: dict with the model features, score and prediction, None if the features are incomplete
+    """
     model_features, feature_generation_time = get_features(address, eoa_stats)
-    if model_features is not None:
-        (
-            model_score,
-            prediction_label,
-            pred_response_time,
-        ) = get_prediction(address, model_features)
-        if prediction_label == "PHISHING_SCAMMER":
-            labels = [
-                {
-                    "entity": address,
-                    "entity_type": EntityType.Address,
-                    "label": "scammer-eoa",
-                    "confidence": round(model_score, 3),
-                }
-            ]
-            metadata = {
-                "scammer": address,
-                "feature_generation_time_sec": feature_generation_time,
-                "prediction_time_sec": pred_response_time,
-                "model_score": round(model_score, 3),
+    if model_features is None:
+        return None
+    (
+        model_score,
+        prediction_label,
+        pred_response_time,
+    ) = get_prediction(address, model_features)
+    return {
+        "is_eoa": True,
+        "model_features": model_features,
+        "model_score": model_score,
+        "prediction": prediction_label,
+        "feature_generation_time": feature_generation_time,
+        "prediction_time": pred_response_time,
+    }
+
+
+def check_scammer(address: str, verdict: dict, chain_id: str):
+    if verdict.get("prediction") == "PHISHING_SCAMMER":
+        model_score = verdict["model_score"]
+        labels = [
+            {
+                "entity": address,
+                "entity_type": EntityType.Address,
+                "label": "scammer-eoa",
+                "confidence": round(model_score, 3),
             }
-            metadata.update(
-                {
-                    f"feature_{idx}_{name}": value
-                    for idx, (name, value) in enumerate(model_features.items())
-                    if name in MODEL_FEATURES
-                }
-            )
-            return EoaScammer(metadata, address, labels, chain_id).emit_finding()
+        ]
+        metadata = {
+            "scammer": address,
+            "feature_generation_time_sec": verdict["feature_generation_time"],
+            "prediction_time_sec": verdict["prediction_time"],
+            "model_score": round(model_score, 3),
+        }
+        metadata.update(
+            {
+                f"feature_{idx}_{name}": value
+                for idx, (name, value) in enumerate(verdict["model_features"].items())
+                if name in MODEL_FEATURES
+            }
+        )
+        return EoaScammer(metadata, address, labels, chain_id).emit_finding()
 
 
-def analyze_address(w3, address):
-    finding = None
-    if is_eoa(w3, address):
+def get_verdict(w3, address) -> tuple:
+    """
+    this function determines whether the address is an eoa and scores it
+    :return: verdict: dict or None if it couldn't be scored, zettablock_lookups: int
+    """
+    verdict = {"is_eoa": is_eoa(w3, address)}
+    zettablock_lookups = 0
+    if verdict["is_eoa"]:
         address_start = timer()
         eoa_stats, eoa_lst = get_eoa_tx_stats([address])
+        zettablock_lookups += 1
 
         if address in eoa_lst:
-            finding = check_scammer(
-                address,
-                eoa_stats=eoa_stats[eoa_stats["eoa"] == address],
-                chain_id=w3.eth.chainId,
-            )
+            verdict = score_address(address, eoa_stats=eoa_stats[address])
+            zettablock_lookups += 4
         address_end = timer()
         response_time = round(address_end - address_start, 3)
-        logger.info(f"Finding generation time for {address}: {response_time}sec")
-    return finding
+        logger.info(f"Verdict generation time for {address}: {response_time}sec")
+    return verdict, zettablock_lookups
+
+
+def analyze_address(w3, address):
+    if address is None:
+        return None
+
+    # busy addresses reuse their verdict until it expires or they have VERDICT_CACHE_MAX_NEW_TXS new txs
+    verdict = VERDICT_CACHE.get(address)
+    if verdict is None:
+        verdict, zettablock_lookups = get_verdict(w3, address)
+        if verdict is None:
+            return None  # incomplete features aren't cached, they are retried with the next tx
+        VERDICT_CACHE.put(address, verdict, zettablock_lookups)
+
+    return check_scammer(address, verdict, w3.eth.chainId)
 
 
 def detect_eoa_phishing_scammer(w3, transaction_event):
@@ -123,12 +192,12 @@ def detect_eoa_phishing_scammer(w3, transaction_event):
         functions = [analyze_address, analyze_address]
         function_params = [to_address, from_address]
 
-        with concurrent.futures.ThreadPoolExecutor() as executor:
-            results = list(
-                executor.map(
-                    lambda f, params: f(w3, params), functions, function_params
-                )
+        # analyzed concurrently, so their Zettablock lookups are batched together
+        results = list(
+            ANALYSIS_EXECUTOR.map(
+                lambda f, params: f(w3, params), functions, function_params
             )
+        )
 
         for finding in results:
             if finding is not None:
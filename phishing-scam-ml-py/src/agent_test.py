@@ -1,5 +1,10 @@
+import threading
+from unittest.mock import Mock, patch
+
 from forta_agent import create_transaction_event
 import agent
+from src.utils import data_processing
+from src.utils.verdict_cache import AddressVerdictCache
 
 mock_tx_event = create_transaction_event(
     {
@@ -14,3 +19,64 @@ class TestAnomalousTokenTransfers:
         findings = agent.handle_transaction(mock_tx_event)
 
         assert len(findings) == 0
+
+    def test_zettablock_lookups_batched_and_cached(self):
+        def records(url, query, addresses, query_type):
+            return [{"eoa": address, "to_out_std_val": 1.0} for address in addresses]
+
+        batcher = data_processing.QueryBatcher("TO_OUT", "eoa, to_out_std_val", "To out stats")
+        with patch.object(data_processing, "get_query_id", return_value="1"), patch.object(
+            data_processing, "zettablock_api", side_effect=records
+        ) as mock_zettablock_api:
+            threads = [
+                threading.Thread(target=batcher.get_records, args=(addresses,))
+                for addresses in (["0x1", "0x2"], ["0x2", "0x3"])
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            cached_records = batcher.get_records(["0x3", "0x1"])
+
+        assert mock_zettablock_api.call_count == 1
+        assert sorted(mock_zettablock_api.call_args[0][2]) == ["0x1", "0x2", "0x3"]
+        assert [record["eoa"] for record in cached_records] == ["0x3", "0x1"]
+
+    def test_zettablock_lookup_failure_resolves_waiters(self):
+        batcher = data_processing.QueryBatcher("TO_OUT", "eoa, to_out_std_val", "To out stats")
+        with patch.object(data_processing, "get_query_id", return_value="1"), patch.object(
+            data_processing, "zettablock_api", return_value=[{"to_out_std_val": 1.0}]
+        ):
+            records = batcher.get_records(["0x1", "0x2"])
+
+        assert records == [], "a malformed response should not block or fail the lookup"
+        assert len(batcher.cache) == 0, "failed queries should not be cached"
+
+    def test_verdict_reused_until_new_txs(self):
+        w3 = Mock()
+        verdict_cache = AddressVerdictCache(10, 3600, 2, 0)
+        with patch.object(agent, "VERDICT_CACHE", verdict_cache), patch.object(
+            agent, "get_verdict", return_value=({"is_eoa": False}, 0)
+        ) as mock_get_verdict:
+            for _ in range(4):
+                assert agent.analyze_address(w3, "0xbeef") is None
+
+        # scored, reused for 2 new txs, scored again
+        assert mock_get_verdict.call_count == 2
+        assert verdict_cache.hits == 2
+        assert verdict_cache.misses == 2
+
+    def test_parse_friends(self):
+        friends = data_processing.parse_friends("[0xab12, null, 0xcd34]")
+
+        assert friends.tolist() == ["0xab12", "0xcd34"]
+        assert len(data_processing.parse_friends(0)) == 0
+
+    def test_model_input_in_model_features_order(self):
+        features = {name: i for i, name in enumerate(agent.MODEL_FEATURES) if i != 3}
+
+        model_input = agent.get_model_input(features)
+
+        assert model_input.shape == (1, len(agent.MODEL_FEATURES))
+        assert model_input[0, 3] == 0
+        assert model_input[0, 5] == 5
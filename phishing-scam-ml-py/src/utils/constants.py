@@ -1,5 +1,18 @@
 MODEL_THRESHOLD = 0.5
 
+ANALYSIS_WORKERS = 4  # threads analyzing the to and from addresses of the txs
+STATS_WORKERS = 16  # threads running the friend stats queries of the analyzed addresses
+ZETTABLOCK_POOL_SIZE = 16  # pooled connections to Zettablock
+ZETTABLOCK_BATCH_WINDOW = 0.05  # seconds to wait for the lookups of other threads before querying Zettablock
+ZETTABLOCK_BATCH_SIZE = 500  # max addresses per Zettablock query
+ZETTABLOCK_RESULT_TIMEOUT = 120  # seconds a thread waits for the batched query of its addresses
+STATS_CACHE_TTL = 3600  # seconds the Zettablock records of an address are cached
+STATS_CACHE_SIZE = 100_000  # max addresses cached per Zettablock dataset
+VERDICT_CACHE_SIZE = 100_000  # max addresses whose verdict is cached
+VERDICT_CACHE_TTL = 21600  # seconds an address verdict is reused
+VERDICT_CACHE_MAX_NEW_TXS = 100  # an address is scored again once seen in this many txs since its verdict
+VERDICT_CACHE_STATS_LOG_INTERVAL = 1000  # log the verdict cache stats every N lookups
+
 MODEL_CREATED_TIMESTAMP = "1678286940"  # March 8, 2023 08:49 AM
 MODEL_FEATURES = [
     "in_block_number_std",
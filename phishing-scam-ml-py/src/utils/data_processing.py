@@ -1,9 +1,8 @@
-import ast
 import concurrent.futures
-import random
 import re
+import threading
+import time
 from os import environ
-from functools import lru_cache
 from timeit import default_timer as timer
 
 import backoff
@@ -12,21 +11,43 @@ import requests
 import pandas as pd
 import numpy as np
 
+from src.utils.constants import (
+    STATS_CACHE_SIZE,
+    STATS_CACHE_TTL,
+    STATS_WORKERS,
+    ZETTABLOCK_BATCH_SIZE,
+    ZETTABLOCK_BATCH_WINDOW,
+    ZETTABLOCK_POOL_SIZE,
+    ZETTABLOCK_RESULT_TIMEOUT,
+)
 from src.utils.logger import logger
 from src.utils.storage import get_secrets
 
 query_id_cache = ExpiringDict(max_len=10, max_age_seconds=1800)
 
 MAX_ADDRESSES_PER_QUERY = 110
+ADDRESS_PATTERN = re.compile(r"0x\w+")
+
+# pooled connections to Zettablock, shared by all the queries
+SESSION = requests.Session()
+SESSION.mount(
+    "https://",
+    requests.adapters.HTTPAdapter(
+        pool_connections=ZETTABLOCK_POOL_SIZE, pool_maxsize=ZETTABLOCK_POOL_SIZE
+    ),
+)
+# runs the four friend stats queries of an address concurrently, for the life of the bot
+STATS_EXECUTOR = concurrent.futures.ThreadPoolExecutor(
+    max_workers=STATS_WORKERS, thread_name_prefix="stats"
+)
+MISSING = object()
 
 
-@lru_cache(maxsize=1_000_000)
 @backoff.on_exception(
     backoff.expo, requests.exceptions.RequestException, max_tries=3, jitter=None
 )
-def zettablock_api(url: str, query: str, addresses: str, query_type: str):
-    # converting addresses from str to list because lru cache can only hash strings
-    variables = {"addresses": addresses.split(",")}
+def zettablock_api(url: str, query: str, addresses: list, query_type: str):
+    variables = {"addresses": addresses}
     payload = {"query": query, "variables": variables}
     headers = {
         "accept": "application/json",
@@ -34,14 +55,97 @@ def zettablock_api(url: str, query: str, addresses: str, query_type: str):
         "content-type": "application/json",
     }
     try:
-        response = requests.post(url, json=payload, headers=headers, timeout=30)
+        response = SESSION.post(url, json=payload, headers=headers, timeout=30)
     except requests.exceptions.Timeout:
         logger.info(f"{query_type} query timed out")
-        return []
+        return None
     data = response.json()["data"]["records"]
     return data
 
 
+class QueryBatcher:
+    """
+    Looks up the records of addresses in a Zettablock dataset. The records are cached per address for STATS_CACHE_TTL,
+    and the misses requested by concurrent threads (the to and from of a tx, concurrent txs) within
+    ZETTABLOCK_BATCH_WINDOW are coalesced into queries of up to ZETTABLOCK_BATCH_SIZE addresses: the first thread to miss
+    waits for the window, then queries the addresses missed by all the threads.
+    """
+
+    def __init__(self, query_name: str, fields: str, query_type: str):
+        self.query_name = query_name
+        self.query = f"query($addresses: [String!]!) {{records(filter: {{ eoa: {{ in: $addresses }} }}) {{{fields}}}}}"
+        self.query_type = query_type
+        # address -> record, None for the addresses without a record
+        self.cache = ExpiringDict(max_len=STATS_CACHE_SIZE, max_age_seconds=STATS_CACHE_TTL)
+        self._lock = threading.Lock()
+        self._pending = {}  # address -> future of its record, for the next query
+
+    def get_records(self, addresses) -> list:
+        """
+        this function returns the records of the addresses, from the cache or a batched query
+        :return: records: list of dict, without the addresses that have no record or whose query failed
+        """
+        records = {}
+        futures = {}
+        leader = False
+        with self._lock:
+            for address in addresses:
+                if address in records or address in futures:
+                    continue
+                record = self.cache.get(address, MISSING)
+                if record is not MISSING:
+                    records[address] = record
+                    continue
+                if len(self._pending) == 0:
+                    leader = True
+                if address not in self._pending:
+                    self._pending[address] = concurrent.futures.Future()
+                futures[address] = self._pending[address]
+
+        if leader:
+            time.sleep(ZETTABLOCK_BATCH_WINDOW)
+            self._flush()
+        failed = 0
+        for address, future in futures.items():
+            try:
+                records[address] = future.result(timeout=ZETTABLOCK_RESULT_TIMEOUT)
+            except Exception:
+                # the query failed or is taking too long, the address is treated as having no record
+                records[address] = None
+                failed += 1
+        if failed > 0:
+            logger.warn(f"{self.query_type} lookup of {failed} addresses failed")
+        return [record for record in records.values() if record is not None]
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        addresses = list(pending)
+        for i in range(0, len(addresses), ZETTABLOCK_BATCH_SIZE):
+            batch = addresses[i : i + ZETTABLOCK_BATCH_SIZE]
+            batch_records = {}
+            error = None
+            try:
+                url = f"https://api.zettablock.com/api/v1/dataset/{get_query_id(self.query_name)}/graphql"
+                data = zettablock_api(url, self.query, batch, self.query_type)
+                if data is not None:
+                    batch_records = {record["eoa"]: record for record in data}
+                    # failed queries are not cached
+                    for address in batch:
+                        self.cache[address] = batch_records.get(address)
+                logger.info(f"{self.query_type} query of {len(batch)} addresses, {len(batch_records)} records")
+            except Exception as e:
+                error = e
+                logger.warn(f"{self.query_type} query of {len(batch)} addresses failed: {e!r}")
+            finally:
+                # the futures are always resolved, so the waiting threads are never left blocked
+                for address in batch:
+                    if error is not None:
+                        pending[address].set_exception(error)
+                    else:
+                        pending[address].set_result(batch_records.get(address))
+
+
 def get_query_id(query_name):
     if query_name in query_id_cache:
         return query_id_cache[query_name]
@@ -50,26 +154,35 @@ def get_query_id(query_name):
     return query_id_cache[query_name]
 
 
-def get_eoa_tx_stats(addresses):
-    start = timer()
-    url = (
-        f"https://api.zettablock.com/api/v1/dataset/{get_query_id('EOA_STATS')}/graphql"
-    )
+EOA_STATS_BATCHER = QueryBatcher(
+    "EOA_STATS",
+    "eoa, num_transactions, total_time, total_outgoing_value, total_incoming_value, in_ratio, from_address_nunique, "
+    "from_address_count_unique_ratio, ratio_from_address_nunique, in_block_number_std, unique_from_friends, unique_to_friends",
+    "EOA stats",
+)
+FROM_IN_BATCHER = QueryBatcher("FROM_IN", "eoa, from_in_std_val, from_in_timespan", "From in stats")
+FROM_OUT_BATCHER = QueryBatcher("FROM_OUT", "eoa, from_out_std_block, from_out_std_val", "From out stats")
+TO_IN_BATCHER = QueryBatcher("TO_IN", "eoa, to_in_min_val, to_in_median_val, to_in_std_block", "To in stats")
+TO_OUT_BATCHER = QueryBatcher("TO_OUT", "eoa, to_out_std_val", "To out stats")
 
-    query = "query($addresses: [String!]!) {   records(filter: { eoa: { in: $addresses } }) {     eoa,     num_transactions,     total_time,     total_outgoing_value,     total_incoming_value,     in_ratio,     from_address_nunique,     from_address_count_unique_ratio,     ratio_from_address_nunique,     in_block_number_std,     unique_from_friends,     unique_to_friends   } }"
 
-    data = zettablock_api(url, query, ",".join(addresses), "EOA stats")
-    df = pd.DataFrame(data).fillna(0)
-    eoas = []
-    if len(df) > 0:
-        df["unique_to_friends"] = df["unique_to_friends"].tolist()
-        df["unique_from_friends"] = df["unique_from_friends"].tolist()
-        eoas = df["eoa"].tolist()
+def get_eoa_tx_stats(addresses) -> tuple:
+    """
+    :return: stats: dict eoa -> stats record (missing values as 0), eoas: list
+    """
+    start = timer()
+    stats = {}
+    for record in EOA_STATS_BATCHER.get_records(addresses):
+        # a copy, the record is cached by the batcher
+        stats[record["eoa"]] = {
+            field: 0 if value is None else value for field, value in record.items()
+        }
+    eoas = list(stats)
     end = timer()
     response_time = round(end - start, 3)
     logger.info(f"EOA stats time for {len(addresses)} addresses: {response_time}sec")
 
-    return df, eoas
+    return stats, eoas
 
 
 def get_from_in_stats(addresses):
@@ -78,16 +191,13 @@ def get_from_in_stats(addresses):
         logger.info(
             f"From In Addresses exceeds max addresses per query: {len(addresses)}, truncating to {MAX_ADDRESSES_PER_QUERY}"
         )
-        addresses = random.sample(addresses, MAX_ADDRESSES_PER_QUERY)
+        addresses = np.random.choice(addresses, MAX_ADDRESSES_PER_QUERY, replace=False)
     min_std = 0.0
     median_timespan = 0.0
     if len(addresses) == 0:
         return min_std, median_timespan
 
-    url = f"https://api.zettablock.com/api/v1/dataset/{get_query_id('FROM_IN')}/graphql"
-
-    query = "query($addresses: [String!]!) {records(filter: { eoa: { in: $addresses } }) {eoa, from_in_std_val, from_in_timespan }}"
-    data = zettablock_api(url, query, ",".join(addresses), "From in stats")
+    data = FROM_IN_BATCHER.get_records(addresses)
     df = pd.DataFrame(data).fillna(0)
 
     min_std = np.min(df["from_in_std_val"])
@@ -107,18 +217,13 @@ def get_from_out_stats(addresses):
         logger.info(
             f"From Out Addresses exceeds max addresses per query: {len(addresses)}, truncating to {MAX_ADDRESSES_PER_QUERY}"
         )
-        addresses = random.sample(addresses, MAX_ADDRESSES_PER_QUERY)
+        addresses = np.random.choice(addresses, MAX_ADDRESSES_PER_QUERY, replace=False)
 
     min_std, block_std_median = 0.0, 0.0
     if len(addresses) == 0:
         return min_std, block_std_median
 
-    url = (
-        f"https://api.zettablock.com/api/v1/dataset/{get_query_id('FROM_OUT')}/graphql"
-    )
-
-    query = "query($addresses: [String!]!) {records(filter: { eoa: { in: $addresses } }) {eoa, from_out_std_block, from_out_std_val}}"
-    data = zettablock_api(url, query, ",".join(addresses), "From out stats")
+    data = FROM_OUT_BATCHER.get_records(addresses)
     df = pd.DataFrame(data).fillna(0)
 
     min_std = np.min(df["from_out_std_val"])
@@ -138,7 +243,7 @@ def get_to_in_stats(addresses, total_eth):
         logger.info(
             f"To in Addresses exceeds max addresses per query: {len(addresses)}, truncating to {MAX_ADDRESSES_PER_QUERY}"
         )
-        addresses = random.sample(addresses, MAX_ADDRESSES_PER_QUERY)
+        addresses = np.random.choice(addresses, MAX_ADDRESSES_PER_QUERY, replace=False)
 
     if len(addresses) == 0:
         return dict(
@@ -149,10 +254,7 @@ def get_to_in_stats(addresses, total_eth):
             block_std_median=0.0,
         )
 
-    url = f"https://api.zettablock.com/api/v1/dataset/{get_query_id('TO_IN')}/graphql"
-
-    query = "query($addresses: [String!]!) {records(filter: { eoa: { in: $addresses } }) {eoa, to_in_min_val, to_in_median_val, to_in_std_block }}"
-    data = zettablock_api(url, query, ",".join(addresses), "To in stats")
+    data = TO_IN_BATCHER.get_records(addresses)
     df = pd.DataFrame(data).fillna(0)
 
     sum_median = np.sum(df["to_in_median_val"])
@@ -176,17 +278,14 @@ def get_to_out_stats(addresses):
         logger.info(
             f"To Out Addresses exceeds max addresses per query: {len(addresses)}, truncating to {MAX_ADDRESSES_PER_QUERY}"
         )
-        addresses = random.sample(addresses, MAX_ADDRESSES_PER_QUERY)
+        addresses = np.random.choice(addresses, MAX_ADDRESSES_PER_QUERY, replace=False)
 
     min_std = 0.0
 
     if len(addresses) == 0:
         return min_std
 
-    url = f"https://api.zettablock.com/api/v1/dataset/{get_query_id('TO_OUT')}/graphql"
-
-    query = "query($addresses: [String!]!) {records(filter: { eoa: { in: $addresses } }) {eoa, to_out_std_val }}"
-    data = zettablock_api(url, query, ",".join(addresses), "To out stats")
+    data = TO_OUT_BATCHER.get_records(addresses)
     df = pd.DataFrame(data).fillna(0)
 
     min_std = np.min(df["to_out_std_val"])
@@ -197,18 +296,22 @@ def get_to_out_stats(addresses):
     return min_std
 
 
-def convert_str_to_list(val):
-    lst = ast.literal_eval(
-        re.sub(r"0x\w+", lambda m: f'"{m.group(0)}"', val.replace("null", "None"))
-    )
-    return [v for v in lst if v is not None]
+def parse_friends(val) -> np.ndarray:
+    """
+    this function extracts the friend addresses from a friend list of the EOA stats (e.g. "[0xab.., null, 0xcd..]") with
+    a compiled pattern, skipping the nulls
+    :return: friend addresses: np.ndarray of str
+    """
+    if not isinstance(val, str):
+        return np.array([], dtype=str)
+    return np.array(ADDRESS_PATTERN.findall(val), dtype=str)
 
 
-def get_features(address, eoa_stats) -> tuple:
+def get_features(address, eoa_stats: dict) -> tuple:
     start = timer()
-    data = eoa_stats.iloc[0].to_dict()
-    to_friends = convert_str_to_list(data["unique_to_friends"])
-    from_friends = convert_str_to_list(data["unique_from_friends"])
+    data = eoa_stats
+    to_friends = parse_friends(data["unique_to_friends"])
+    from_friends = parse_friends(data["unique_from_friends"])
     total_eth = data["total_incoming_value"] + data["total_outgoing_value"]
 
     del data["total_incoming_value"]
@@ -230,42 +333,41 @@ def get_features(address, eoa_stats) -> tuple:
         {"addresses": to_friends},
     ]
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        try:
-            results = list(
-                executor.map(lambda f, params: f(**params), functions, function_params)
-            )
-
-            # get from_in ML features
-            (
-                data["from_in_min_std"],
-                data["from_in_block_timespan_median"],
-            ) = results[0]
-
-            # get from_out ML features
-            (
-                data["from_out_min_std"],
-                data["from_out_block_std_median"],
-            ) = results[1]
-
-            # get to_in ML features
-            to_in_stats = results[2]
-            data["to_in_sum_min"] = to_in_stats["sum_min"]
-            data["to_in_sum_median"] = to_in_stats["sum_median"]
-            data["to_in_sum_median_ratio"] = to_in_stats["sum_median_ratio"]
-            data["to_in_min_min"] = to_in_stats["min_min"]
-            data["to_in_block_std_median"] = to_in_stats["block_std_median"]
-
-            # get to_out ML features
-            data["to_out_min_std"] = results[3]
-        except KeyError as e:
-            logger.warn(f"incomplete features for {address} {e}: {data}")
-            data = None
-
-        end = timer()
-        feature_generation_response_time_sec = end - start
-        logger.info(
-            f"Feature generation time for {address}: {feature_generation_response_time_sec}"
+    try:
+        results = list(
+            STATS_EXECUTOR.map(lambda f, params: f(**params), functions, function_params)
         )
 
-        return data, feature_generation_response_time_sec
+        # get from_in ML features
+        (
+            data["from_in_min_std"],
+            data["from_in_block_timespan_median"],
+        ) = results[0]
+
+        # get from_out ML features
+        (
+            data["from_out_min_std"],
+            data["from_out_block_std_median"],
+        ) = results[1]
+
+        # get to_in ML features
+        to_in_stats = results[2]
+        data["to_in_sum_min"] = to_in_stats["sum_min"]
+        data["to_in_sum_median"] = to_in_stats["sum_median"]
+        data["to_in_sum_median_ratio"] = to_in_stats["sum_median_ratio"]
+        data["to_in_min_min"] = to_in_stats["min_min"]
+        data["to_in_block_std_median"] = to_in_stats["block_std_median"]
+
+        # get to_out ML features
+        data["to_out_min_std"] = results[3]
+    except KeyError as e:
+        logger.warn(f"incomplete features for {address} {e}: {data}")
+        data = None
+
+    end = timer()
+    feature_generation_response_time_sec = end - start
+    logger.info(
+        f"Feature generation time for {address}: {feature_generation_response_time_sec}"
+    )
+
+    return data, feature_generation_response_time_sec
@@ -0,0 +1,63 @@
+import threading
+import time
+from collections import OrderedDict
+
+from src.utils.logger import logger
+
+
+class AddressVerdictCache:
+    """
+    LRU cache of the verdicts of the analyzed addresses (whether it is an eoa, the model score and the features it was
+    scored with), so busy addresses skip is_eoa and the Zettablock lookups. A verdict is reused until it is older than ttl
+    seconds or the address was seen in max_new_txs more txs since it was scored, as its stats drift with its activity.
+    """
+
+    def __init__(self, max_size: int, ttl: int, max_new_txs: int, stats_log_interval: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.max_new_txs = max_new_txs
+        self.stats_log_interval = stats_log_interval
+        self.verdicts = OrderedDict()  # address -> [verdict, scored at, new txs, zettablock lookups]
+        self.hits = 0
+        self.misses = 0
+        self.avoided_zettablock_lookups = 0
+        self._lock = threading.Lock()
+
+    def get(self, address: str):
+        """
+        this function returns the verdict of the address, counting the lookup as a new tx of the address
+        :return: verdict: dict or None
+        """
+        with self._lock:
+            entry = self.verdicts.get(address)
+            if entry is not None:
+                entry[2] += 1
+                if time.time() - entry[1] > self.ttl or entry[2] > self.max_new_txs:
+                    del self.verdicts[address]
+                    entry = None
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.avoided_zettablock_lookups += entry[3]
+                self.verdicts.move_to_end(address)
+            if self.stats_log_interval > 0 and (self.hits + self.misses) % self.stats_log_interval == 0:
+                logger.info(self.stats())
+        return entry[0] if entry is not None else None
+
+    def put(self, address: str, verdict: dict, zettablock_lookups: int):
+        with self._lock:
+            self.verdicts[address] = [verdict, time.time(), 0, zettablock_lookups]
+            self.verdicts.move_to_end(address)
+            if len(self.verdicts) > self.max_size:
+                self.verdicts.popitem(last=False)
+
+    def hit_ratio(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups > 0 else 0.0
+
+    def stats(self) -> str:
+        return (
+            f"verdict cache size={len(self.verdicts)} hits={self.hits} misses={self.misses} "
+            f"hit_ratio={self.hit_ratio():.2%} avoided_zettablock_lookups={self.avoided_zettablock_lookups}"
+        )
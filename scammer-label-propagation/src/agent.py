@@ -2,14 +2,19 @@ import logging
 from datetime import datetime
 import os
 import random
+import threading
 import time
 import forta_agent
 from web3 import Web3
 from forta_agent import get_json_rpc_url, Finding
-from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import torch
 
 from src.main import run_all
-from src.constants import attacker_bots, ATTACKER_CONFIDENCE, N_WORKERS, MAX_FINDINGS, HOURS_BEFORE_REANALYZE, PERCENTAGE_ATTACKERS, MAX_FINDINGS_PER_ADDRESS
+from src.constants import (attacker_bots, ATTACKER_CONFIDENCE, N_WORKERS, MAX_FINDINGS, HOURS_BEFORE_REANALYZE, PERCENTAGE_ATTACKERS,
+                           MAX_FINDINGS_PER_ADDRESS, PROCESS_POOL, PROCESS_POOL_MAX_RETRIES, TORCH_THREADS_PER_WORKER)
 from src.storage import get_secrets, dynamo_table
 
 
@@ -25,21 +30,118 @@ else:
 logger = logging.getLogger(__name__)
 
 web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
+process_executor = None
+process_executor_lock = threading.Lock()
+
+
+def get_torch_threads():
+    """
+    this function returns the torch threads of each process of the pool, so the processes together use all the cores
+    :return: torch_threads: int
+    """
+    if TORCH_THREADS_PER_WORKER > 0:
+        return TORCH_THREADS_PER_WORKER
+    return max(1, (os.cpu_count() or 1) // N_WORKERS)
+
+
+def initialize_worker(worker_secrets):
+    """
+    this function initializes each process of the pool. The model is loaded once per process, when it imports src.main,
+    and the cores are split between the processes
+    """
+    global secrets
+    secrets = worker_secrets
+    torch.set_num_threads(get_torch_threads())
+
+
+def dataframe_to_records(df):
+    """
+    this function converts the attackers DataFrame to a list of records, with the address in the 'address' key
+    :return: records: list of dict
+    """
+    return [{'address': address, **record} for address, record in zip(df.index, df.to_dict('records'))]
+
+
+def run_all_records(central_node):
+    """
+    this function runs the whole pipeline in a process of the pool. The results are returned as records instead of
+    DataFrames, as they are pickled back to the agent
+    :return: attackers: list of dict, graph_statistics: dict, attackers_global: list of dict
+    """
+    attackers_df, graph_statistics, attackers_df_global = run_all(central_node, secrets=secrets, web3=web3)
+    return dataframe_to_records(attackers_df), graph_statistics, dataframe_to_records(attackers_df_global)
+
+
+def create_process_executor():
+    """
+    this function creates the process pool. Spawned processes don't inherit the torch thread pools of the agent
+    :return: process_executor: ProcessPoolExecutor
+    """
+    return ProcessPoolExecutor(max_workers=N_WORKERS, mp_context=multiprocessing.get_context('spawn'),
+                               initializer=initialize_worker, initargs=(secrets,))
+
+
+def replace_broken_process_executor(broken_executor):
+    """
+    this function replaces the process pool after one of its processes died, which breaks the pool for all its futures.
+    The threads waiting on the same broken pool call it at the same time, only the first one replaces it
+    :param broken_executor: the pool that raised BrokenProcessPool
+    """
+    global process_executor
+    with process_executor_lock:
+        if process_executor is broken_executor:
+            broken_executor.shutdown(wait=False)
+            process_executor = create_process_executor()
+            logger.warning(f"Process pool was broken, started a new one with {N_WORKERS} workers")
+
+
+def run_in_process_pool(central_node):
+    """
+    this function runs the pipeline of an address in the process pool, on a new pool if a process of the pool died
+    :param central_node: address to analyze
+    :return: attackers: list of dict, graph_statistics: dict, attackers_global: list of dict
+    """
+    for n in range(PROCESS_POOL_MAX_RETRIES + 1):
+        executor_used = process_executor
+        try:
+            return executor_used.submit(run_all_records, central_node).result()
+        except BrokenProcessPool:
+            replace_broken_process_executor(executor_used)
+            if n == PROCESS_POOL_MAX_RETRIES:
+                raise
+            logger.warning(f"{central_node}:\tProcess pool was broken, retrying #{n + 1}")
 
 
 def run_all_extended(central_node, alert_event, web3):
     global secrets
     try:
-        attackers_df, graph_statistics, attackers_df_global = run_all(central_node, secrets=secrets, web3=web3)
+        if PROCESS_POOL:
+            # This thread only waits for the process, so the futures in global_futures are the same in both modes
+            attackers, graph_statistics, attackers_global = run_in_process_pool(central_node)
+        else:
+            attackers_df, graph_statistics, attackers_df_global = run_all(central_node, secrets=secrets, web3=web3)
+            attackers, attackers_global = dataframe_to_records(attackers_df), dataframe_to_records(attackers_df_global)
     except Warning as w:
         logger.warning(f"{central_node}:\tWarning running run_all in a thread: {w}")
         return []
+    except BrokenProcessPool as e:
+        # the address may be what kills the processes, it is skipped instead of failing the scan
+        logger.error(f"{central_node}:\tSkipped, the process pool broke {PROCESS_POOL_MAX_RETRIES + 1} times analyzing it: {e}")
+        return []
     except Exception as e:
         logger.error(f"{central_node}:\tError running run_all in a thread: {e}", exc_info=True)
         # We need to raise the exception to expose error to the scan node
         if 'production' in os.environ.get('NODE_ENV', ''):
             raise e
         return []
+    return build_findings(central_node, alert_event, attackers, graph_statistics, attackers_global)
+
+
+def build_findings(central_node, alert_event, attackers, graph_statistics, attackers_global):
+    """
+    this function builds the findings of the new attackers found by the individual and the global model
+    :return: findings: list of Finding
+    """
     # Now we put things into a list of findings
     all_findings_list = []
     finding_dict = {
@@ -50,15 +152,14 @@ def run_all_extended(central_node, alert_event, web3):
             'type': forta_agent.FindingType.Scam
         }
     logger.info(f"{central_node}:\t{graph_statistics} new attackers found")
-    # if attackers_df.shape[0] > MAX_FINDINGS:
-    #     logger.info(f"{central_node}:\tToo many attackers found: {attackers_df.shape[0]}")
-    # if attackers_df.shape[0] >= int(PERCENTAGE_ATTACKERS * graph_statistics['n_nodes']):
-    #     logger.info(f"{central_node}:\tToo many attackers found in relation to the graph. Lowering confidencce: {attackers_df.shape[0]}")
+    # if len(attackers) > MAX_FINDINGS:
+    #     logger.info(f"{central_node}:\tToo many attackers found: {len(attackers)}")
+    # if len(attackers) >= int(PERCENTAGE_ATTACKERS * graph_statistics['n_nodes']):
+    #     logger.info(f"{central_node}:\tToo many attackers found in relation to the graph. Lowering confidencce: {len(attackers)}")
     #     finding_dict['severity'] = forta_agent.FindingSeverity.Medium
     # We will only consider the model as working if it has less or equal than MAX_FINDINGS_PER_ADDRESS findings. Otherwise we remove all findings
-    if attackers_df.shape[0] <= MAX_FINDINGS_PER_ADDRESS:
-        for row_idx in range(attackers_df.shape[0]):
-            attacker_info = attackers_df.iloc[row_idx]
+    if len(attackers) <= MAX_FINDINGS_PER_ADDRESS:
+        for attacker_info in attackers:
             logger.info(f'{central_node}:\tNew attacker info: {attacker_info}')
             metadata = {
                     'central_node': central_node,
@@ -69,7 +170,7 @@ def run_all_extended(central_node, alert_event, web3):
                     'model_confidence': attacker_info['n_predicted_attacker']/10 * attacker_info['mean_probs_attacker'],
                 }
             label_dict = {
-                'entity': attacker_info.name,
+                'entity': attacker_info['address'],
                 'label': 'scammer-eoa',
                 'confidence': attacker_info['n_predicted_attacker']/10 * attacker_info['mean_probs_attacker'],
                 'entity_type': forta_agent.EntityType.Address,
@@ -77,11 +178,11 @@ def run_all_extended(central_node, alert_event, web3):
             }
             finding_dict['labels'] = [forta_agent.Label(label_dict)]
             finding_dict['metadata'] = metadata
-            finding_dict['description'] = f"{attacker_info.name} marked as scammer by label propagation"
-            finding_dict['addresses'] = [attacker_info.name, central_node]
+            finding_dict['description'] = f"{attacker_info['address']} marked as scammer by label propagation"
+            finding_dict['addresses'] = [attacker_info['address'], central_node]
             all_findings_list.append(Finding(finding_dict))
     else:
-        logger.info(f"{central_node}:\tToo many attackers found: {attackers_df.shape[0]}. Not adding any findings")
+        logger.info(f"{central_node}:\tToo many attackers found: {len(attackers)}. Not adding any findings")
     if alert_event.alert.alert_id in ['SCAM-DETECTOR-NATIVE-ICE-PHISHING']:
         logger.info(f"{central_node}:\tAlert {alert_event.alert.alert_id} is a native ice phishing alert. Not running global model")
         return all_findings_list
@@ -92,12 +193,11 @@ def run_all_extended(central_node, alert_event, web3):
     finding_dict_global['description'] = 'Address marked as scammer by label propagation (global model)'
     # Restarting severity
     finding_dict_global['severity'] = forta_agent.FindingSeverity.High
-    # if attackers_df_global.shape[0] >= int(PERCENTAGE_ATTACKERS * graph_statistics['n_nodes']):
-    #     logger.info(f"{central_node}:\tToo many attackers found in relation to the graph for global model. Lowering confidencce: {attackers_df_global.shape[0]}")
+    # if len(attackers_global) >= int(PERCENTAGE_ATTACKERS * graph_statistics['n_nodes']):
+    #     logger.info(f"{central_node}:\tToo many attackers found in relation to the graph for global model. Lowering confidencce: {len(attackers_global)}")
     #     finding_dict_global['severity'] = forta_agent.FindingSeverity.Medium
-    if attackers_df_global.shape[0] <= MAX_FINDINGS_PER_ADDRESS:
-        for row_idx in range(attackers_df_global.shape[0]):
-            attacker_info = attackers_df_global.iloc[row_idx]
+    if len(attackers_global) <= MAX_FINDINGS_PER_ADDRESS:
+        for attacker_info in attackers_global:
             logger.info(f'{central_node}:\tNew attacker info global: {attacker_info}')
             metadata = {
                     'central_node': central_node,
@@ -108,7 +208,7 @@ def run_all_extended(central_node, alert_event, web3):
                     'model_confidence': str(attacker_info['p_attacker']),
                 }
             label_dict = {
-                    'entity': attacker_info.name,
+                    'entity': attacker_info['address'],
                     'label': 'scammer-eoa',
                     'confidence': str(attacker_info['p_attacker']),
                     'entity_type': forta_agent.EntityType.Address,
@@ -116,11 +216,11 @@ def run_all_extended(central_node, alert_event, web3):
                 }
             finding_dict_global['labels'] = [forta_agent.Label(label_dict)]
             finding_dict_global['metadata'] = metadata
-            finding_dict_global['description'] = f"{attacker_info.name} marked as scammer by label propagation (global model)"
-            finding_dict_global['addresses'] = [attacker_info.name, central_node]
+            finding_dict_global['description'] = f"{attacker_info['address']} marked as scammer by label propagation (global model)"
+            finding_dict_global['addresses'] = [attacker_info['address'], central_node]
             all_findings_list.append(Finding(finding_dict_global))
     else:
-        logger.info(f"{central_node}:\tToo many attackers found for global model: {attackers_df_global.shape[0]}. Not adding any findings")
+        logger.info(f"{central_node}:\tToo many attackers found for global model: {len(attackers_global)}. Not adding any findings")
     return all_findings_list
         
         
@@ -135,6 +235,10 @@ def initialize():
     secrets = get_secrets()
     global dynamo
     dynamo = dynamo_table(secrets)
+    global process_executor
+    if PROCESS_POOL and process_executor is None:
+        process_executor = create_process_executor()
+        logger.info(f"Started process pool with {N_WORKERS} workers and {get_torch_threads()} torch threads per worker")
 
     subscription_json = []
     global CHAIN_ID
@@ -0,0 +1,103 @@
+import hashlib
+import logging
+import os
+import time
+
+import pandas as pd
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def get_digest(*objects) -> str:
+    """
+    Returns a digest of DataFrames, dicts of DataFrames and other picklable objects, to detect changes in the inputs
+    of an analysis
+    :return: str with the hex digest
+    """
+    digest = hashlib.sha256()
+    for obj in objects:
+        if isinstance(obj, dict):
+            for key in sorted(obj.keys()):
+                digest.update(str(key).encode())
+                digest.update(get_digest(obj[key]).encode())
+        elif isinstance(obj, pd.DataFrame):
+            digest.update(str(list(obj.columns)).encode())
+            digest.update(pd.util.hash_pandas_object(obj, index=True).values.tobytes())
+        else:
+            digest.update(repr(obj).encode())
+    return digest.hexdigest()
+
+
+class AnalysisStore:
+    """
+    Persists the last analysis of each central node in a local directory, so a re-analysis within ttl seconds reuses
+    it: the graph if the collected data didn't change, the fold weights to warm-start the training, and the results if
+    neither the data nor the labels changed. There is one file per central node, written atomically, so the processes
+    of the pool can share the directory. Each save sweeps the expired files and, above max_entries, the least recently
+    saved ones, so the directory doesn't grow without bound.
+    """
+
+    def __init__(self, path, ttl, max_entries):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        os.makedirs(path, exist_ok=True)
+
+    def _file(self, central_node):
+        return os.path.join(self.path, f'{central_node}.pt')
+
+    def load(self, central_node):
+        """
+        Returns the last analysis of the central node, None if there is none or it expired
+        :param central_node: str
+        :return: dict or None
+        """
+        file = self._file(central_node)
+        try:
+            if time.time() - os.path.getmtime(file) > self.ttl:
+                os.remove(file)
+                return None
+            return torch.load(file)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"{central_node}:\tError loading the previous analysis: {e}")
+            return None
+
+    def save(self, central_node, analysis):
+        """
+        :param central_node: str
+        :param analysis: dict with the digests, graph, labels, fold weights and predictions, and results
+        """
+        file = self._file(central_node)
+        temp_file = f'{file}.{os.getpid()}.tmp'
+        torch.save(analysis, temp_file)
+        os.replace(temp_file, file)
+        self.sweep()
+
+    def sweep(self):
+        """
+        Deletes the files older than ttl, including the temporary files of interrupted saves, and the oldest analyses
+        above max_entries
+        """
+        now = time.time()
+        analyses = []
+        with os.scandir(self.path) as entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime
+                    if now - mtime > self.ttl:
+                        os.remove(entry.path)
+                    elif entry.name.endswith('.pt'):
+                        analyses.append((mtime, entry.path))
+                except FileNotFoundError:
+                    # Already removed by another process of the pool
+                    pass
+        if self.max_entries > 0 and len(analyses) > self.max_entries:
+            analyses.sort()
+            for _, file in analyses[:len(analyses) - self.max_entries]:
+                try:
+                    os.remove(file)
+                except FileNotFoundError:
+                    pass
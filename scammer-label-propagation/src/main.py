@@ -1,6 +1,7 @@
 import logging
 import os
 import pickle
+import time
 import numpy as np
 import pandas as pd
 import torch
@@ -8,17 +9,20 @@ from forta_agent import get_json_rpc_url
 from hexbytes import HexBytes
 from web3 import Web3
 
+from src.analysis_store import AnalysisStore, get_digest
 from src.constants import (ATTACKER_CONFIDENCE, MIN_FOLDS_ATTACKER, N_FOLDS,
-                           PREDICTED_ATTACKER_CONFIDENCE, VICTIM_SAMPLING, SEED, MAX_NEIGHBORS_INDIVIDUAL_MODEL)
+                           PREDICTED_ATTACKER_CONFIDENCE, VICTIM_SAMPLING, SEED, MAX_NEIGHBORS_INDIVIDUAL_MODEL,
+                           ANALYSIS_STORE_PATH, ANALYSIS_STORE_MAX_ENTRIES, HOURS_BEFORE_REANALYZE, GLOBAL_MODEL_FIRST,
+                           GLOBAL_UNCERTAIN_MIN_PROBABILITY, WARM_START_EPOCHS)
 from src.model.aux import cross_entropy_masked
-from src.model.model import ModelAttention, ModelAttentionMultiHead
-from src.model.train import prepare_graph_and_train, prepare_graph_and_predict
+from src.model.train import GLOBAL_MODEL_BATCHER, prepare_graph_and_train_folds, prepare_graph_and_predict
 from src.preprocessing.get_data import (collect_data_parallel_parts, collect_data_zettablock,
-                                        download_labels_graphql,
+                                        download_labels_graphql, get_attacker_neighbors, get_attackers_list,
                                         get_automatic_labels)
 from src.preprocessing.process_data import prepare_data
 
 logger = logging.getLogger(__name__)
+analysis_store = None
 
 
 def run_all(central_node, secrets, web3):
@@ -30,8 +34,6 @@ def run_all(central_node, secrets, web3):
     central_node = central_node.lower()
     logger.info(f"{central_node}:\tStart processing")
 
-    # model_type = ModelAttention
-    model_type = ModelAttentionMultiHead
     loss_function = cross_entropy_masked
 
     # data = collect_data_parallel_parts(central_node)
@@ -41,41 +43,88 @@ def run_all(central_node, secrets, web3):
         node_path = os.path.join(data_path, f'{central_node}.pkl')
         with open(node_path, 'wb') as f:
             pickle.dump(data, f)
-    all_nodes_dict, node_feature, transactions_overview, edge_indexes, edge_features = prepare_data(data)
+    # A re-analysis reuses the previous analysis of the address as far as its inputs didn't change
+    previous_analysis = get_analysis_store().load(central_node) if ANALYSIS_STORE_PATH else None
+    data_digest = get_digest(data)
+    if previous_analysis is not None and previous_analysis['data_digest'] == data_digest:
+        logger.info(f"{central_node}:\tData unchanged since the previous analysis, reusing its graph")
+        all_nodes_dict, node_feature, transactions_overview, edge_indexes, edge_features = previous_analysis['graph']
+    else:
+        all_nodes_dict, node_feature, transactions_overview, edge_indexes, edge_features = prepare_data(data)
     labels_df = download_labels_graphql(all_nodes_dict, central_node)
+    labels_digest = get_digest(labels_df)
+    if (previous_analysis is not None and previous_analysis['data_digest'] == data_digest
+            and previous_analysis['labels_digest'] == labels_digest):
+        logger.info(f"{central_node}:\tData and labels unchanged since the previous analysis, reusing its results")
+        return previous_analysis['results']
+    # The global model doesn't depend on the labels. With GLOBAL_MODEL_FIRST it runs first, batched with the graphs of
+    # the other addresses being analyzed, and the individual models only decide the nodes it is uncertain about
+    predictions_global_model = prepare_graph_and_predict(node_feature, edge_indexes, edge_features,
+                                                         batcher=GLOBAL_MODEL_BATCHER if GLOBAL_MODEL_FIRST else None)
+    uncertain_nodes = None
+    if GLOBAL_MODEL_FIRST:
+        p_attacker = predictions_global_model[:, 1].numpy()
+        uncertain = (p_attacker >= GLOBAL_UNCERTAIN_MIN_PROBABILITY) & (p_attacker < PREDICTED_ATTACKER_CONFIDENCE)
+        uncertain_nodes = set(np.array(list(all_nodes_dict.keys()))[uncertain]) - set(get_attackers_list(labels_df, ATTACKER_CONFIDENCE))
+        logger.info(f"{central_node}:\t{len(uncertain_nodes)} nodes in the uncertainty band of the global model")
     np.random.seed(SEED)
+    # The nodes that sent transactions to an attacker are the candidate victims of every fold
+    attacker_neighbors = get_attacker_neighbors(all_nodes_dict, transactions_overview, labels_df,
+                                                attacker_confidence=ATTACKER_CONFIDENCE)
     # web3 = Web3(Web3.HTTPProvider(get_json_rpc_url()))
-    if len(all_nodes_dict) >= MAX_NEIGHBORS_INDIVIDUAL_MODEL:
-        logger.info(f"{central_node}:\tToo many neighbors for individual model ({len(all_nodes_dict)}), using only global model")
+    global_model_decides = uncertain_nodes is not None and len(uncertain_nodes) == 0
+    if len(all_nodes_dict) >= MAX_NEIGHBORS_INDIVIDUAL_MODEL or global_model_decides:
+        if global_model_decides:
+            logger.info(f"{central_node}:\tThe global model is certain about every node, using only global model")
+        else:
+            logger.info(f"{central_node}:\tToo many neighbors for individual model ({len(all_nodes_dict)}), using only global model")
         filtered_attackers_df = pd.DataFrame(columns=['n_predicted_attacker', 'mean_probs_victim', 'mean_probs_attacker'])
         labels_torch, automatic_labels = get_automatic_labels(
                 all_nodes_dict, transactions_overview, central_node, labels_df,
-                attacker_confidence=ATTACKER_CONFIDENCE, victim_sampling=VICTIM_SAMPLING)
+                attacker_confidence=ATTACKER_CONFIDENCE, victim_sampling=VICTIM_SAMPLING,
+                attacker_neighbors=attacker_neighbors)
         original_attackers = [address for address, label in automatic_labels.items() if label == 'attacker']
+        labels_folds, folds_state, folds_trained_at, fold_predictions = [], None, None, None
     else:
-        all_results = []
+        labels_folds = []
         for _ in range(N_FOLDS):
             labels_torch, automatic_labels = get_automatic_labels(
                 all_nodes_dict, transactions_overview, central_node, labels_df,
-                attacker_confidence=ATTACKER_CONFIDENCE, victim_sampling=VICTIM_SAMPLING)
-            
-            model, predictions_every_ten, _ = prepare_graph_and_train(
-                node_feature, edge_indexes, edge_features, model_type, loss_function, labels_torch)
-            all_results.append({'automatic_labels': automatic_labels, 'model': model,
-                                'predictions_every_ten': predictions_every_ten[-1]})
-        n_predicted_attacker = torch.sum(torch.stack(
-            [torch.argmax(all_results[i]['predictions_every_ten'], axis=1) for i in range(len(all_results))], axis=1), axis=1) # type: ignore
-        mean_probs = torch.mean(torch.stack([all_results[i]['predictions_every_ten'] for i in range(len(all_results))]), axis=0) # type: ignore
+                attacker_confidence=ATTACKER_CONFIDENCE, victim_sampling=VICTIM_SAMPLING,
+                attacker_neighbors=attacker_neighbors)
+            labels_folds.append(labels_torch)
+        # The folds are trained together on the same graph. They are warm-started for WARM_START_EPOCHS from the weights
+        # of the last full training of the address if it is younger than HOURS_BEFORE_REANALYZE. The warm-started
+        # weights are not stored, so the next re-analyses start from the same full training and don't pile up epochs
+        previous_folds_state = None
+        if (previous_analysis is not None and previous_analysis.get('folds_trained_at') is not None
+                and time.time() - previous_analysis['folds_trained_at'] <= HOURS_BEFORE_REANALYZE * 3600):
+            previous_folds_state = previous_analysis['folds_state']
+        if previous_folds_state is not None:
+            folds_model, fold_predictions, epochs_trained = prepare_graph_and_train_folds(
+                node_feature, edge_indexes, edge_features, loss_function, labels_folds,
+                epochs=WARM_START_EPOCHS, initial_state=previous_folds_state)
+            folds_state, folds_trained_at = previous_folds_state, previous_analysis['folds_trained_at']
+        else:
+            folds_model, fold_predictions, epochs_trained = prepare_graph_and_train_folds(
+                node_feature, edge_indexes, edge_features, loss_function, labels_folds)
+            folds_state, folds_trained_at = folds_model.state_dict(), time.time()
+        logger.info(f"{central_node}:	Folds trained for {epochs_trained.tolist()} epochs{' (warm start)' if previous_folds_state is not None else ''}")
+        n_predicted_attacker = torch.sum(torch.argmax(fold_predictions, axis=2), axis=0) # type: ignore
+        mean_probs = torch.mean(fold_predictions, axis=0) # type: ignore
         all_results_df = pd.DataFrame(
             {'n_predicted_attacker': n_predicted_attacker, 'mean_probs_victim': mean_probs[:, 0], 
             'mean_probs_attacker': mean_probs[:, 1]},
-            index=all_results[0]['automatic_labels'].keys())
+            index=all_nodes_dict.keys())
         all_attackers_df = all_results_df[all_results_df['n_predicted_attacker']>= MIN_FOLDS_ATTACKER]
         original_attackers = [address for address, label in automatic_labels.items() if label == 'attacker']
         # Filtering for the ones that were originally not attackers
         filtered_attackers_df = all_attackers_df.loc[~all_attackers_df.index.isin(original_attackers)]
         # filtering for the average prediction confidence
         filtered_attackers_df = filtered_attackers_df[filtered_attackers_df['mean_probs_attacker'] >= PREDICTED_ATTACKER_CONFIDENCE]
+        if uncertain_nodes is not None:
+            # The global model decides the rest of the nodes
+            filtered_attackers_df = filtered_attackers_df.loc[filtered_attackers_df.index.isin(uncertain_nodes)]
         # Missing checking which of those are contracts
         attackers_not_contracts = []
         for address in list(filtered_attackers_df.index):
@@ -92,7 +141,6 @@ def run_all(central_node, secrets, web3):
         'n_labeled_victims_extended': len([label for label in automatic_labels.values() if label == 'victim']),
         'n_addresses_with_any_label': labels_df.shape[0],
     }
-    predictions_global_model = prepare_graph_and_predict(node_feature, edge_indexes, edge_features, labels_torch)
     results_global_model = pd.DataFrame(predictions_global_model.numpy(), index=all_nodes_dict.keys(), columns=['p_victim', 'p_attacker'])
     if results_global_model.loc[central_node].shape[0] == 0:
         logger.info(f"{central_node}:\tThe global model did not predict the central node")
@@ -105,7 +153,30 @@ def run_all(central_node, secrets, web3):
     results_global_model = results_global_model.loc[attackers_not_contracts_global]
     graph_statistics['n_predicted_attackers_global_model'] = results_global_model.shape[0]
     logger.info(f"{central_node}:\tFinished processing: {results_global_model.shape[0]} attackers found with global model")
-    return filtered_attackers_df, graph_statistics, results_global_model
+    results = filtered_attackers_df, graph_statistics, results_global_model
+    if ANALYSIS_STORE_PATH:
+        get_analysis_store().save(central_node, {
+            'data_digest': data_digest,
+            'labels_digest': labels_digest,
+            'graph': (all_nodes_dict, node_feature, transactions_overview, edge_indexes, edge_features),
+            'labels_folds': labels_folds,
+            'folds_state': folds_state,
+            'folds_trained_at': folds_trained_at,
+            'fold_predictions': fold_predictions,
+            'results': results,
+        })
+    return results
+
+
+def get_analysis_store():
+    """
+    Returns the analysis store of the process, opening it on the first call
+    :return: AnalysisStore
+    """
+    global analysis_store
+    if analysis_store is None:
+        analysis_store = AnalysisStore(ANALYSIS_STORE_PATH, HOURS_BEFORE_REANALYZE * 3600, ANALYSIS_STORE_MAX_ENTRIES)
+    return analysis_store
 
 
 def is_contract(w3, address) -> bool:
@@ -1,5 +1,8 @@
+import math
+
 import torch
 from torch_geometric.nn import TransformerConv
+from torch_geometric.utils import softmax
 import torch.nn.functional as F
 
 
@@ -66,4 +69,105 @@ class ModelAttentionMultiHead(torch.nn.Module):
         x = F.relu(self.conv2(x, x_in.edge_index, x_in.edge_attr))
         x = F.relu(self.linear1(x))
         x_out = self.linear2(x)
-        return x_out
\ No newline at end of file
+        return x_out
+
+class FoldsTransformerConv(torch.nn.Module):
+    """
+    The TransformerConv layers of several folds with their parameters stacked on a first fold dimension, so the folds
+    run on the same graph with batched operations. Computes the same as a TransformerConv (concat, root weight, no
+    beta, no dropout) for each fold.
+    """
+    def __init__(self, convs) -> None:
+        """
+        :param convs: The TransformerConv of each fold, whose parameters are stacked
+        """
+        super().__init__()
+        self.heads = convs[0].heads
+        self.out_channels = convs[0].out_channels
+        for name in ['lin_query', 'lin_key', 'lin_value', 'lin_skip']:
+            self.register_parameter(f'{name}_weight', torch.nn.Parameter(
+                torch.stack([getattr(conv, name).weight.detach().t() for conv in convs])))
+            self.register_parameter(f'{name}_bias', torch.nn.Parameter(
+                torch.stack([getattr(conv, name).bias.detach() for conv in convs]).unsqueeze(1)))
+        self.lin_edge_weight = torch.nn.Parameter(torch.stack([conv.lin_edge.weight.detach().t() for conv in convs]))
+
+    def forward(self, x, edge_index, edge_attr):
+        """
+        :param x: node features of shape (n_nodes, in_channels), shared by the folds, or (n_folds, n_nodes, in_channels)
+        :return: node embeddings of shape (n_folds, n_nodes, heads * out_channels)
+        """
+        n_folds, n_nodes = self.lin_query_weight.shape[0], x.shape[-2]
+        H, C = self.heads, self.out_channels
+        if x.dim() == 2:
+            x = x.expand(n_folds, -1, -1)
+        source, target = edge_index
+        query = torch.baddbmm(self.lin_query_bias, x, self.lin_query_weight).view(n_folds, n_nodes, H, C)
+        key = torch.baddbmm(self.lin_key_bias, x, self.lin_key_weight).view(n_folds, n_nodes, H, C)
+        value = torch.baddbmm(self.lin_value_bias, x, self.lin_value_weight).view(n_folds, n_nodes, H, C)
+        edge = torch.matmul(edge_attr, self.lin_edge_weight).view(n_folds, -1, H, C)
+
+        key_j = key[:, source] + edge
+        alpha = (query[:, target] * key_j).sum(dim=-1) / math.sqrt(C)
+        alpha = softmax(alpha, target, num_nodes=n_nodes, dim=1)
+        messages = (value[:, source] + edge) * alpha.unsqueeze(-1)
+        out = torch.zeros(n_folds, n_nodes, H, C, dtype=messages.dtype).index_add_(1, target, messages)
+        return out.view(n_folds, n_nodes, H * C) + torch.baddbmm(self.lin_skip_bias, x, self.lin_skip_weight)
+
+
+class FoldsModelAttentionMultiHead(torch.nn.Module):
+    """
+    ModelAttentionMultiHead of several folds with stacked parameters, trained together on the same graph. Returns the
+    logits of each fold.
+    """
+    def __init__(self, n_folds, n_node_features, n_edge_attributes, n_classes=2, hidden_size=16,
+                 heads=5, head_size=12) -> None:
+        """
+        :param n_folds: The number of folds
+        Other parameters as in ModelAttentionMultiHead
+        """
+        super().__init__()
+        models = [ModelAttentionMultiHead(n_node_features, n_edge_attributes, n_classes=n_classes,
+                                          hidden_size=hidden_size, heads=heads, head_size=head_size)
+                  for _ in range(n_folds)]
+        self.load_models(models)
+        self.model_kwargs = dict(n_node_features=n_node_features, n_edge_attributes=n_edge_attributes,
+                                 n_classes=n_classes, hidden_size=hidden_size, heads=heads, head_size=head_size)
+
+    def load_models(self, models) -> None:
+        """
+        Replaces the parameters of the folds with the ones of the models, one per fold
+        """
+        self.conv1 = FoldsTransformerConv([model.conv1 for model in models])
+        self.conv2 = FoldsTransformerConv([model.conv2 for model in models])
+        for name in ['linear1', 'linear2']:
+            self.register_parameter(f'{name}_weight', torch.nn.Parameter(
+                torch.stack([getattr(model, name).weight.detach().t() for model in models])))
+            self.register_parameter(f'{name}_bias', torch.nn.Parameter(
+                torch.stack([getattr(model, name).bias.detach() for model in models]).unsqueeze(1)))
+
+    def fold_model(self, fold) -> ModelAttentionMultiHead:
+        """
+        Returns the ModelAttentionMultiHead with the parameters of one fold
+        """
+        model = ModelAttentionMultiHead(**self.model_kwargs)
+        with torch.no_grad():
+            for conv_name in ['conv1', 'conv2']:
+                conv, folds_conv = getattr(model, conv_name), getattr(self, conv_name)
+                for name in ['lin_query', 'lin_key', 'lin_value', 'lin_skip']:
+                    getattr(conv, name).weight.copy_(getattr(folds_conv, f'{name}_weight')[fold].t())
+                    getattr(conv, name).bias.copy_(getattr(folds_conv, f'{name}_bias')[fold, 0])
+                conv.lin_edge.weight.copy_(folds_conv.lin_edge_weight[fold].t())
+            for name in ['linear1', 'linear2']:
+                getattr(model, name).weight.copy_(getattr(self, f'{name}_weight')[fold].t())
+                getattr(model, name).bias.copy_(getattr(self, f'{name}_bias')[fold, 0])
+        return model
+
+    def forward(self, x_in):
+        """
+        Returns logits of shape (n_folds, n_nodes, n_classes). to obtain final probabilities needs to use softmax afterwards
+        """
+        x = F.relu(self.conv1(x_in.x, x_in.edge_index, x_in.edge_attr))
+        x = F.relu(self.conv2(x, x_in.edge_index, x_in.edge_attr))
+        x = F.relu(torch.baddbmm(self.linear1_bias, x, self.linear1_weight))
+        x_out = torch.baddbmm(self.linear2_bias, x, self.linear2_weight)
+        return x_out
@@ -1,59 +1,170 @@
+import logging
+import threading
+import time
 import torch
 import numpy as np
 import torch.nn as nn
 import torch.nn.functional as F
 
-from torch_geometric.data import Data
-from torch_geometric.loader import DataLoader
-from torch_geometric.utils import to_networkx
+from torch_geometric.data import Batch, Data
 from sklearn.preprocessing import MinMaxScaler
 
-from src.constants import MODEL_PATH
+from src.constants import (EARLY_STOPPING_MIN_DELTA, EARLY_STOPPING_PATIENCE, GLOBAL_MODEL_BATCH_SIZE,
+                           GLOBAL_MODEL_BATCH_WINDOW, MODEL_PATH)
+from src.model.model import FoldsModelAttentionMultiHead
 
+logger = logging.getLogger(__name__)
 big_model = torch.load(MODEL_PATH)
 
 
-def prepare_graph_and_train(node_feature, edge_indexes, edge_features, model_type, loss_function, labels, epochs=201):
+def prepare_graph(node_feature, edge_indexes, edge_features, labels=None) -> Data:
+    """
+    Builds the graph with the min-max scaled node features and the edge features, without nans
+    """
     minmax_scaler = MinMaxScaler()
     node_features_torch = torch.Tensor(np.nan_to_num(minmax_scaler.fit_transform(node_feature)))
     edge_indexes_torch = torch.LongTensor(edge_indexes).t()
     edge_features_torch =  torch.nan_to_num(torch.Tensor(edge_features))
-    scammer_graph = Data(x=node_features_torch, edge_index=edge_indexes_torch, 
-                        edge_attr=edge_features_torch, y=labels)
-    netx = to_networkx(scammer_graph)
-    # Train the model
+    return Data(x=node_features_torch, edge_index=edge_indexes_torch,
+                edge_attr=edge_features_torch, y=labels)
+
+
+def prepare_graph_and_train_folds(node_feature, edge_indexes, edge_features, loss_function, labels_folds,
+                                  epochs=201, patience=EARLY_STOPPING_PATIENCE, min_delta=EARLY_STOPPING_MIN_DELTA,
+                                  initial_state=None):
+    """
+    Trains a ModelAttentionMultiHead per fold (one labels tensor per fold) on the same graph, built once. The folds have
+    their parameters stacked and are trained together with batched operations; as their parameters are disjoint, a
+    single Adam on the sum of the fold losses updates each fold as if it was trained alone.
+    A fold stops when its loss hasn't improved by min_delta for patience epochs (patience 0 disables early stopping):
+    its parameters and predictions are kept from that epoch, training ends when all the folds stopped.
+    initial_state is the state_dict of a previous training of the folds to warm-start from (e.g. a previous analysis of
+    the same address), so with early stopping the folds usually stop after a few epochs.
+    :return: FoldsModelAttentionMultiHead, predictions of the folds at their last epoch (n_folds, n_nodes, 2),
+    epochs trained per fold
+    """
+    scammer_graph = prepare_graph(node_feature, edge_indexes, edge_features)
+    labels = torch.stack(labels_folds)
+    n_folds = labels.shape[0]
     loss_fn = nn.CrossEntropyLoss()
-    scammer_dataset = DataLoader([scammer_graph], batch_size=64)
-    model = model_type(scammer_graph.num_node_features, scammer_graph.num_edge_features, hidden_size=64)
+    model = FoldsModelAttentionMultiHead(n_folds, scammer_graph.num_node_features, scammer_graph.num_edge_features,
+                                         hidden_size=64)
+    if initial_state is not None:
+        try:
+            model.load_state_dict(initial_state)
+        except RuntimeError as e:
+            logger.warning(f"The folds can't be warm-started, training from scratch: {e}")
     optimizer = torch.optim.Adam(model.parameters(), lr=0.01, weight_decay=5e-4)
-    predictions_every_ten = []
+
+    predictions = torch.zeros(n_folds, scammer_graph.num_nodes, 2)
+    active = torch.ones(n_folds, dtype=torch.bool)
+    best_loss = torch.full((n_folds,), float('inf'))
+    epochs_without_improvement = torch.zeros(n_folds, dtype=torch.long)
+    epochs_trained = torch.full((n_folds,), epochs, dtype=torch.long)
+    stopped_parameters = [parameter.detach().clone() for parameter in model.parameters()]
     for epoch in range(epochs):
         model.train()
-        for iterator in scammer_dataset:
-            optimizer.zero_grad()
-            original_label = iterator.y
-            predictions = model(iterator)
-            loss = loss_function(original_label, predictions, loss_fn)
-            loss.backward()
-            optimizer.step()
-        if epoch % 10 == 0:
-            model.eval()
-            predictions_every_ten.append(F.softmax(model(iterator), dim=1).detach())
-    return model, predictions_every_ten, netx
-
-
-def prepare_graph_and_predict(node_feature, edge_indexes, edge_features, labels):
+        optimizer.zero_grad()
+        logits = model(scammer_graph)
+        fold_losses = torch.stack([loss_function(labels[fold], logits[fold], loss_fn) for fold in range(n_folds)])
+        torch.where(active, fold_losses, torch.zeros_like(fold_losses)).sum().backward()
+        optimizer.step()
+        with torch.no_grad():
+            # the stopped folds keep the parameters of their last epoch (Adam would keep moving them)
+            for parameter, stopped_parameter in zip(model.parameters(), stopped_parameters):
+                parameter[~active] = stopped_parameter[~active]
+
+            if patience > 0:
+                fold_losses = fold_losses.detach()
+                improved = fold_losses < best_loss - min_delta
+                best_loss = torch.where(improved, fold_losses, best_loss)
+                epochs_without_improvement = torch.where(improved, 0, epochs_without_improvement + 1)
+                stopping = active & (epochs_without_improvement >= patience)
+                if stopping.any():
+                    model.eval()
+                    predictions[stopping] = F.softmax(model(scammer_graph)[stopping], dim=2)
+                    for parameter, stopped_parameter in zip(model.parameters(), stopped_parameters):
+                        stopped_parameter[stopping] = parameter[stopping]
+                    epochs_trained[stopping] = epoch + 1
+                    active &= ~stopping
+                    if not active.any():
+                        break
+    if active.any():
+        model.eval()
+        with torch.no_grad():
+            predictions[active] = F.softmax(model(scammer_graph)[active], dim=2)
+    return model, predictions, epochs_trained
+
+
+def predict_graphs(graphs) -> list:
+    """
+    Runs the global model once on the disjoint union of the graphs. The model only aggregates over the edges of each
+    node, so the predictions of each graph are the same as predicting it alone
+    :return: list of tensors (n_nodes, 2) with the probabilities of each graph
+    """
     global big_model
-    minmax_scaler = MinMaxScaler()
-    node_features_torch = torch.Tensor(np.nan_to_num(minmax_scaler.fit_transform(node_feature)))
-    edge_indexes_torch = torch.LongTensor(edge_indexes).t()
-    edge_features_torch =  torch.nan_to_num(torch.Tensor(edge_features))
-    scammer_graph = Data(x=node_features_torch, edge_index=edge_indexes_torch, 
-                        edge_attr=edge_features_torch, y=labels)
-    scammer_dataset = DataLoader([scammer_graph], batch_size=64)
+    batch = Batch.from_data_list(graphs)
     big_model.eval()
-    all_predictions = []
-    for iterator in scammer_dataset:
-        predictions = big_model(iterator)
-        all_predictions.append(F.softmax(predictions, dim=1).detach())
-    return torch.cat(all_predictions, axis=0)
+    with torch.no_grad():
+        predictions = F.softmax(big_model(batch), dim=1)
+    return list(torch.split(predictions, [graph.num_nodes for graph in graphs]))
+
+
+class GlobalModelBatcher:
+    """
+    Batches the global model predictions of the graphs of the addresses analyzed concurrently. The first graph waits
+    window seconds for others to arrive, then all the pending graphs are predicted in forward passes of at most
+    max_graphs graphs.
+    """
+
+    def __init__(self, window, max_graphs):
+        self.window = window
+        self.max_graphs = max_graphs
+        self._lock = threading.Lock()
+        self._pending = []  # (graph, slot)
+
+    def predict(self, graph):
+        """
+        :return: tensor (n_nodes, 2) with the probabilities of the graph
+        """
+        slot = {'done': threading.Event()}
+        with self._lock:
+            self._pending.append((graph, slot))
+            leader = len(self._pending) == 1
+        if leader:
+            time.sleep(self.window)
+            self._flush()
+        slot['done'].wait()
+        if 'error' in slot:
+            raise slot['error']
+        return slot['predictions']
+
+    def _flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+        for i in range(0, len(pending), self.max_graphs):
+            chunk = pending[i:(i + self.max_graphs)]
+            try:
+                for (_, slot), predictions in zip(chunk, predict_graphs([graph for graph, _ in chunk])):
+                    slot['predictions'] = predictions
+            except Exception as e:
+                for _, slot in chunk:
+                    slot['error'] = e
+            finally:
+                for _, slot in chunk:
+                    slot['done'].set()
+        logger.debug(f"Global model predicted {len(pending)} graphs together")
+
+
+GLOBAL_MODEL_BATCHER = GlobalModelBatcher(GLOBAL_MODEL_BATCH_WINDOW, GLOBAL_MODEL_BATCH_SIZE)
+
+
+def prepare_graph_and_predict(node_feature, edge_indexes, edge_features, labels=None, batcher=None):
+    """
+    Predicts the graph with the global model, batched with the graphs of other addresses if a batcher is given
+    :return: tensor (n_nodes, 2) with the probabilities
+    """
+    scammer_graph = prepare_graph(node_feature, edge_indexes, edge_features, labels)
+    if batcher is not None:
+        return batcher.predict(scammer_graph)
+    return predict_graphs([scammer_graph])[0]
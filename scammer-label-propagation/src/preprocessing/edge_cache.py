@@ -0,0 +1,108 @@
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class EdgeCache:
+    """
+    Persistent cache of the Zettablock edge aggregates of each address, in a local SQLite database in WAL mode, so the
+    neighbors shared by different central nodes are only queried once. The entries are keyed by (address, dataset,
+    data_creation_date). An entry is used while its data_creation_date is the latest seen for the dataset and it is
+    younger than ttl seconds, so the addresses are queried again once the dataset is refreshed.
+    """
+
+    def __init__(self, path, ttl, stats_log_interval):
+        self.path = path
+        self.ttl = ttl
+        self.stats_log_interval = stats_log_interval
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stored': 0}
+        self._lookups = 0
+        # One connection per process. With the process pool each process opens its own one on the same database
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS edges "
+            "(address TEXT, dataset TEXT, data_creation_date TEXT, receiver TEXT, sender TEXT, fetched_at REAL, "
+            "PRIMARY KEY (address, dataset, data_creation_date))"
+        )
+
+    def latest_data_creation_date(self, dataset):
+        """
+        :param dataset: str with the Zettablock dataset id
+        :return: the latest data_creation_date stored for the dataset, '' if there is none
+        """
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(data_creation_date) FROM edges WHERE dataset = ?", (dataset,)).fetchone()
+        return row[0] or ''
+
+    def get_many(self, addresses, dataset):
+        """
+        Returns the cached edges of the addresses that are still valid
+        :param addresses: list of str
+        :param dataset: str with the Zettablock dataset id
+        :return: dict address -> (receiver records, sender records)
+        """
+        data_creation_date = self.latest_data_creation_date(dataset)
+        min_fetched_at = time.time() - self.ttl
+        edges = {}
+        with self._lock:
+            for address in addresses:
+                row = self._connection.execute(
+                    "SELECT receiver, sender FROM edges "
+                    "WHERE address = ? AND dataset = ? AND data_creation_date = ? AND fetched_at >= ?",
+                    (address, dataset, data_creation_date, min_fetched_at)).fetchone()
+                if row is not None:
+                    edges[address] = (json.loads(row[0]), json.loads(row[1]))
+            self._count(hits=len(edges), misses=len(addresses) - len(edges))
+        return edges
+
+    def put_many(self, edges, dataset):
+        """
+        Stores the fetched edges. Addresses without edges are stored under the latest data_creation_date of the
+        dataset, as the response doesn't have any
+        :param edges: dict address -> (receiver records, sender records)
+        :param dataset: str with the Zettablock dataset id
+        """
+        latest_data_creation_date = self.latest_data_creation_date(dataset)
+        fetched_at = time.time()
+        rows = []
+        for address, (receiver, sender) in edges.items():
+            data_creation_date = max([record['data_creation_date'] for record in receiver + sender],
+                                     default=latest_data_creation_date)
+            rows.append((address, dataset, data_creation_date, json.dumps(receiver), json.dumps(sender), fetched_at))
+        with self._lock:
+            self._connection.execute("BEGIN")
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO edges "
+                "(address, dataset, data_creation_date, receiver, sender, fetched_at) VALUES (?, ?, ?, ?, ?, ?)", rows)
+            self._connection.execute("COMMIT")
+            self._stats['stored'] += len(rows)
+
+    def _count(self, hits, misses):
+        previous_lookups = self._lookups
+        self._stats['hits'] += hits
+        self._stats['misses'] += misses
+        self._lookups += hits + misses
+        if self.stats_log_interval > 0 and self._lookups // self.stats_log_interval > previous_lookups // self.stats_log_interval:
+            logger.info(f"Edge cache: {self._format_stats()}")
+
+    def _format_stats(self):
+        lookups = max(self._lookups, 1)
+        return f"{self._stats}, hit ratio: {self._stats['hits'] / lookups:.1%}"
+
+    def stats(self):
+        """
+        Returns the lookup counters and the number of stored entries
+        :return: dict
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = self._connection.execute("SELECT COUNT(*) FROM edges").fetchone()[0]
+        return stats
@@ -1,12 +1,18 @@
 import time
 import torch
 import logging
+import threading
 import requests
 import numpy as np
 import pandas as pd
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
-from src.constants import attacker_bots, victim_bots, SIMULTANEOUS_ADDRESSES, MIN_NEIGHBORS, MAX_NEIGHBORS
+from src.constants import (attacker_bots, victim_bots, SIMULTANEOUS_ADDRESSES, MIN_NEIGHBORS, MAX_NEIGHBORS,
+                           ZETTABLOCK_WORKERS, ZETTABLOCK_REQUESTS_PER_SECOND, EDGE_CACHE_PATH, EDGE_CACHE_TTL,
+                           EDGE_CACHE_STATS_LOG_INTERVAL, LABELS_WORKERS, LABEL_CACHE_SIZE, LABEL_CACHE_TTL)
+from src.preprocessing.edge_cache import EdgeCache
+from src.preprocessing.label_cache import LabelCache
 from src.storage import get_secrets, dynamo_table
 
 
@@ -75,6 +81,99 @@ def get_list_of_addresses_zettablock(central_node, API_key, n_retries=3):
     return list_of_addresses
 
 
+class RateLimiter:
+    """
+    Spaces the requests to an API shared by concurrent threads, so they stay within requests_per_second; acquire()
+    blocks until the next request slot.
+    """
+
+    def __init__(self, requests_per_second):
+        self.interval = 1 / requests_per_second
+        self._lock = threading.Lock()
+        self._next_slot = 0
+
+    def acquire(self):
+        with self._lock:
+            now = time.monotonic()
+            slot = max(now, self._next_slot)
+            self._next_slot = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+# Pooled connections to Zettablock, shared by all the queries of the process
+ZETTABLOCK_SESSION = requests.Session()
+ZETTABLOCK_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=ZETTABLOCK_WORKERS,
+                                                                  pool_maxsize=ZETTABLOCK_WORKERS))
+ZETTABLOCK_RATE_LIMITER = RateLimiter(ZETTABLOCK_REQUESTS_PER_SECOND)
+ZETTABLOCK_EXECUTOR = ThreadPoolExecutor(max_workers=ZETTABLOCK_WORKERS, thread_name_prefix='zettablock')
+ERC20_EDGE_COLUMNS = ['data_creation_date', 'from_address', 'to_address', 'sum_price_in_usd', 'max_price_in_usd',
+                      'n_erc20_transactions_together']
+ETH_EDGE_COLUMNS = ['data_creation_date', 'from_address', 'to_address', 'sum_value_eth', 'max_value_eth',
+                    'n_transactions_together']
+edge_cache = None
+
+
+def get_edge_cache():
+    """
+    Returns the edge cache of the process, opening it on the first call
+    :return: EdgeCache or None if it is disabled
+    """
+    global edge_cache
+    if EDGE_CACHE_PATH and edge_cache is None:
+        edge_cache = EdgeCache(EDGE_CACHE_PATH, EDGE_CACHE_TTL, EDGE_CACHE_STATS_LOG_INTERVAL)
+    return edge_cache
+
+
+def fetch_address_edges_zettablock(address, url, query, headers, n_retries=3):
+    """
+    Queries the edges of an address, with retries
+    :return: (receiver records, sender records) or None if all the retries failed
+    """
+    payload = {"query": query, "variables": {"address": address}}
+    for _ in range(n_retries):
+        ZETTABLOCK_RATE_LIMITER.acquire()
+        try:
+            response = ZETTABLOCK_SESSION.post(url, json=payload, headers=headers, timeout=60)
+            if response.status_code != 200:
+                raise ValueError(f"Status code: {response.status_code}")
+            data = response.json()['data']
+            return data['receiver'], data['sender']
+        except Exception as e:
+            logger.debug(f'Retrying: {e}')
+    return None
+
+
+def fetch_edges_zettablock(list_of_addresses, url, query, API_key, n_retries=3):
+    """
+    Returns the edges of all the addresses for the dataset of the url. The addresses are looked up in the edge cache
+    first, and the misses are queried concurrently under the rate limit and stored. If the request of an address fails
+    n_retries times, the address is skipped
+    :return: list of edge records
+    """
+    dataset = url.split('/')[-2]
+    cache = get_edge_cache()
+    edges = cache.get_many(list_of_addresses, dataset) if cache is not None else {}
+    headers = {
+            "accept": "application/json",
+            "X-API-KEY": API_key,
+            "content-type": "application/json"
+        }
+    misses = [address for address in list_of_addresses if address not in edges]
+    fetched_edges = {}
+    for address, address_edges in zip(misses, ZETTABLOCK_EXECUTOR.map(
+            lambda address: fetch_address_edges_zettablock(address, url, query, headers, n_retries=n_retries), misses)):
+        if address_edges is not None:
+            fetched_edges[address] = address_edges
+    if cache is not None and len(fetched_edges) > 0:
+        cache.put_many(fetched_edges, dataset)
+    edges.update(fetched_edges)
+    logger.debug(f'{dataset}:\t{len(list_of_addresses) - len(misses)} addresses from the edge cache, '
+                 f'{len(fetched_edges)}/{len(misses)} queried')
+    return [record for address in list_of_addresses if address in edges
+            for records in edges[address] for record in records]
+
+
 def get_erc20_data_zettablock(list_of_addresses, API_key, n_retries=3):
     # ERC20 obtaining the data
     erc20_url = "https://api.zettablock.com/api/v1/dataset/sq_e0c40a9d7531406fad1deef330c9ec66/graphql"
@@ -98,31 +197,8 @@ def get_erc20_data_zettablock(list_of_addresses, API_key, n_retries=3):
         }
         }
     """
-    all_erc20_transactions = []
-    headers = {
-            "accept": "application/json",
-            "X-API-KEY": API_key,
-            "content-type": "application/json"
-        }
-    for address in list_of_addresses:
-        variables = {"address":address}
-        payload = {"query": erc20_query, "variables": variables}
-        for i in range(n_retries):
-            try:
-                response = requests.post(erc20_url, json=payload, headers=headers)
-                if response.status_code != 200:
-                    raise ValueError(f"Status code: {response.status_code}")
-            except Exception as e:
-                logger.debug('Retrying')
-            else:
-                all_erc20_transactions.append(pd.DataFrame(response.json()['data']['receiver']))
-                all_erc20_transactions.append(pd.DataFrame(response.json()['data']['sender']))
-                break
-        # If the request fails n_retries times, it will skip the address
-        if i == (n_retries - 1):
-            continue
-    
-    all_erc20_transactions_df = pd.concat(all_erc20_transactions).reset_index(drop=True).drop_duplicates()
+    all_erc20_transactions = fetch_edges_zettablock(list_of_addresses, erc20_url, erc20_query, API_key, n_retries=n_retries)
+    all_erc20_transactions_df = pd.DataFrame(all_erc20_transactions, columns=ERC20_EDGE_COLUMNS).drop_duplicates()
 
     erc20_out = all_erc20_transactions_df[
         all_erc20_transactions_df['from_address'].isin(list_of_addresses)].groupby('from_address').agg(
@@ -176,31 +252,8 @@ def get_eth_data_zettablock(list_of_addresses, API_key, n_retries=3):
         }
         }
     """
-    all_eth_transactions = []
-    headers = {
-            "accept": "application/json",
-            "X-API-KEY": API_key,
-            "content-type": "application/json"
-        }
-    for address in list_of_addresses:
-        variables = {"address":address}
-        payload = {"query": eth_query, "variables": variables}
-        for i in range(n_retries):
-            try:
-                response = requests.post(eth_url, json=payload, headers=headers)
-                if response.status_code != 200:
-                    raise ValueError(f"Status code: {response.status_code}")
-            except Exception as e:
-                logger.debug('Retrying')
-            else:
-                all_eth_transactions.append(pd.DataFrame(response.json()['data']['receiver']))
-                all_eth_transactions.append(pd.DataFrame(response.json()['data']['sender']))
-                break
-        # If the request fails n_retries times, it will skip the address
-        if i == (n_retries - 1):
-            continue
-
-    all_eth_transactions_df = pd.concat(all_eth_transactions).reset_index(drop=True).drop_duplicates()
+    all_eth_transactions = fetch_edges_zettablock(list_of_addresses, eth_url, eth_query, API_key, n_retries=n_retries)
+    all_eth_transactions_df = pd.DataFrame(all_eth_transactions, columns=ETH_EDGE_COLUMNS).drop_duplicates()
     eth_out = all_eth_transactions_df[
         all_eth_transactions_df['from_address'].isin(list_of_addresses)].groupby('from_address').agg(
         {'to_address': 'nunique', 'sum_value_eth': 'sum', 'max_value_eth': 'max', 'n_transactions_together': 'sum'}).reset_index()
@@ -464,33 +517,25 @@ def prepare_labels(df) -> pd.DataFrame:
     attack_words  = ['phish', 'hack', 'attack', 'Attack', 'scam']
     victim_words = ['Victim', 'victim', 'benign']
 
-    labeled = []
     df['entity'] = df['entity'].apply(str.lower)
-    for address in df['entity'].unique():
-        temp_label = {'address': address, 'attacker': 0, 'victim': 0}
-        temp_temp_df = df[df['entity'] == address]
-        for i in range(temp_temp_df.shape[0]):
-            temp_series = temp_temp_df.iloc[i]
-            if any([aw in temp_series['label'] for aw in attack_words]):
-                if temp_series['confidence'] > temp_label['attacker']:
-                    temp_label['attacker'] = temp_series['confidence']
-            elif any([vw in temp_series['label'] for vw in victim_words]):
-                if temp_series['confidence'] > temp_label['victim']:
-                    temp_label['victim'] = temp_series['confidence']
-        labeled.append(temp_label)
-    return pd.DataFrame(labeled)
-
-
-def download_labels_graphql(all_nodes_dict, central_node) -> pd.DataFrame:
-    """
-    Downloads the labels of the nodes in all_nodes_dict. It uses the graphql API of Forta.
-    :param all_nodes_dict: dict Dictionary with the nodes to download the labels from
-    :param central_node: str Central node
-    :return: pd.DataFrame Dataframe with the labels"""
-    logger.info(f'{central_node}\tDownloading the automatic labels')
-    forta_api = "https://api.forta.network/graphql"
-    headers = {"content-type": "application/json"}
-    query = """
+    is_attacker = df['label'].str.contains('|'.join(attack_words), regex=True, na=False)
+    is_victim = ~is_attacker & df['label'].str.contains('|'.join(victim_words), regex=True, na=False)
+    confidences = pd.DataFrame({
+        'address': df['entity'],
+        'attacker': df['confidence'].where(is_attacker, 0),
+        'victim': df['confidence'].where(is_victim, 0),
+    })
+    # The labels of the other type count as 0, so every address is kept with the highest confidence of each type
+    return confidences.groupby('address', sort=False).max().reset_index()
+
+
+# Pooled connections to the Forta API, shared by all the label queries of the process
+FORTA_SESSION = requests.Session()
+FORTA_SESSION.mount("https://", requests.adapters.HTTPAdapter(pool_connections=LABELS_WORKERS,
+                                                             pool_maxsize=LABELS_WORKERS))
+LABELS_EXECUTOR = ThreadPoolExecutor(max_workers=LABELS_WORKERS, thread_name_prefix='labels')
+LABEL_CACHE = LabelCache(LABEL_CACHE_SIZE, LABEL_CACHE_TTL)
+LABELS_QUERY = """
     query Query($labelsInput: LabelsInput) {
     labels(input: $labelsInput) {
         labels {
@@ -514,77 +559,116 @@ def download_labels_graphql(all_nodes_dict, central_node) -> pd.DataFrame:
     }
     }
     """
+
+
+def query_labels_graphql(labels_input, central_node) -> tuple:
+    """
+    Pages through the labels of a chunk of addresses. It allows at most SIMULTANEOUS_ADDRESSES pages to not overcharge
+    the system, in case there is a contract
+    :param labels_input: dict LabelsInput of the query, with the entities of the chunk
+    :param central_node: str Central node
+    :return: tuple of lists (entities, labels, confidences)
+    """
+    forta_api = "https://api.forta.network/graphql"
+    headers = {"content-type": "application/json"}
+    query_variables = {"labelsInput": dict(labels_input, state=True, first=50)}
+    entities, labels, confidences = [], [], []
+    next_page_exists = True
+    current_page = 0
+    while next_page_exists and current_page < SIMULTANEOUS_ADDRESSES:
+        for retry in range(5):
+            try:
+                payload = dict(query=LABELS_QUERY, variables=query_variables)
+                response = FORTA_SESSION.post(forta_api, json=payload, headers=headers, timeout=60)
+                # Each response is parsed once
+                page = response.json()['data']['labels']
+            except Exception as e:
+                logger.debug(f'Retrying for {retry+1} time')
+                if retry == 4:
+                    raise ValueError(f'{central_node}:\tLabels query failed. {e}')
+            else:
+                break
+        for label in page['labels']:
+            entities.append(label['label']['entity'])
+            labels.append(label['label']['label'])
+            confidences.append(label['label']['confidence'])
+        next_page_exists = page['pageInfo']['hasNextPage']
+        query_variables['labelsInput']['after'] = page['pageInfo']['endCursor']
+        current_page += 1
+    return entities, labels, confidences
+
+
+def download_labels_graphql(all_nodes_dict, central_node) -> pd.DataFrame:
+    """
+    Downloads the labels of the nodes in all_nodes_dict. It uses the graphql API of Forta. The labels of the addresses
+    missing from the label cache are queried in chunks of SIMULTANEOUS_ADDRESSES, and the attacker and victim queries of
+    all the chunks run concurrently in LABELS_WORKERS threads.
+    :param all_nodes_dict: dict Dictionary with the nodes to download the labels from
+    :param central_node: str Central node
+    :return: pd.DataFrame Dataframe with the labels"""
+    logger.info(f'{central_node}\tDownloading the automatic labels')
     all_nodes_list = list(all_nodes_dict.keys())
-    all_labels = []
-    for i in range(int(len(all_nodes_list) / SIMULTANEOUS_ADDRESSES) + 1):
-        # This happens if the length of all_nodes_list is a multiple of SIMULTANEOUS_ADDRESSES
-        if len(all_nodes_list[(i * SIMULTANEOUS_ADDRESSES):((i + 1) * SIMULTANEOUS_ADDRESSES)]) == 0:
-            continue
-        # We query first the potential attackers.
-        query_variables = {
-            "labelsInput": {
-                "state": True,
-                "first": 50,
-                "sourceIds": attacker_bots,
-                "entities": all_nodes_list[(i * SIMULTANEOUS_ADDRESSES):((i + 1) * SIMULTANEOUS_ADDRESSES)]
-                }
-            }
-        next_page_exists = True
-        # We allow at most n_addresses pages to not overcharge the system, in case there is a contract
-        current_page = 0
-        while next_page_exists and current_page < SIMULTANEOUS_ADDRESSES:
-            for i in range(5):
-                try:
-                    payload = dict(query=query, variables=query_variables)
-                    response = requests.request("POST", forta_api, json=payload, headers=headers)
-                    all_labels += response.json()['data']['labels']['labels']
-                except Exception as e:
-                    logger.debug(f'Retrying for {i+1} time')
-                    if i == 4:
-                        raise ValueError(f'{central_node}:\tLabels query failed. {response}.\n{e}', exc_info=True)
-                else:
-                    break
-            next_page_exists = response.json()['data']['labels']['pageInfo']['hasNextPage']
-            query_variables['labelsInput']['after'] = response.json()['data']['labels']['pageInfo']['endCursor']
-            current_page += 1
-        # Now query victims
-        query_variables = {
-            "labelsInput": {
-                "state": True,
-                "first": 50,
-                "sourceIds": victim_bots,
-                "labels": ['Victim', 'victim', 'benign'],
-                "entities": all_nodes_list[(i * SIMULTANEOUS_ADDRESSES):((i + 1) * SIMULTANEOUS_ADDRESSES)]
-                }
-            }
-        next_page_exists = True
-        # We allow at most n_addresses pages to not overcharge the system, in case there is a contract
-        current_page = 0
-        while next_page_exists and current_page < SIMULTANEOUS_ADDRESSES:
-            for i in range(5):
-                try:
-                    payload = dict(query=query, variables=query_variables)
-                    response = requests.request("POST", forta_api, json=payload, headers=headers)
-                    all_labels += response.json()['data']['labels']['labels']
-                except Exception as e:
-                    logger.debug(f'Retrying for {i+1} time')
-                    if i == 4:
-                        raise ValueError(f'{central_node}:\tLabels query failed. {response}.\n{e}', exc_info=True)
-                else:
-                    break
-            next_page_exists = response.json()['data']['labels']['pageInfo']['hasNextPage']
-            end_cursor = response.json()['data']['labels']['pageInfo']['endCursor']
-            query_variables['labelsInput']['after'] = end_cursor
-            current_page += 1
-    all_labels_df = pd.DataFrame([response['label'] for response in all_labels])
+    cached_labels = LABEL_CACHE.get_many(all_nodes_list)
+    missing_nodes = [address for address in all_nodes_list if address not in cached_labels]
+    chunks = [missing_nodes[i:(i + SIMULTANEOUS_ADDRESSES)] for i in range(0, len(missing_nodes), SIMULTANEOUS_ADDRESSES)]
+    labels_inputs = []
+    for chunk in chunks:
+        # We query the potential attackers and the victims
+        labels_inputs.append({"sourceIds": attacker_bots, "entities": chunk})
+        labels_inputs.append({"sourceIds": victim_bots, "labels": ['Victim', 'victim', 'benign'], "entities": chunk})
+    new_labels = {address: ([], []) for address in missing_nodes}
+    for entities, labels, confidences in LABELS_EXECUTOR.map(
+            lambda labels_input: query_labels_graphql(labels_input, central_node), labels_inputs):
+        for entity, label, confidence in zip(entities, labels, confidences):
+            address_labels = new_labels.get(entity.lower())
+            if address_labels is not None:
+                address_labels[0].append(label)
+                address_labels[1].append(confidence)
+    LABEL_CACHE.put_many(new_labels)
+    logger.info(f'{central_node}\t{len(cached_labels)} addresses from the label cache, {len(chunks) * 2} label queries. {LABEL_CACHE.stats()}')
+    entities, labels, confidences = [], [], []
+    for address in all_nodes_list:
+        address_labels, address_confidences = cached_labels[address] if address in cached_labels else new_labels[address]
+        entities += [address] * len(address_labels)
+        labels += address_labels
+        confidences += address_confidences
+    all_labels_df = pd.DataFrame({'entity': entities, 'label': labels, 'confidence': confidences})
     if all_labels_df.shape[0] == 0:
         raise Warning(f'{central_node}:\tNo labels found, skipping')
     labels_df = prepare_labels(all_labels_df)
     return labels_df
 
 
+def get_attackers_list(labels_df, attacker_confidence) -> list:
+    """
+    Gets the addresses whose probability of being an attacker is at least attacker_confidence
+    :param labels_df: pd.DataFrame Dataframe with the labels
+    :param attacker_confidence: float Confidence to consider an address as an attacker
+    :return: list of str with the attackers
+    """
+    return labels_df.loc[labels_df['attacker']>=attacker_confidence, 'address'].unique().tolist()
+
+
+def get_attacker_neighbors(all_nodes_dict, transactions_overview, labels_df, attacker_confidence=0.1) -> np.ndarray:
+    """
+    Gets which nodes sent transactions to an attacker. It only depends on the graph and the labels, so it is computed
+    once and reused by the get_automatic_labels of every fold
+    :param all_nodes_dict: dict Dictionary with the index of each node
+    :param transactions_overview: pd.DataFrame Dataframe with the transactions
+    :param labels_df: pd.DataFrame Dataframe with the labels
+    :param attacker_confidence: float Confidence to consider an address as an attacker
+    :return: np.ndarray boolean vector over the node indexes
+    """
+    attackers_list = get_attackers_list(labels_df, attacker_confidence)
+    to_attacker = transactions_overview['to_address'].isin(attackers_list).to_numpy()
+    senders = transactions_overview.loc[to_attacker, 'from_address'].map(all_nodes_dict).dropna().to_numpy(dtype=np.int64)
+    attacker_neighbors = np.zeros(len(all_nodes_dict), dtype=bool)
+    attacker_neighbors[senders] = True
+    return attacker_neighbors
+
+
 def get_automatic_labels(all_nodes_dict, transactions_overview, central_node, labels_df,
-                         attacker_confidence=0.1, victim_confidence=0.5, victim_sampling=2):
+                         attacker_confidence=0.1, victim_confidence=0.5, victim_sampling=2, attacker_neighbors=None):
     """
     Gets the automatic labels for the nodes in all_nodes_dict. 
     It uses the labels_df to get the labels of the nodes. The logic to get labels is as follows:
@@ -601,6 +685,7 @@ def get_automatic_labels(all_nodes_dict, transactions_overview, central_node, la
     :param attacker_confidence: float Confidence to consider an address as an attacker
     :param victim_confidence: float Confidence to consider an address as a victim
     :param victim_sampling: int Number of victims to add for each attacker
+    :param attacker_neighbors: np.ndarray Output of get_attacker_neighbors for the same labels, computed if None
     :return: torch.Tensor tensor with the labels
     :return: dict Dictionary with the labels
     """
@@ -609,7 +694,7 @@ def get_automatic_labels(all_nodes_dict, transactions_overview, central_node, la
     automatic_labels = {address: 'unlabeled' for address in all_nodes_dict.keys()}
 
     # Attackers
-    attackers_list = labels_df.loc[labels_df['attacker']>=attacker_confidence, 'address'].unique().tolist()
+    attackers_list = get_attackers_list(labels_df, attacker_confidence)
     if len(attackers_list) == 0:
         logger.warning(f'{central_node}:\tWith current attacker level {attacker_confidence} there are not enough attackers. Only global model will work')
     if central_node not in attackers_list:
@@ -623,12 +708,16 @@ def get_automatic_labels(all_nodes_dict, transactions_overview, central_node, la
     victims_list = temp_victim.loc[temp_victim['attacker'] < min(victim_confidence, attacker_confidence), 'address'].unique().tolist()
     if len(victims_list) < int(victim_sampling * num_attackers):
         n_victims = int(victim_sampling * num_attackers) - len(victims_list)
-        # In case we have to add random victims
-        potential_victims = []
-        for key in all_nodes_dict.keys():
-            if pd.Series(transactions_overview.loc[transactions_overview['from_address'] == key, 'to_address'].values).isin(attackers_list).any():
-                if key not in attackers_list and key not in victims_list and key != central_node: # central node is either unlabeled or attacker
-                    potential_victims.append(key)
+        # In case we have to add random victims: unlabeled nodes that sent transactions to an attacker
+        if attacker_neighbors is None:
+            attacker_neighbors = get_attacker_neighbors(all_nodes_dict, transactions_overview, labels_df, attacker_confidence)
+        addresses = np.empty(len(all_nodes_dict), dtype=object)
+        addresses[list(all_nodes_dict.values())] = list(all_nodes_dict.keys())
+        labeled = [all_nodes_dict[address] for address in attackers_list + victims_list + [central_node]  # central node is either unlabeled or attacker
+                   if address in all_nodes_dict]
+        candidates = attacker_neighbors.copy()
+        candidates[labeled] = False
+        potential_victims = addresses[candidates].tolist()
         if len(potential_victims) > n_victims:
             final_victims = np.random.choice(potential_victims, n_victims, replace=False).tolist()
         else:
@@ -642,11 +731,8 @@ def get_automatic_labels(all_nodes_dict, transactions_overview, central_node, la
 
     # Prepare the torch tensor
     labels = torch.ones(len(all_nodes_dict), dtype=torch.long) * -1
-    for key in all_nodes_dict.keys():
-        if automatic_labels[key] == 'victim':
-            labels[all_nodes_dict[key]] = 0
-        elif automatic_labels[key] == 'attacker':
-            labels[all_nodes_dict[key]] = 1
+    labels[[index for key, index in all_nodes_dict.items() if automatic_labels[key] == 'victim']] = 0
+    labels[[index for key, index in all_nodes_dict.items() if automatic_labels[key] == 'attacker']] = 1
     return labels, automatic_labels
 
 
@@ -0,0 +1,57 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class LabelCache:
+    """
+    LRU cache of the Forta labels of each address, shared by the analyses of the process, so the neighbors shared by
+    different central nodes only have their labels downloaded once every ttl seconds. Addresses without labels are
+    cached too, as most of the neighbors don't have any.
+    """
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.labels = OrderedDict()  # address -> (labels, confidences, cached at)
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, addresses):
+        """
+        Returns the cached labels of the addresses that haven't expired
+        :param addresses: list of str
+        :return: dict address -> (labels, confidences)
+        """
+        now = time.time()
+        cached = {}
+        with self._lock:
+            for address in addresses:
+                entry = self.labels.get(address)
+                if entry is not None and now - entry[2] > self.ttl:
+                    del self.labels[address]
+                    entry = None
+                if entry is not None:
+                    self.labels.move_to_end(address)
+                    cached[address] = entry[:2]
+            self.hits += len(cached)
+            self.misses += len(addresses) - len(cached)
+        return cached
+
+    def put_many(self, labels):
+        """
+        :param labels: dict address -> (labels, confidences)
+        """
+        now = time.time()
+        with self._lock:
+            for address, (address_labels, confidences) in labels.items():
+                self.labels[address] = (address_labels, confidences, now)
+                self.labels.move_to_end(address)
+            while len(self.labels) > self.max_size:
+                self.labels.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        hit_ratio = self.hits / lookups if lookups > 0 else 0.0
+        return f"label cache size={len(self.labels)} hits={self.hits} misses={self.misses} hit_ratio={hit_ratio:.2%}"
@@ -2,76 +2,64 @@ import numpy as np
 import pandas as pd
 
 
-def get_edge_indexes(row, all_nodes_dict) -> tuple:
+# Properties of the edges: (edge aggregate, node aggregate, node of the edge) whose ratio is the property, in order
+EDGE_PROPERTIES = [
+    # ETH information
+    ('n_transactions_together', 'n_transactions_out_eth', 'from_address'),
+    ('max_value_together_eth', 'max_value_out_eth', 'from_address'),
+    ('avg_value_together_eth', 'avg_value_out_eth', 'from_address'),
+    ('total_value_together', 'total_value_out_eth', 'from_address'),
+    ('n_transactions_together', 'n_transactions_in_eth', 'to_address'),
+    ('max_value_together_eth', 'max_value_in_eth', 'to_address'),
+    ('avg_value_together_eth', 'avg_value_in_eth', 'to_address'),
+    ('total_value_together', 'total_value_in_eth', 'to_address'),
+    # ERC20 information
+    ('n_transactions_together_erc20', 'n_transactions_out_erc20', 'from_address'),
+    ('max_usd_together_erc20', 'max_usd_out_erc20', 'from_address'),
+    ('avg_usd_together_erc20', 'avg_usd_out_erc20', 'from_address'),
+    ('total_usd_together_erc20', 'total_usd_out_erc20', 'from_address'),
+    ('n_transactions_together_erc20', 'n_transactions_in_erc20', 'to_address'),
+    ('max_usd_together_erc20', 'max_usd_in_erc20', 'to_address'),
+    ('avg_usd_together_erc20', 'avg_usd_in_erc20', 'to_address'),
+    ('total_usd_together_erc20', 'total_usd_in_erc20', 'to_address'),
+]
+
+
+def get_edge_indexes(transactions_overview, all_nodes_dict) -> np.ndarray:
     """
-    Get the indexes of the nodes in the edge
-    :param row: row of the dataframe
+    Get the indexes of the nodes of all the edges
+    :param transactions_overview: dataframe with the edges
     :param all_nodes_dict: dictionary of all nodes
-    :return: tuple of the indexes of the nodes in the edge
+    :return: array of shape (n_edges, 2) with the indexes of the from and to nodes of each edge
     """
-    return (all_nodes_dict[row.from_address], all_nodes_dict[row.to_address])
+    edge_indexes = np.empty((transactions_overview.shape[0], 2), dtype=np.int64)
+    edge_indexes[:, 0] = transactions_overview['from_address'].map(all_nodes_dict).to_numpy()
+    edge_indexes[:, 1] = transactions_overview['to_address'].map(all_nodes_dict).to_numpy()
+    return edge_indexes
 
 
-def calculate_edge_properties(edge, node_feature) -> list:
+def calculate_edge_properties(transactions_overview, node_feature, edge_indexes) -> np.ndarray:
     """
-    Calculate the properties of the edge and normalize them
-    :param edge: edge to calculate the properties
-    :param node_feature: dataframe with the features of the nodes
-    :return: list of the properties of the edge
+    Calculate the properties of all the edges at once: the ratios of EDGE_PROPERTIES, with the node aggregates
+    gathered by node index. Dividing by 0 gives inf/nan, inf is replaced by nan
+    :param transactions_overview: dataframe with the edges
+    :param node_feature: dataframe with the features of the nodes, in the order of the node indexes
+    :param edge_indexes: array with the indexes of the from and to nodes of each edge
+    :return: array of shape (n_edges, 16) with the properties of the edges
     """
-    np.seterr(invalid='ignore')  # For this function, ignore dividing by 0 as we will clean after
-    # this is to make sure that dividing by 0 gives inf/nan
-    edge['n_transactions_together'] = np.float64(edge['n_transactions_together'])
-    edge['max_value_together_eth'] = np.float64(edge['max_value_together_eth'])
-    edge['avg_value_together_eth'] = np.float64(edge['avg_value_together_eth'])
-    edge['total_value_together'] = np.float64(edge['total_value_together'])
-    edge['n_transactions_together_erc20'] = np.float64(edge['n_transactions_together_erc20'])
-    edge['max_usd_together_erc20'] = np.float64(edge['max_usd_together_erc20'])
-    edge['avg_usd_together_erc20'] = np.float64(edge['avg_usd_together_erc20'])
-    edge['total_usd_together_erc20'] = np.float64(edge['total_usd_together_erc20'])
-
-    # ETH information
-    from_n_p_out_eth = edge.n_transactions_together / node_feature.loc[
-        edge.from_address, 'n_transactions_out_eth']
-    from_max_p_out_eth = edge.max_value_together_eth / node_feature.loc[
-        edge.from_address, 'max_value_out_eth']
-    from_avg_p_out_eth = edge.avg_value_together_eth / node_feature.loc[
-        edge.from_address, 'avg_value_out_eth']
-    from_total_p_out_eth = edge.total_value_together / node_feature.loc[
-        edge.from_address, 'total_value_out_eth']
-    from_n_p_in_eth = edge.n_transactions_together / node_feature.loc[
-        edge.to_address, 'n_transactions_in_eth']
-    from_max_p_in_eth = edge.max_value_together_eth / node_feature.loc[
-        edge.to_address, 'max_value_in_eth']
-    from_avg_p_in_eth = edge.avg_value_together_eth / node_feature.loc[
-        edge.to_address, 'avg_value_in_eth']
-    from_total_p_in_eth = edge.total_value_together / node_feature.loc[
-        edge.to_address, 'total_value_in_eth']
-    # ERC20 information
-    from_n_p_out_erc20 = edge.n_transactions_together_erc20 / node_feature.loc[
-        edge.from_address, 'n_transactions_out_erc20']
-    from_max_p_out_erc20 = edge.max_usd_together_erc20 / node_feature.loc[
-        edge.from_address, 'max_usd_out_erc20']
-    from_avg_p_out_erc20 = edge.avg_usd_together_erc20 / node_feature.loc[
-        edge.from_address, 'avg_usd_out_erc20']
-    from_total_p_out_erc20 = edge.total_usd_together_erc20 / node_feature.loc[
-        edge.from_address, 'total_usd_out_erc20']
-    from_n_p_in_erc20 = edge.n_transactions_together_erc20 / node_feature.loc[
-        edge.to_address, 'n_transactions_in_erc20']
-    from_max_p_in_erc20 = edge.max_usd_together_erc20 / node_feature.loc[
-        edge.to_address, 'max_usd_in_erc20']
-    from_avg_p_in_erc20 = edge.avg_usd_together_erc20 / node_feature.loc[
-        edge.to_address, 'avg_usd_in_erc20']
-    from_total_p_in_erc20 = edge.total_usd_together_erc20 / node_feature.loc[
-        edge.to_address, 'total_usd_in_erc20']
-    np.seterr(invalid='warn')  # set warnings for dividing by 0 again
-    to_return = [from_n_p_out_eth, from_max_p_out_eth, from_avg_p_out_eth, from_total_p_out_eth, 
-            from_n_p_in_eth, from_max_p_in_eth, from_avg_p_in_eth, from_total_p_in_eth,
-            from_n_p_out_erc20, from_max_p_out_erc20, from_avg_p_out_erc20, from_total_p_out_erc20,
-            from_n_p_in_erc20, from_max_p_in_erc20, from_avg_p_in_erc20, from_total_p_in_erc20]
+    node_side = {'from_address': 0, 'to_address': 1}
+    edge_values = transactions_overview[
+        [edge_column for edge_column, _, _ in EDGE_PROPERTIES]].to_numpy(dtype=np.float64)
+    node_values = node_feature[
+        [node_column for _, node_column, _ in EDGE_PROPERTIES]].to_numpy(dtype=np.float64)
+    # node aggregate of each property for each edge: the from or to node of the edge, column of the property
+    property_nodes = edge_indexes[:, [node_side[side] for _, _, side in EDGE_PROPERTIES]]
+    node_values = node_values[property_nodes, np.arange(len(EDGE_PROPERTIES))]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        edge_features = edge_values / node_values
     # Replace inf with nan
-    to_return = [np.nan if np.isinf(x) else x for x in to_return]
-    return to_return
+    edge_features[np.isinf(edge_features)] = np.nan
+    return edge_features
 
 
 def format_empty_values(data_in: dict) -> dict:
@@ -138,8 +126,6 @@ def prepare_data(data_in: dict) -> tuple:
         transactions_overview['to_address'].isin(node_feature.index.to_list())]
     transactions_overview = transactions_overview.reset_index(drop=True)
     # Calculate edges and properties
-    edge_indexes = transactions_overview.apply(
-        get_edge_indexes, all_nodes_dict=all_nodes_dict, axis=1)
-    edge_features = transactions_overview.apply(
-        calculate_edge_properties, node_feature=node_feature, axis=1)
+    edge_indexes = get_edge_indexes(transactions_overview, all_nodes_dict)
+    edge_features = calculate_edge_properties(transactions_overview, node_feature, edge_indexes)
     return all_nodes_dict, node_feature, transactions_overview, edge_indexes, edge_features
@@ -1,9 +1,12 @@
 import time
+from unittest import mock
+from concurrent.futures.process import BrokenProcessPool
+import pandas as pd
 from forta_agent import  create_alert_event, create_block_event
 import src.agent as agent
 import json
 import unittest
-from src.constants import N_WORKERS
+from src.constants import N_WORKERS, MAX_FINDINGS_PER_ADDRESS
 
 
 class TestScammerLabelPropagationAgent(unittest.TestCase):
@@ -208,6 +211,66 @@ class TestScammerLabelPropagationAgent(unittest.TestCase):
              }
         agent.run_all_extended(central_node, create_alert_event(alert))
 
+    def test_run_all_extended_findings_from_records(self):
+        central_node = '0x000006d683610e61ad9ee4b487fae3904b392b9e'
+        alert = create_alert_event(
+            {"alert":
+                {"name": "x",
+                 "hash": "0xabc",
+                 "description": "description",
+                 "alertId": "alert",
+                 "source":
+                    {"bot": {'id': "0x1d646c4045189991fdfd24a66b192a294158b839a6ec121d740474bdacb3ab23"}},
+                 "labels": []
+                 }
+             })
+        attackers_df = pd.DataFrame({'n_predicted_attacker': [10, 8], 'mean_probs_victim': [0.05, 0.02],
+                                     'mean_probs_attacker': [0.95, 0.98]}, index=['0xa', '0xb'])
+        attackers_df_global = pd.DataFrame({'p_victim': [0.01], 'p_attacker': [0.99]}, index=['0xc'])
+        records = agent.dataframe_to_records(attackers_df)
+        assert records[1] == {'address': '0xb', 'n_predicted_attacker': 8, 'mean_probs_victim': 0.02, 'mean_probs_attacker': 0.98}, "The records should keep the address and the columns"
+        agent.secrets = {}
+        with mock.patch.object(agent, 'run_all', return_value=(attackers_df, {'n_nodes': 3}, attackers_df_global)):
+            findings = agent.run_all_extended(central_node, alert, None)
+        assert [finding.alert_id for finding in findings] == ['SCAMMER-LABEL-PROPAGATION-1'] * 2 + ['SCAMMER-LABEL-PROPAGATION-2']
+        assert findings[0].labels[0].entity == '0xa' and abs(findings[0].labels[0].confidence - 0.95) < 1e-9
+        too_many_df = pd.DataFrame({'n_predicted_attacker': [10] * (MAX_FINDINGS_PER_ADDRESS + 1), 
+                                    'mean_probs_victim': 0.0, 'mean_probs_attacker': 1.0},
+                                   index=[f'0x{i}' for i in range(MAX_FINDINGS_PER_ADDRESS + 1)])
+        with mock.patch.object(agent, 'run_all', return_value=(too_many_df, {'n_nodes': 3}, attackers_df_global)):
+            findings = agent.run_all_extended(central_node, alert, None)
+        assert len(findings) == 1, "Only the global model findings should be kept when there are too many attackers"
+
+    def test_run_all_extended_replaces_broken_process_pool(self):
+        central_node = '0x000006d683610e61ad9ee4b487fae3904b392b9e'
+        alert = create_alert_event(
+            {"alert":
+                {"name": "x",
+                 "hash": "0xabc",
+                 "description": "description",
+                 "alertId": "alert",
+                 "source":
+                    {"bot": {'id': "0x1d646c4045189991fdfd24a66b192a294158b839a6ec121d740474bdacb3ab23"}},
+                 "labels": []
+                 }
+             })
+        broken_executor = mock.Mock()
+        broken_executor.submit.side_effect = BrokenProcessPool("a process died")
+        new_executor = mock.Mock()
+        new_executor.submit.return_value.result.return_value = ([], {'n_nodes': 3}, [])
+        with mock.patch.object(agent, 'PROCESS_POOL', True), mock.patch.object(agent, 'process_executor', broken_executor), \
+                mock.patch.object(agent, 'create_process_executor', return_value=new_executor):
+            findings = agent.run_all_extended(central_node, alert, None)
+            assert agent.process_executor is new_executor, "The broken pool should have been replaced"
+        broken_executor.shutdown.assert_called_once_with(wait=False)
+        new_executor.submit.assert_called_once()
+        assert findings == [], "The address should have been retried on the new pool"
+
+        with mock.patch.object(agent, 'PROCESS_POOL', True), mock.patch.object(agent, 'process_executor', broken_executor), \
+                mock.patch.object(agent, 'create_process_executor', return_value=broken_executor):
+            findings = agent.run_all_extended(central_node, alert, None)
+        assert findings == [], "The address should be skipped when the new pool breaks too"
+
     def test_address_more_predictions(self):
         central_node = '0x872f8a8847129c7c3de5ad4cc8e9b2468763dbdf'
         agent.initialize()
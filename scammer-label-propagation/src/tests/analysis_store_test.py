@@ -0,0 +1,24 @@
+import os
+import tempfile
+import time
+import unittest
+
+from src.analysis_store import AnalysisStore
+
+
+class TestAnalysisStore(unittest.TestCase):
+    def test_save_sweeps_expired_and_oldest_analyses(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = AnalysisStore(directory, ttl=3600, max_entries=2)
+            store.save('0x1', {'results': 1})
+            expired_time = time.time() - 7200
+            os.utime(os.path.join(directory, '0x1.pt'), (expired_time, expired_time))
+            store.save('0x2', {'results': 2})
+            assert not os.path.exists(os.path.join(directory, '0x1.pt')), "Expired analyses should be deleted on save"
+
+            old_time = time.time() - 60
+            os.utime(os.path.join(directory, '0x2.pt'), (old_time, old_time))
+            store.save('0x3', {'results': 3})
+            store.save('0x4', {'results': 4})
+            assert sorted(os.listdir(directory)) == ['0x3.pt', '0x4.pt'], "Only the newest max_entries should be kept"
+            assert store.load('0x4') == {'results': 4}
@@ -1,7 +1,15 @@
+import os
+import tempfile
 import time
 import unittest
+from unittest import mock
+
+import numpy as np
+import pandas as pd
 import src.preprocessing.get_data as get_data
 import src.preprocessing.process_data as process_data
+from src.preprocessing.edge_cache import EdgeCache
+from src.preprocessing.label_cache import LabelCache
 from src.preprocessing.get_data import put_query_id_dynamo, get_query_id_dynamo
 
 class TestAuxiliarFunctions(unittest.TestCase):
@@ -42,5 +50,117 @@ class TestAuxiliarFunctions(unittest.TestCase):
         
 
 
+    def test_prepare_data_edge_properties(self):
+        data = {
+            'all_eth_transactions': pd.DataFrame({
+                'from_address': ['a', 'b', 'a', 'contract'], 'to_address': ['b', 'c', 'c', 'a'],
+                'n_transactions_together': [2, 1, 4, 1], 'max_value_together_eth': [1., 1., 2., 1.],
+                'avg_value_together_eth': [.5, 0., 1., 1.], 'total_value_together': [1., 0., 4., 1.]}),
+            'all_erc20_transactions': pd.DataFrame(),
+            'eth_in': pd.DataFrame({
+                'address': ['b', 'c'], 'n_transactions_in_eth': [4, 5], 'max_value_in_eth': [2., 2.],
+                'avg_value_in_eth': [1., 0.], 'total_value_in_eth': [2., 5.]}),
+            'eth_out': pd.DataFrame({
+                'address': ['a', 'b'], 'n_transactions_out_eth': [8, 1], 'max_value_out_eth': [2., 0.],
+                'avg_value_out_eth': [1., 0.], 'total_value_out_eth': [5., 0.]}),
+            'erc20_in': pd.DataFrame(), 'erc20_out': pd.DataFrame(),
+        }
+        all_nodes_dict, _, transactions_overview, edge_indexes, edge_features = process_data.prepare_data(data)
+        assert all_nodes_dict == {'a': 0, 'b': 1, 'c': 2}
+        # the edge from the contract is removed
+        assert edge_indexes.tolist() == [[0, 1], [0, 2], [1, 2]]
+        assert edge_features.shape == (3, 16)
+        # from a to b: out ratios of a, in ratios of b
+        np.testing.assert_array_equal(edge_features[0, :8], [2 / 8, 1 / 2, .5, 1 / 5, 2 / 4, 1 / 2, .5, 1 / 2])
+        # from b to c: 1 / 0 (inf) is nan, 0 / 0 is nan
+        assert np.isnan(edge_features[2, 1]) and np.isnan(edge_features[2, 6])
+        np.testing.assert_array_equal(edge_features[2, [0, 4, 5]], [1., 1 / 5, 1 / 2])
+        # no erc20 transactions and no erc20 node aggregates
+        assert np.isnan(edge_features[:, 8:]).all()
+
+    def test_edge_cache(self):
+        def edges(address, data_creation_date):
+            record = {'data_creation_date': data_creation_date, 'from_address': address, 'to_address': '0xc',
+                      'sum_value_eth': 2.0, 'max_value_eth': 1.5, 'n_transactions_together': 2}
+            return {'data': {'receiver': [record], 'sender': []}}
+
+        def post(url, json, headers, timeout):
+            address = json['variables']['address']
+            posted.append(address)
+            response = mock.Mock(status_code=200 if address != '0xfail' else 500)
+            response.json.return_value = edges(address, data_creation_date)
+            return response
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(get_data, 'edge_cache', EdgeCache(os.path.join(directory, 'edges.db'), 3600, 0)), \
+                mock.patch.object(get_data.ZETTABLOCK_SESSION, 'post', side_effect=post):
+            posted, data_creation_date = [], '2023-06-01'
+            eth_data = get_data.get_eth_data_zettablock(['0xa', '0xb', '0xfail'], API_key='key')
+            assert sorted(posted) == ['0xa', '0xb'] + ['0xfail'] * 3, "Every address should be queried, the failures with retries"
+            assert eth_data['eth_out'].set_index('address').loc['0xa', 'total_value_out_eth'] == 2.0
+            posted = []
+            get_data.get_eth_data_zettablock(['0xa', '0xb', '0xc'], API_key='key')
+            assert sorted(posted) == ['0xc'], "Only the addresses missing from the cache should be queried"
+            # Once the dataset is refreshed, the cached edges of the previous date aren't used anymore
+            posted, data_creation_date = [], '2023-06-02'
+            get_data.get_eth_data_zettablock(['0xd'], API_key='key')
+            get_data.get_eth_data_zettablock(['0xa', '0xd'], API_key='key')
+            assert posted == ['0xd', '0xa']
+            assert get_data.edge_cache.stats()['entries'] == 5
+
+
+    def test_download_labels_cached(self):
+        def post(url, json, headers, timeout):
+            labels_input = json['variables']['labelsInput']
+            queried.append(labels_input)
+            if 'labels' in labels_input:
+                labels = [{'label': {'label': 'victim', 'entity': entity.upper(), 'confidence': 0.5}}
+                          for entity in labels_input['entities'] if entity.endswith('1')]
+            else:
+                labels = [{'label': {'label': 'scam', 'entity': entity, 'confidence': 0.9}}
+                          for entity in labels_input['entities'] if entity.endswith('2')]
+            response = mock.Mock()
+            response.json.return_value = {'data': {'labels': {
+                'labels': labels, 'pageInfo': {'hasNextPage': False, 'endCursor': None}}}}
+            return response
+
+        all_nodes_dict = {f'0x{i}': i for i in range(get_data.SIMULTANEOUS_ADDRESSES + 5)}
+        with mock.patch.object(get_data, 'LABEL_CACHE', LabelCache(1000, 3600)), \
+                mock.patch.object(get_data.FORTA_SESSION, 'post', side_effect=post):
+            queried = []
+            labels_df = get_data.download_labels_graphql(all_nodes_dict, '0x0')
+            assert len(queried) == 4, "The attackers and the victims of each chunk should be queried once"
+            assert labels_df.set_index('address').loc['0x21', 'victim'] == 0.5, "The victims of every chunk should be downloaded"
+            assert labels_df.set_index('address').loc['0x32', 'attacker'] == 0.9
+            queried = []
+            cached_labels_df = get_data.download_labels_graphql(all_nodes_dict, '0x0')
+            assert len(queried) == 0, "The labels should come from the label cache"
+            pd.testing.assert_frame_equal(labels_df, cached_labels_df)
+
+    def test_automatic_labels_victim_sampling(self):
+        all_nodes_dict = {address: i for i, address in enumerate(['0xc', '0xa', '0xv', '0x1', '0x2', '0x3', '0x4'])}
+        transactions_overview = pd.DataFrame({
+            'from_address': ['0xc', '0x1', '0x2', '0x3', '0xv', '0x4', '0xa'],
+            'to_address':   ['0xa', '0xa', '0xc', '0x4', '0xa', '0x1', '0x3']})
+        labels_df = pd.DataFrame({'address': ['0xc', '0xa', '0xv'], 'attacker': [0.9, 0.9, 0.0], 'victim': [0.0, 0.0, 0.9]})
+        attacker_neighbors = get_data.get_attacker_neighbors(all_nodes_dict, transactions_overview, labels_df, attacker_confidence=0.5)
+        assert attacker_neighbors.tolist() == [True, False, True, True, True, False, False], "The nodes sending to an attacker should be flagged"
+        for _ in range(5):
+            labels, automatic_labels = get_data.get_automatic_labels(
+                all_nodes_dict, transactions_overview, '0xc', labels_df, attacker_confidence=0.5, victim_sampling=1.5,
+                attacker_neighbors=attacker_neighbors)
+            victims = sorted(address for address, label in automatic_labels.items() if label == 'victim')
+            # 3 victims are needed: the labeled one and two of the unlabeled nodes sending to attackers
+            assert victims == ['0x1', '0x2', '0xv']
+            assert labels.tolist() == [1, 1, 0, 0, 0, -1, -1]
+        np.random.seed(0)
+        _, sampled_labels = get_data.get_automatic_labels(
+            all_nodes_dict, transactions_overview, '0xc', labels_df, attacker_confidence=0.5, victim_sampling=1,
+            attacker_neighbors=attacker_neighbors)
+        np.random.seed(0)
+        _, computed_labels = get_data.get_automatic_labels(
+            all_nodes_dict, transactions_overview, '0xc', labels_df, attacker_confidence=0.5, victim_sampling=1)
+        assert sampled_labels == computed_labels, "The precomputed attacker neighbors should sample the same victims"
+
 if __name__ == '__main__':
     unittest.main()
@@ -1,14 +1,45 @@
 import logging
+import os
+import tempfile
 import unittest
 from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
 
-from src.constants import N_WORKERS
+import numpy as np
+import pandas as pd
+import torch
+
+import src.main as main
+from src.constants import N_WORKERS, WARM_START_EPOCHS
 from src.main import run_all
+from src.model.train import prepare_graph_and_train_folds
 
 logger = logging.getLogger(__name__)
 
 
 
+def synthetic_data_and_labels():
+    """
+    Returns the data of a random graph of 30 addresses, as collected by collect_data_zettablock, and its labels
+    """
+    np.random.seed(1993)
+    addresses = [f'0x{i:02x}' for i in range(30)]
+    eth_transactions = pd.DataFrame({'from_address': np.random.choice(addresses, 120),
+                                     'to_address': np.random.choice(addresses, 120)})
+    eth_transactions = eth_transactions[eth_transactions['from_address'] != eth_transactions['to_address']].drop_duplicates()
+    for column in ['n_transactions_together', 'max_value_together_eth', 'avg_value_together_eth', 'total_value_together']:
+        eth_transactions[column] = np.random.rand(eth_transactions.shape[0])
+    data = {'all_eth_transactions': eth_transactions, 'all_erc20_transactions': pd.DataFrame()}
+    for name in ['eth_in', 'eth_out', 'erc20_in', 'erc20_out']:
+        direction, kind = name.split('_')[1], name.split('_')[0]
+        unit = 'value' if kind == 'eth' else 'usd'
+        data[name] = pd.DataFrame({'address': addresses, **{
+            f'{aggregate}_{direction}_{kind}': np.random.rand(len(addresses))
+            for aggregate in ['n_transactions', f'max_{unit}', f'avg_{unit}', f'total_{unit}']}})
+    labels_df = pd.DataFrame({'address': addresses[:6], 'attacker': [1.0] * 3 + [0.0] * 3, 'victim': [0.0] * 3 + [1.0] * 3})
+    return addresses, data, labels_df
+
+
 class TestMain(unittest.TestCase):
     def test_run_all_processpool(self):
         """
@@ -58,5 +89,69 @@ class TestMain(unittest.TestCase):
         assert catch_warning, "run_all() should raise a warning for this address"
 
 
+    def test_run_all_reuses_previous_analysis(self):
+        """
+        A re-analysis with the same data and labels reuses the results of the previous one, and with new labels it
+        reuses the graph and warm-starts the folds for fewer epochs from the weights of the last full training
+        """
+        addresses, data, labels_df = synthetic_data_and_labels()
+        new_labels_df = pd.concat([labels_df, pd.DataFrame({'address': ['0x10'], 'attacker': [1.0], 'victim': [0.0]})])
+        newer_labels_df = pd.concat([new_labels_df, pd.DataFrame({'address': ['0x11'], 'attacker': [1.0], 'victim': [0.0]})])
+        trainings = []
+
+        def train_folds(*args, **kwargs):
+            model, predictions, epochs_trained = prepare_graph_and_train_folds(*args, **kwargs)
+            trainings.append((kwargs.get('initial_state'), epochs_trained))
+            return model, predictions, epochs_trained
+
+        with tempfile.TemporaryDirectory() as directory, \
+                mock.patch.object(main, 'ANALYSIS_STORE_PATH', directory), \
+                mock.patch.object(main, 'analysis_store', None), \
+                mock.patch.object(main, 'collect_data_zettablock', side_effect=lambda *args: dict(data)), \
+                mock.patch.object(main, 'download_labels_graphql', side_effect=[labels_df, labels_df, new_labels_df, newer_labels_df]), \
+                mock.patch.object(main, 'prepare_data', wraps=main.prepare_data) as prepare_data, \
+                mock.patch.object(main, 'prepare_graph_and_train_folds', side_effect=train_folds), \
+                mock.patch.object(main, 'prepare_graph_and_predict', side_effect=lambda x, *args, **kwargs: torch.full((x.shape[0], 2), 0.5)), \
+                mock.patch.object(main, 'is_contract', return_value=False), \
+                mock.patch.dict(os.environ, {'NODE_ENV': 'production'}):
+            attackers_df, graph_statistics, _ = main.run_all(addresses[0], secrets={}, web3=None)
+            assert trainings[0][0] is None
+            reused_attackers_df, reused_graph_statistics, _ = main.run_all(addresses[0], secrets={}, web3=None)
+            assert len(trainings) == 1, "The folds shouldn't be trained again if the data and labels didn't change"
+            pd.testing.assert_frame_equal(attackers_df, reused_attackers_df)
+            assert graph_statistics == reused_graph_statistics
+            _, new_graph_statistics, _ = main.run_all(addresses[0], secrets={}, web3=None)
+            assert prepare_data.call_count == 1, "The graph should be reused if the data didn't change"
+            assert len(trainings) == 2 and trainings[1][0] is not None, "The folds should be warm-started"
+            assert new_graph_statistics['n_labeled_attackers'] == 4
+            # with the default early stopping settings
+            assert trainings[1][1].max() <= WARM_START_EPOCHS < trainings[0][1].min(), "A warm start should train fewer epochs"
+            main.run_all(addresses[0], secrets={}, web3=None)
+            assert all(torch.equal(trainings[2][0][key], trainings[1][0][key]) for key in trainings[1][0]), \
+                "Every warm start should start from the last full training"
+
+    def test_run_all_global_model_first(self):
+        """
+        With GLOBAL_MODEL_FIRST the folds are only trained when the global model is uncertain about some node
+        """
+        addresses, data, labels_df = synthetic_data_and_labels()
+        with mock.patch.object(main, 'ANALYSIS_STORE_PATH', ''), \
+                mock.patch.object(main, 'GLOBAL_MODEL_FIRST', True), \
+                mock.patch.object(main, 'collect_data_zettablock', side_effect=lambda *args: dict(data)), \
+                mock.patch.object(main, 'download_labels_graphql', return_value=labels_df), \
+                mock.patch.object(main, 'prepare_graph_and_train_folds', wraps=main.prepare_graph_and_train_folds) as train_folds, \
+                mock.patch.object(main, 'is_contract', return_value=False), \
+                mock.patch.dict(os.environ, {'NODE_ENV': 'production'}):
+            # Certain about every node: the global model decides
+            with mock.patch.object(main, 'prepare_graph_and_predict', side_effect=lambda x, *args, **kwargs: torch.tensor([[0.95, 0.05]]).repeat(x.shape[0], 1)) as predict:
+                attackers_df, graph_statistics, _ = main.run_all(addresses[0], secrets={}, web3=None)
+            assert predict.call_args.kwargs['batcher'] is main.GLOBAL_MODEL_BATCHER
+            assert train_folds.call_count == 0 and attackers_df.shape[0] == 0
+            # Uncertain about the unlabeled nodes: the folds are trained, and only decide those nodes
+            with mock.patch.object(main, 'prepare_graph_and_predict', side_effect=lambda x, *args, **kwargs: torch.full((x.shape[0], 2), 0.5)):
+                attackers_df, graph_statistics, _ = main.run_all(addresses[0], secrets={}, web3=None)
+            assert train_folds.call_count == 1
+            assert not attackers_df.index.isin(labels_df['address']).any()
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,96 @@
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import numpy as np
+import pandas as pd
+import torch
+
+from src.model.aux import cross_entropy_masked
+import src.model.train as train
+from src.model.model import FoldsModelAttentionMultiHead, ModelAttentionMultiHead
+from src.model.train import prepare_graph, prepare_graph_and_train_folds
+
+
+def random_graph(n_nodes=60, n_edges=300, n_folds=3):
+    np.random.seed(1993)
+    node_feature = pd.DataFrame(np.random.rand(n_nodes, 16))
+    edge_indexes = np.random.randint(0, n_nodes, (n_edges, 2))
+    edge_features = np.random.rand(n_edges, 16)
+    labels_folds = []
+    for _ in range(n_folds):
+        labels = torch.full((n_nodes,), -1, dtype=torch.long)
+        labeled = np.random.choice(n_nodes, 20, replace=False)
+        labels[labeled[:5]] = 1
+        labels[labeled[5:]] = 0
+        labels_folds.append(labels)
+    return node_feature, edge_indexes, edge_features, labels_folds
+
+
+class TestTrain(unittest.TestCase):
+    def test_folds_model_equals_fold_models(self):
+        node_feature, edge_indexes, edge_features, _ = random_graph()
+        graph = prepare_graph(node_feature, edge_indexes, edge_features)
+        folds_model = FoldsModelAttentionMultiHead(3, 16, 16, hidden_size=64)
+        logits = folds_model(graph)
+        assert logits.shape == (3, 60, 2)
+        for fold in range(3):
+            assert torch.allclose(folds_model.fold_model(fold)(graph), logits[fold], atol=1e-5)
+
+    def test_train_folds_same_as_separately(self):
+        node_feature, edge_indexes, edge_features, labels_folds = random_graph()
+        torch.manual_seed(1993)
+        _, predictions, epochs_trained = prepare_graph_and_train_folds(
+            node_feature, edge_indexes, edge_features, cross_entropy_masked, labels_folds, epochs=10, patience=0)
+        assert epochs_trained.tolist() == [10, 10, 10]
+
+        # same initialization, each fold trained alone
+        torch.manual_seed(1993)
+        initial_model = FoldsModelAttentionMultiHead(3, 16, 16, hidden_size=64)
+        graph = prepare_graph(node_feature, edge_indexes, edge_features)
+        for fold in range(3):
+            model = initial_model.fold_model(fold)
+            optimizer = torch.optim.Adam(model.parameters(), lr=0.01, weight_decay=5e-4)
+            for _ in range(10):
+                optimizer.zero_grad()
+                cross_entropy_masked(labels_folds[fold], model(graph), torch.nn.CrossEntropyLoss()).backward()
+                optimizer.step()
+            assert torch.allclose(torch.softmax(model(graph), dim=1), predictions[fold], atol=1e-5)
+
+    def test_train_folds_early_stopping(self):
+        node_feature, edge_indexes, edge_features, labels_folds = random_graph()
+        folds_model, predictions, epochs_trained = prepare_graph_and_train_folds(
+            node_feature, edge_indexes, edge_features, cross_entropy_masked, labels_folds, patience=5, min_delta=1e-2)
+        assert (epochs_trained < 201).all(), "the folds should stop on a loss plateau"
+        # the stopped folds keep the parameters they were predicted with
+        graph = prepare_graph(node_feature, edge_indexes, edge_features)
+        assert torch.allclose(torch.softmax(folds_model(graph), dim=2), predictions, atol=1e-5)
+
+
+    def test_train_folds_warm_start(self):
+        node_feature, edge_indexes, edge_features, labels_folds = random_graph()
+        folds_model, _, epochs_trained = prepare_graph_and_train_folds(
+            node_feature, edge_indexes, edge_features, cross_entropy_masked, labels_folds, patience=5, min_delta=1e-2)
+        _, _, warm_epochs_trained = prepare_graph_and_train_folds(
+            node_feature, edge_indexes, edge_features, cross_entropy_masked, labels_folds, patience=5, min_delta=1e-2,
+            initial_state=folds_model.state_dict())
+        assert (warm_epochs_trained < epochs_trained).all(), "the warm-started folds should stop earlier"
+
+    def test_global_model_batched_predictions(self):
+        graphs = []
+        for n_nodes in [20, 35, 50]:
+            node_feature, edge_indexes, edge_features, _ = random_graph(n_nodes=n_nodes, n_edges=4 * n_nodes, n_folds=0)
+            graphs.append((node_feature, edge_indexes, edge_features))
+        torch.manual_seed(1993)
+        with mock.patch.object(train, 'big_model', ModelAttentionMultiHead(16, 16, hidden_size=64)):
+            separate_predictions = [train.prepare_graph_and_predict(*graph) for graph in graphs]
+            union_predictions = train.predict_graphs([prepare_graph(*graph) for graph in graphs])
+            batcher = train.GlobalModelBatcher(window=0.5, max_graphs=2)
+            with ThreadPoolExecutor(max_workers=3) as executor:
+                batched_predictions = list(executor.map(lambda graph: train.prepare_graph_and_predict(*graph, batcher=batcher), graphs))
+        for separate, union, batched in zip(separate_predictions, union_predictions, batched_predictions):
+            assert separate.shape == union.shape == batched.shape
+            assert torch.allclose(separate, union, atol=1e-6) and torch.allclose(separate, batched, atol=1e-6)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -6,9 +6,10 @@ from pyevmasm import disassemble_hex
 from web3 import Web3
 from os import environ
 
-from src.constants import (CONTRACT_SLOT_ANALYSIS_DEPTH,
-                           TORNADO_CASH_ADDRESSES,
+from src.constants import (TORNADO_CASH_ADDRESSES,
                            TORNADO_CASH_FUNDED_ACCOUNTS_QUEUE_SIZE)
+from src.contract_inspection import (STORAGE_ADDRESSES_CACHE, get_storage_addresses, is_candidate_address,
+                                     is_contract, is_contract_batch)
 from src.findings import SuspiciousContractFindings
 from src.storage import get_secrets
 
@@ -33,38 +34,6 @@ def initialize():
     environ["ZETTABLOCK_API_KEY"] = SECRETS_JSON['apiKeys']['ZETTABLOCK']
 
 
-def is_contract(w3, address) -> bool:
-    """
-    this function determines whether address is a contract
-    :return: is_contract: bool
-    """
-    if address is None:
-        return True
-    code = w3.eth.get_code(Web3.toChecksumAddress(address))
-    return code != HexBytes('0x')
-
-
-def get_storage_addresses(w3, address) -> set:
-    """
-    this function returns the addresses that are references in the storage of a contract (first CONTRACT_SLOT_ANALYSIS_DEPTH slots)
-    :return: address_list: list (only returning contract addresses)
-    """
-    if address is None:
-        return set()
-
-    address_set = set()
-    for i in range(CONTRACT_SLOT_ANALYSIS_DEPTH):
-        mem = w3.eth.get_storage_at(Web3.toChecksumAddress(address), i)
-        if mem != HexBytes('0x0000000000000000000000000000000000000000000000000000000000000000'):
-            # looking at both areas of the storage slot as - depending on packing - the address could be at the beginning or the end.
-            if is_contract(w3, mem[0:20]):
-                address_set.add(Web3.toChecksumAddress(mem[0:20].hex()))
-            if is_contract(w3, mem[12:]):
-                address_set.add(Web3.toChecksumAddress(mem[12:].hex()))
-
-    return address_set
-
-
 def get_opcode_addresses(w3, address) -> set:
     """
     this function returns the addresses that are references in the opcodes of a contract
@@ -75,14 +44,15 @@ def get_opcode_addresses(w3, address) -> set:
 
     code = w3.eth.get_code(Web3.toChecksumAddress(address))
     opcode = disassemble_hex(code.hex())
-    address_set = set()
+    params = []
     for op in opcode.splitlines():
         for param in op.split(' '):
             if param.startswith('0x') and len(param) == 42:
-                if is_contract(w3, param):
-                    address_set.add(Web3.toChecksumAddress(param))
+                params.append(param)
 
-    return address_set
+    # the deduplicated operands are checked with one JSON-RPC batch
+    contracts = is_contract_batch(w3, params)
+    return {address for address, contract in contracts.items() if contract}
 
 
 def detect_suspicious_contract_creations(w3, transaction_event: forta_agent.transaction_event.TransactionEvent) -> list:
@@ -99,7 +69,7 @@ def detect_suspicious_contract_creations(w3, transaction_event: forta_agent.tran
             w3, transaction_event.from_, nonce
         )
 
-        storage_addresses = get_storage_addresses(w3, created_contract_address)
+        storage_addresses = get_storage_addresses(w3, created_contract_address, transaction_event.block_number)
         opcode_addresses = get_opcode_addresses(w3, created_contract_address)
 
         created_contract_addresses.append(created_contract_address.lower())
@@ -126,7 +96,7 @@ def detect_suspicious_contract_creations(w3, transaction_event: forta_agent.tran
 
                 # obtain all the addresses contained in the created contract and propagate to the findings
                 storage_addresses = get_storage_addresses(
-                    w3, created_contract_address)
+                    w3, created_contract_address, transaction_event.block_number)
                 opcode_addresses = get_opcode_addresses(
                     w3, created_contract_address)
 
@@ -216,3 +216,12 @@ class TestSuspiciousContractAgent:
         assert finding.severity == FindingSeverity.High
         assert finding.metadata["address_contained_in_created_contract_1"] == "address1"
         assert finding.metadata["address_contained_in_created_contract_2"] == "address2"
+
+    def test_storage_addresses_candidate_filter(self):
+        assert not agent.is_candidate_address(bytes(19) + b"\x05"), "small numbers shouldn't be checked for code"
+        assert not agent.is_candidate_address(b"\xff" * 20), "masks shouldn't be checked for code"
+        assert agent.is_candidate_address(bytes.fromhex(CONTRACT_WITH_ADDRESS[2:])), "addresses should be checked for code"
+
+    def test_storage_addresses_memoized_per_block(self):
+        addresses = agent.get_storage_addresses(w3, CONTRACT_WITH_ADDRESS, 1)
+        assert agent.STORAGE_ADDRESSES_CACHE[(CONTRACT_WITH_ADDRESS, 1)] == addresses
@@ -1,4 +1,9 @@
 CONTRACT_SLOT_ANALYSIS_DEPTH = 20  # how many slots should be read to extract contract addresses from created contract
+CONTRACT_CACHE_SIZE = 100000  # how many contract/EOA check results to keep
+RPC_BATCH_SIZE = 100  # how many calls to send in one JSON-RPC batch
+RPC_BATCH_TIMEOUT = 30  # timeout in seconds of the JSON-RPC batch request
+STORAGE_ADDRESSES_CACHE_SIZE = 1000  # how many (contract, block) storage addresses results to keep
+MIN_ADDRESS_NONZERO_BYTES = 10  # storage values with fewer non-zero bytes are not checked for contracts
 
 TORNADO_CASH_FUNDED_ACCOUNTS_QUEUE_SIZE = 10000  # how many accounts should be held by the bot in memory before dequeuing items
 
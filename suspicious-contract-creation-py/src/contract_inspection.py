@@ -0,0 +1,165 @@
+import logging
+from collections import OrderedDict
+
+import requests
+from hexbytes import HexBytes
+from web3 import Web3
+
+from src.constants import (
+    CONTRACT_CACHE_SIZE,
+    CONTRACT_SLOT_ANALYSIS_DEPTH,
+    MIN_ADDRESS_NONZERO_BYTES,
+    RPC_BATCH_SIZE,
+    RPC_BATCH_TIMEOUT,
+    STORAGE_ADDRESSES_CACHE_SIZE,
+)
+
+# same module in the contract analysis bots (malicious-smart-contract-ml, malicious-token-contract-ml,
+# suspicious-contract-creation, unverified-contract); keep the copies in sync
+
+# the logger the ml bots set up in src/logger.py, the root logger in the other bots
+logger = logging.getLogger("root")
+
+ZERO_SLOT = bytes(32)
+MASK_BYTES = b"\xff" * 20
+CONTRACT_CACHE = OrderedDict()  # checksum address -> whether it is a contract, shared by all the contract checks
+STORAGE_ADDRESSES_CACHE = OrderedDict()  # (checksum address, block number) -> storage addresses
+
+
+def lru_put(cache: OrderedDict, key, value, max_size: int):
+    cache[key] = value
+    cache.move_to_end(key)
+    if len(cache) > max_size:
+        cache.popitem(last=False)
+
+
+def rpc_batch(w3, method: str, params_list: list) -> list:
+    """
+    this function sends the calls as JSON-RPC batches of RPC_BATCH_SIZE to the http provider of w3
+    :return: results in the order of params_list, None for the failed calls or when the provider has no endpoint
+    """
+    results = [None] * len(params_list)
+    endpoint_uri = getattr(getattr(w3, "provider", None), "endpoint_uri", None)
+    if endpoint_uri is None:
+        return results
+
+    for start in range(0, len(params_list), RPC_BATCH_SIZE):
+        payload = [
+            {"jsonrpc": "2.0", "id": id, "method": method, "params": params_list[id]}
+            for id in range(start, min(start + RPC_BATCH_SIZE, len(params_list)))
+        ]
+        try:
+            responses = requests.post(str(endpoint_uri), json=payload, timeout=RPC_BATCH_TIMEOUT).json()
+            for response in responses:
+                if response.get("result") is not None:
+                    results[response["id"]] = response["result"]
+        except Exception as e:
+            logger.warning(f"Error in {method} batch of {len(payload)} calls, falling back to single calls: {e}")
+    return results
+
+
+def is_contract(w3, address) -> bool:
+    """
+    this function determines whether address is a contract
+    :return: is_contract: bool
+    """
+    if address is None:
+        return True
+    checksum_address = Web3.toChecksumAddress(address)
+    contract = CONTRACT_CACHE.get(checksum_address)
+    if contract is None:
+        code = w3.eth.get_code(checksum_address)
+        contract = code != HexBytes("0x")
+    lru_put(CONTRACT_CACHE, checksum_address, contract, CONTRACT_CACHE_SIZE)
+    return contract
+
+
+def is_contract_batch(w3, addresses) -> dict:
+    """
+    this function determines which addresses are contracts, fetching the code of the addresses not in the cache with JSON-RPC batches of eth_getCode
+    :return: is_contract by checksum address: dict
+    """
+    result = {}
+    for address in addresses:
+        checksum_address = Web3.toChecksumAddress(address)
+        if checksum_address not in result:
+            result[checksum_address] = CONTRACT_CACHE.get(checksum_address)
+
+    misses = [address for address, contract in result.items() if contract is None]
+    if len(misses) > 1:
+        codes = rpc_batch(w3, "eth_getCode", [[address, "latest"] for address in misses])
+        for address, code in zip(misses, codes):
+            if code is not None:
+                result[address] = code not in ("0x", "0x0")
+
+    # single calls for the providers without batch support and the failed calls
+    for address, contract in result.items():
+        if contract is None:
+            result[address] = is_contract(w3, address)
+        else:
+            lru_put(CONTRACT_CACHE, address, contract, CONTRACT_CACHE_SIZE)
+
+    return result
+
+
+def is_candidate_address(candidate: bytes) -> bool:
+    """
+    this function discards the values that can't be the address of a deployed contract without a RPC call: small numbers,
+    values packed with zeros (e.g. the other half of a slot holding an address) and masks
+    :return: is_candidate_address: bool
+    """
+    return len(candidate) - candidate.count(0) >= MIN_ADDRESS_NONZERO_BYTES and candidate != MASK_BYTES
+
+
+def get_storage_slots(w3, checksum_address: str, block_identifier="latest") -> list:
+    """
+    this function reads the first CONTRACT_SLOT_ANALYSIS_DEPTH storage slots of a contract in one JSON-RPC batch
+    :return: slots: list of 32 bytes
+    """
+    block_param = hex(block_identifier) if isinstance(block_identifier, int) else block_identifier
+    results = rpc_batch(
+        w3,
+        "eth_getStorageAt",
+        [[checksum_address, hex(i), block_param] for i in range(CONTRACT_SLOT_ANALYSIS_DEPTH)],
+    )
+
+    slots = []
+    for i, result in enumerate(results):
+        if result is not None:
+            slots.append(bytes(HexBytes(result)).rjust(32, b"\x00"))
+        elif block_identifier == "latest":
+            slots.append(bytes(w3.eth.get_storage_at(checksum_address, i)))
+        else:
+            slots.append(bytes(w3.eth.get_storage_at(checksum_address, i, block_identifier)))
+    return slots
+
+
+def get_storage_addresses(w3, address, block_identifier="latest") -> set:
+    """
+    this function returns the addresses that are references in the storage of a contract (first CONTRACT_SLOT_ANALYSIS_DEPTH slots)
+    the slots are read in one batch and the candidate addresses are checked in a second one; memoized per (address, block number)
+    :return: address_list: list (only returning contract addresses)
+    """
+    if address is None:
+        return set()
+    if block_identifier is None:
+        block_identifier = "latest"
+
+    checksum_address = Web3.toChecksumAddress(address)
+    memoize = isinstance(block_identifier, int)
+    if memoize and (checksum_address, block_identifier) in STORAGE_ADDRESSES_CACHE:
+        return set(STORAGE_ADDRESSES_CACHE[(checksum_address, block_identifier)])
+
+    candidates = []
+    for mem in get_storage_slots(w3, checksum_address, block_identifier):
+        if mem != ZERO_SLOT:
+            # looking at both areas of the storage slot as - depending on packing - the address could be at the beginning or the end.
+            for candidate in (mem[0:20], mem[12:]):
+                if is_candidate_address(candidate):
+                    candidates.append(candidate)
+
+    contracts = is_contract_batch(w3, candidates)
+    address_set = {address for address, contract in contracts.items() if contract}
+    if memoize:
+        lru_put(STORAGE_ADDRESSES_CACHE, (checksum_address, block_identifier), frozenset(address_set), STORAGE_ADDRESSES_CACHE_SIZE)
+    return address_set
@@ -22,7 +22,7 @@ class EthMock:
         else:
             return 0
 
-    def get_storage_at(self, address, position):
+    def get_storage_at(self, address, position, block_identifier=None):
         if address == EOA_ADDRESS:
             return HexBytes('0x0000000000000000000000000000000000000000000000000000000000000000')
         elif address == CONTRACT_NO_ADDRESS:
@@ -13,7 +13,8 @@ from web3 import Web3
 import time
 
 from src.blockexplorer import BlockExplorer
-from src.constants import CONTRACT_SLOT_ANALYSIS_DEPTH, WAIT_TIME
+from src.constants import WAIT_TIME
+from src.contract_inspection import get_storage_addresses, is_contract, is_contract_batch
 from src.findings import UnverifiedCodeContractFindings
 from src.storage import get_secrets
 
@@ -72,38 +73,6 @@ def calc_contract_address(w3, address, nonce) -> str:
     return Web3.toChecksumAddress(Web3.keccak(rlp.encode([address_bytes, nonce]))[-20:])
 
 
-def is_contract(w3, address) -> bool:
-    """
-    this function determines whether address is a contract
-    :return: is_contract: bool
-    """
-    if address is None:
-        return True
-    code = w3.eth.get_code(Web3.toChecksumAddress(address))
-    return code != HexBytes('0x')
-
-
-def get_storage_addresses(w3, address) -> set:
-    """
-    this function returns the addresses that are references in the storage of a contract (first CONTRACT_SLOT_ANALYSIS_DEPTH slots)
-    :return: address_list: list (only returning contract addresses)
-    """
-    if address is None:
-        return set()
-
-    address_set = set()
-    for i in range(CONTRACT_SLOT_ANALYSIS_DEPTH):
-        mem = w3.eth.get_storage_at(Web3.toChecksumAddress(address), i)
-        if mem != HexBytes('0x0000000000000000000000000000000000000000000000000000000000000000'):
-            # looking at both areas of the storage slot as - depending on packing - the address could be at the beginning or the end.
-            if is_contract(w3, mem[0:20]):
-                address_set.add(Web3.toChecksumAddress(mem[0:20].hex()))
-            if is_contract(w3, mem[12:]):
-                address_set.add(Web3.toChecksumAddress(mem[12:].hex()))
-
-    return address_set
-
-
 def get_opcode_addresses(w3, address) -> set:
     """
     this function returns the addresses that are references in the opcodes of a contract
@@ -114,14 +83,15 @@ def get_opcode_addresses(w3, address) -> set:
 
     code = w3.eth.get_code(Web3.toChecksumAddress(address))
     opcode = disassemble_hex(code.hex())
-    address_set = set()
+    params = []
     for op in opcode.splitlines():
         for param in op.split(' '):
             if param.startswith('0x') and len(param) == 42:
-                if is_contract(w3, param):
-                    address_set.add(Web3.toChecksumAddress(param))
+                params.append(param)
 
-    return address_set
+    # the deduplicated operands are checked with one JSON-RPC batch
+    contracts = is_contract_batch(w3, params)
+    return {address for address, contract in contracts.items() if contract}
 
 
 def cache_contract_creation(w3, blockexplorer, transaction_event: forta_agent.transaction_event.TransactionEvent):
@@ -186,6 +156,8 @@ def detect_unverified_contract_creation(w3, blockexplorer, wait_time=WAIT_TIME,
                             if not blockexplorer.is_verified(created_contract_address):
                                 logging.info(
                                     f"Identified unverified contract: {created_contract_address}")
+                                # read at the latest block: the contract is checked WAIT_TIME after its creation and
+                                # nodes without historical state can't serve the storage of that block
                                 storage_addresses = get_storage_addresses(
                                     w3, created_contract_address)
                                 opcode_addresses = get_opcode_addresses(